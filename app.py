@@ -1,21 +1,47 @@
-import tempfile
-import io
 import os
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydub import AudioSegment # For conversion
 from pydub.exceptions import CouldntDecodeError
 
-from http.client import HTTPException
-
 import uvicorn
-from starlette.responses import HTMLResponse
-from fastapi import FastAPI, File, UploadFile
+from starlette.responses import HTMLResponse, PlainTextResponse
+from fastapi import FastAPI, File, HTTPException, UploadFile
 from starlette.responses import JSONResponse
 from starlette.staticfiles import StaticFiles
 
-from fingerprinting import endpoint_detection_app
-
-app = FastAPI()
+import metrics
+from recognition_service import RecognitionService, ServiceSaturated
+
+DB_PATH = os.environ.get('FINGERPRINT_DB', 'fingerprints.db') # SQLite database or memory-mapped index directory
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', os.cpu_count()))
+RECOGNITION_MAX_QUEUE = int(os.environ.get('RECOGNITION_MAX_QUEUE', 2 * RECOGNITION_WORKERS))
+LOOKUP_BATCH_WINDOW_MS = float(os.environ.get('LOOKUP_BATCH_WINDOW_MS', 0)) # 0 disables micro-batching of hash lookups
+MATCH_PROGRESSIVE = os.environ.get('MATCH_PROGRESSIVE', '0') == '1' # resolve hashes rarest first and prune hopeless songs
+MATCH_EARLY_STOP_MARGIN = float(os.environ['MATCH_EARLY_STOP_MARGIN']) if 'MATCH_EARLY_STOP_MARGIN' in os.environ else None
+RECOGNITION_WARM_UP = os.environ.get('RECOGNITION_WARM_UP', '1') == '1' # workers pre-load librosa and JIT compile before serving
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024)) # recognition results kept for re-uploads, 0 disables the cache
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('RESULT_CACHE_TTL_SECONDS', 3600))
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', 0)) # warn if startup takes longer, 0 disables the check
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_start = time.perf_counter()
+    app.state.recognition = RecognitionService(DB_PATH, RECOGNITION_WORKERS, RECOGNITION_MAX_QUEUE, LOOKUP_BATCH_WINDOW_MS / 1000,
+                                               {'progressive': MATCH_PROGRESSIVE, 'margin': MATCH_EARLY_STOP_MARGIN},
+                                               RECOGNITION_WARM_UP, RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS)
+    app.state.recognition.warm_up()
+    startup_seconds = time.perf_counter() - startup_start
+    print(f"Recognition pool ready with {RECOGNITION_WORKERS} workers in {startup_seconds:.2f}s.")
+    metrics.record_event('startup', startup_seconds, workers=RECOGNITION_WORKERS, warm_up=RECOGNITION_WARM_UP)
+    if STARTUP_BUDGET_SECONDS and startup_seconds > STARTUP_BUDGET_SECONDS:
+        print(f"Warning: startup took {startup_seconds:.2f}s, over the budget of {STARTUP_BUDGET_SECONDS:.2f}s")
+    yield
+    app.state.recognition.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "application/static"
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
@@ -29,10 +55,9 @@ async def read_root():
 # Renamed function slightly to avoid confusion with the previous attempt
 async def process_audio_upload_convert(audio_file: UploadFile = File(...)) -> JSONResponse:
     """
-    Receives uploaded audio, converts to WAV, generates spectrogram from WAV path.
+    Receives uploaded audio, decodes it in memory and runs the detection on the decoded samples.
     """
     print(f"Received upload: {audio_file.filename}, content_type: {audio_file.content_type}")
-    temp_wav_path = None # Initialize path variable
 
     try:
         # 1. Read uploaded audio bytes
@@ -40,48 +65,29 @@ async def process_audio_upload_convert(audio_file: UploadFile = File(...)) -> JS
         if not audio_bytes:
             raise HTTPException(status_code=400, detail="No audio data received.")
 
-        # 2. Use Pydub to load audio from bytes
-        audio_stream = io.BytesIO(audio_bytes)
+        # 2. Decode and recognize in the worker pool, keeping the event loop free for other uploads
         try:
-            print("Loading audio bytes with Pydub...")
-            audio_segment = AudioSegment.from_file(audio_stream)
-            print(f"Pydub loaded audio: {audio_segment.duration_seconds}s, {audio_segment.frame_rate}Hz, {audio_segment.channels}ch")
+            match_name, score = await app.state.recognition.recognize(audio_bytes)
+        except ServiceSaturated as saturated:
+            print(f"Rejecting upload: {saturated}")
+            metrics.count('uploads_rejected')
+            raise HTTPException(status_code=503,
+                                detail={"message": "Server busy, retry later.", "queue_depth": saturated.queue_depth, "capacity": saturated.capacity},
+                                headers={"Retry-After": "1"})
         except CouldntDecodeError as decode_err:
              print(f"Pydub decode error: {decode_err}. Is ffmpeg installed?")
+             metrics.count('upload_decode_errors')
              raise HTTPException(status_code=400, detail=f"Cannot decode uploaded audio format ({audio_file.content_type}). Error: {decode_err}")
-        except Exception as pydub_err:
-            print(f"Error loading audio with Pydub: {pydub_err}")
-            raise HTTPException(status_code=500, detail=f"Server error processing audio with Pydub: {pydub_err}")
 
-        # 3. Create a temporary file path for the WAV output
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav_file:
-            temp_wav_path = temp_wav_file.name
-        print(f"Created temporary WAV path: {temp_wav_path}")
-
-        # 4. Export the audio segment to the temporary WAV file
-        try:
-            print(f"Exporting to WAV: {temp_wav_path}")
-            # Export as WAV (generally safer for processing than MP3)
-            audio_segment.export(temp_wav_path, format="wav")
-            print("WAV export complete.")
-        except Exception as export_err:
-            print(f"Error exporting to WAV: {export_err}")
-            raise HTTPException(status_code=500, detail=f"Server error converting audio to WAV: {export_err}")
-
-        # 5. Call your function with the temporary WAV path
-        print(f"Calling generate_spectrogram with path: {temp_wav_path}")
-        # Make sure generate_spectogram expects a path string here
-        match_name, score = endpoint_detection_app(temp_wav_path)
-
-        # 6. Process the results
+        # 3. Process the results
         result_data = {
-            "message": "Spectrogram generated successfully from converted WAV.",
+            "message": "Spectrogram generated successfully from uploaded audio.",
             "closest_match": match_name,
             "score": score,
         }
         print(f"Spectrogram processing complete. Result data: {result_data}")
 
-        # 7. Return success response
+        # 4. Return success response
         return JSONResponse(content={
             "status": "success",
             "filename": audio_file.filename,
@@ -95,22 +101,21 @@ async def process_audio_upload_convert(audio_file: UploadFile = File(...)) -> JS
         raise http_exc
     except Exception as e:
         print(f"Unhandled error processing audio: {e}")
+        metrics.count('upload_errors')
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
     finally:
-        # 8. Clean up: Ensure the temporary WAV file is deleted
-        if temp_wav_path and os.path.exists(temp_wav_path):
-            try:
-                os.remove(temp_wav_path)
-                print(f"Cleaned up temporary file: {temp_wav_path}")
-            except OSError as cleanup_err:
-                print(f"Error cleaning up temporary file {temp_wav_path}: {cleanup_err}")
-
         if audio_file:
             await audio_file.close()
             print("UploadFile closed.")
 
 
+@app.get('/metrics')
+async def read_metrics() -> PlainTextResponse:
+    """Stage latencies and counters in the Prometheus text format, empty while FINGERPRINT_METRICS=0."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 @app.get('/', response_class=HTMLResponse)
 async def read_html_root():
     html_file_path = BASE_DIR / "application/templates/index.html"
@@ -0,0 +1,170 @@
+import csv
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Iterator
+
+from fingerprinting import find_peak_indices, compute_spectrogram, generate_fingerprint_arrays, generate_fingerprints, get_sample_len, \
+    load_audio, match_sample_db, peak_indices_to_peaks, warm_up
+from fingerprint_index import open_index
+from repeat_detection import find_repeats, loop_coverage, recording_peaks
+
+AUDIO_SUFFIXES = ('.mp3', '.wav', '.flac', '.ogg')
+RESULT_FIELDS = ['path', 'start_time', 'clip_len', 'match', 'score', 'confidence', 'expected', 'correct', 'peaks', 'loop_period', 'loop_coverage',
+                 'seconds', 'error']
+
+ClipJob = namedtuple('ClipJob', ['index', 'path', 'start_time', 'expected'])
+
+_worker_index = None # opened once per worker process by _init_worker
+_worker_options = {}
+
+
+def find_audio_files(folder) -> list:
+    return sorted(path for path in Path(folder).rglob('*') if path.suffix.lower() in AUDIO_SUFFIXES)
+
+
+def read_jobs(source) -> list:
+    """
+    ClipJobs for every audio file below a directory, or for every row of a manifest. A manifest is a CSV file with
+    a path column and optional start_time and expected columns, or a text file with one path per line. Relative
+    paths are resolved against the manifest's directory.
+    """
+    source = Path(source)
+    if source.is_dir():
+        return [ClipJob(index, path, None, None) for index, path in enumerate(find_audio_files(source))]
+
+    with open(source, 'r', newline='', encoding='utf-8') as f:
+        if source.suffix.lower() == '.csv':
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [{'path': line.strip()} for line in f if line.strip()]
+    return [ClipJob(index, source.parent / row['path'],
+                    float(row['start_time']) if row.get('start_time') else None,
+                    row.get('expected') or None)
+            for index, row in enumerate(rows)]
+
+
+def relative_clip_starts(seed: int, count: int = 30) -> list:
+    """Clip positions as fractions of the part of a file a clip can start in, drawn like tests_db.generate_random_list."""
+    rng = random.Random(seed)
+    return [rng.random() for _ in range(count)]
+
+
+def _init_worker(db_path, options: dict) -> None:
+    global _worker_index, _worker_options
+    _worker_index = open_index(db_path)
+    _worker_index.lookup([0]) # touch the index so the first clip doesn't pay for opening it
+    _worker_options = options
+    if not options['verbose']:
+        sys.stdout = open(os.devnull, 'w') # the pipeline's progress prints would interleave across workers
+    warm_up(_worker_index.front_end) # keeps the librosa imports and JIT compilation out of the first clip's timing
+
+
+def recognize_clip(job: ClipJob) -> dict:
+    """Decodes the job's file once, cuts the clip from memory and matches it. Runs in a worker process."""
+    options = _worker_options
+    front_end = _worker_index.front_end
+    clip_len = options['clip_len']
+    result = {'path': str(job.path), 'expected': job.expected}
+    start = time.perf_counter()
+    try:
+        audio_signal, sampling_rate = load_audio(str(job.path), sampling_rate=front_end.sampling_rate)
+        duration = get_sample_len(audio_signal, sampling_rate)
+        if options['detect_loops']:
+            # flags recordings that loop one lure before the catalog is queried, from a self-join of the whole file
+            peaks, _ = recording_peaks([audio_signal], options['peak_min_dist'], options['peak_min_amp'],
+                                       options['max_peaks_per_frame'], front_end)
+            repeats = find_repeats(*generate_fingerprint_arrays(peaks))
+            if repeats:
+                result.update(loop_period=round(repeats[0].period, 3), loop_coverage=round(loop_coverage(repeats[0], duration), 3))
+        if clip_len is None or clip_len >= duration:
+            start_time, clip_len = 0.0, duration
+        elif job.start_time is not None:
+            start_time = min(job.start_time, duration - clip_len)
+        else:
+            # the same seeded clip positions as experiments/tests_db.execute_test
+            start_time = options['relative_starts'][job.index % len(options['relative_starts'])] * (duration - clip_len)
+
+        while True:
+            first_sample = int(start_time * sampling_rate)
+            clip = audio_signal[first_sample:first_sample + int(clip_len * sampling_rate)]
+            frames, bins = find_peak_indices(compute_spectrogram(clip, front_end), options['peak_min_dist'],
+                                             options['peak_min_amp'], options['max_peaks_per_frame'])
+            # near silent clips are moved along the file until they have enough peaks to match
+            if len(frames) >= 10 or start_time + 0.5 > duration - clip_len:
+                break
+            start_time += 0.5
+
+        sample_fingerprints = generate_fingerprints(peak_indices_to_peaks(frames, bins, front_end), 'test')
+        match_name, score, confidence = match_sample_db(sample_fingerprints, _worker_index, get_sample_len(clip, sampling_rate),
+                                                        options['progressive'], options['margin'])
+        result.update(start_time=round(start_time, 3), clip_len=round(get_sample_len(clip, sampling_rate), 3),
+                      match=match_name, score=score, confidence=confidence, peaks=len(frames))
+        if job.expected is not None:
+            result['correct'] = score >= options['min_score'] and match_name == job.expected
+    except Exception as err:
+        result['error'] = f"{type(err).__name__}: {err}"
+    result['seconds'] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def recognize_batch(source, db_path, workers: int = 1, clip_len: float = None, seed: int = 42, peak_min_distance: int = 25,
+                    peak_min_amplitude_threshold: int = -40, max_peaks_per_frame: int = None, min_score: int = 250,
+                    progressive: bool = False, margin: float = None, detect_loops: bool = False, verbose: bool = False) -> Iterator[dict]:
+    """
+    Recognizes a clip of every file of a directory or manifest (see read_jobs) and yields one result dict per
+    file as soon as it is done, in completion order. Every worker process opens the index once. Without
+    clip_len the whole file is matched, otherwise a clip_len second clip at the manifest's start_time or at a
+    seeded random position. With detect_loops, the strongest repeat period of every file and the fraction of the
+    file it covers are added as loop_period and loop_coverage, see repeat_detection.
+    """
+    options = {
+        'clip_len': clip_len,
+        'relative_starts': relative_clip_starts(seed),
+        'peak_min_dist': peak_min_distance,
+        'peak_min_amp': peak_min_amplitude_threshold,
+        'max_peaks_per_frame': max_peaks_per_frame,
+        'min_score': min_score,
+        'progressive': progressive,
+        'margin': margin,
+        'detect_loops': detect_loops,
+        'verbose': verbose,
+    }
+    jobs = read_jobs(source)
+    with Pool(workers, initializer=_init_worker, initargs=(db_path, options)) as pool:
+        yield from pool.imap_unordered(recognize_clip, jobs)
+
+
+def write_results(results: Iterator[dict], out_path=None, min_score: int = 250) -> dict:
+    """
+    Streams results to a CSV file, a JSONL file or, without out_path, stdout as JSONL, flushing every row so
+    partial results survive an interrupted run. Returns a summary of the batch.
+    """
+    summary = {'clips': 0, 'errors': 0, 'matched': 0, 'with_expected': 0, 'correct': 0}
+    start = time.perf_counter()
+    out_file = open(out_path, 'w', newline='', encoding='utf-8') if out_path else sys.stdout
+    writer = csv.DictWriter(out_file, RESULT_FIELDS) if out_path and Path(out_path).suffix.lower() == '.csv' else None
+    try:
+        if writer:
+            writer.writeheader()
+        for result in results:
+            summary['clips'] += 1
+            summary['errors'] += 'error' in result
+            summary['matched'] += result.get('score', 0) >= min_score
+            summary['with_expected'] += 'correct' in result
+            summary['correct'] += bool(result.get('correct'))
+            if writer:
+                writer.writerow(result)
+            else:
+                out_file.write(json.dumps(result) + '\n')
+            out_file.flush()
+    finally:
+        if out_path:
+            out_file.close()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
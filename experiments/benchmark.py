@@ -0,0 +1,304 @@
+"""
+Benchmark of the ingestion and recognition hot paths on synthetic, seeded audio, so no dataset is needed and runs
+of different commits are comparable. Run from the repository root:
+
+    python -m experiments.benchmark --out benchmark.json [--baseline previous.json]
+
+A few probe songs are rendered as WAV files and go through the full pipeline. The rest of each catalog is filled with
+fingerprints of random peaks drawn from the probe songs' frequencies, which keeps 100k song catalogs cheap to build.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+from fingerprinting import SAMPLING_RATE, HOP_LENGTH, load_audio, compute_spectrogram, find_peak_indices, peak_indices_to_peaks, \
+    generate_fingerprint_arrays, generate_fingerprints, add_song_to_db, add_fingerprint_arrays_to_db, match_sample_db
+from fingerprint_index import open_index
+from setup import setup_db
+
+BENCHMARK_FORMAT_VERSION = 2
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list) # stage -> [seconds]
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.samples[stage].append(time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        return {stage: latency_stats(samples) for stage, samples in self.samples.items()}
+
+
+def latency_stats(samples: list) -> dict:
+    samples_ms = np.array(samples) * 1000
+    return {
+        "n": len(samples_ms),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p95_ms": float(np.percentile(samples_ms, 95)),
+        "mean_ms": float(samples_ms.mean()),
+        "total_s": float(samples_ms.sum() / 1000),
+    }
+
+
+def peak_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB on Linux
+
+
+@contextmanager
+def quiet():
+    """Silences the progress prints of the pipeline while it is being timed."""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+
+def synthetic_song(seed: int, duration: float, sampling_rate: int = SAMPLING_RATE) -> np.ndarray:
+    """Bird song like signal: frequency sweeping syllables with a harmonic and hann envelopes over faint noise."""
+    rng = np.random.default_rng(seed)
+    signal = rng.normal(0, 0.003, int(duration * sampling_rate)).astype(np.float32)
+    syllable_start = rng.uniform(0, 0.3)
+    while syllable_start < duration:
+        syllable_len = rng.uniform(0.05, 0.4)
+        sample_count = min(int(syllable_len * sampling_rate), len(signal) - int(syllable_start * sampling_rate))
+        t = np.arange(sample_count) / sampling_rate
+        start_freq, end_freq = rng.uniform(1000, 6000, 2)
+        phase = 2 * np.pi * (start_freq * t + (end_freq - start_freq) * t ** 2 / (2 * syllable_len))
+        syllable = (np.sin(phase) + 0.3 * np.sin(2 * phase)) * np.hanning(sample_count) * rng.uniform(0.2, 0.8)
+        first = int(syllable_start * sampling_rate)
+        signal[first:first + sample_count] += syllable.astype(np.float32)
+        syllable_start += syllable_len + rng.uniform(0.02, 0.5)
+    return signal
+
+
+def filler_peaks(rng, duration: float, peaks_per_second: float, freq_pool: np.ndarray) -> np.ndarray:
+    peak_count = rng.poisson(peaks_per_second * duration)
+    frames = rng.integers(0, int(duration * SAMPLING_RATE / HOP_LENGTH), peak_count)
+    return np.column_stack((frames * HOP_LENGTH / SAMPLING_RATE, rng.choice(freq_pool, peak_count)))
+
+
+def fingerprint_file(path, timer: StageTimer, peak_min_distance: int, peak_min_amplitude_threshold: int,
+                     start_time: float = 0.0, clip_duration: float = None):
+    with timer.time("decode"):
+        audio_signal, sampling_rate = load_audio(str(path), start_time, clip_duration)
+    with timer.time("stft"):
+        spectrogram = compute_spectrogram(audio_signal)
+    with timer.time("find_peaks"):
+        frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold)
+        peaks = peak_indices_to_peaks(frames, bins)
+    return audio_signal, peaks
+
+
+def run_benchmark(args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    work_dir = Path(tempfile.mkdtemp(prefix='fingerprint-benchmark-'))
+    db_path = work_dir / 'benchmark.db'
+    setup_db(db_path)
+    conn = sqlite3.connect(db_path)
+
+    # probe songs: full pipeline, timed per song
+    ingest_timer = StageTimer()
+    probe_paths, probe_peaks = [], []
+    for probe in range(args.probe_songs):
+        path = work_dir / f'probe{probe:04d}.wav'
+        sf.write(path, synthetic_song(args.seed * 100_003 + probe, args.song_duration), SAMPLING_RATE)
+        probe_paths.append(path)
+
+    with quiet():
+        fingerprint_file(probe_paths[0], StageTimer(), args.peak_min_dist, args.peak_min_amp) # pays for lazy imports and JIT compilation
+        for path in probe_paths:
+            audio_signal, peaks = fingerprint_file(path, ingest_timer, args.peak_min_dist, args.peak_min_amp)
+            with ingest_timer.time("generate_fingerprints"):
+                hashes, offsets = generate_fingerprint_arrays(peaks)
+            with ingest_timer.time("db_insert"):
+                song_id = add_song_to_db(conn, path.name, path, len(audio_signal) / SAMPLING_RATE, commit=False)
+                add_fingerprint_arrays_to_db(conn, song_id, hashes, offsets)
+            probe_peaks.append(peaks)
+
+    all_probe_peaks = np.concatenate(probe_peaks)
+    peaks_per_second = len(all_probe_peaks) / (args.probe_songs * args.song_duration)
+    freq_pool = all_probe_peaks[:, 1]
+    ingest_stages = ingest_timer.summary()
+    audio_seconds = args.probe_songs * args.song_duration
+    ingest = {
+        "stages": ingest_stages,
+        "audio_seconds_per_second": audio_seconds / sum(stage["total_s"] for stage in ingest_stages.values()),
+        "peaks_per_second_of_audio": peaks_per_second,
+        "catalogs": [],
+    }
+
+    # query clips cut at seeded positions from the probe songs
+    queries = [(int(rng.integers(args.probe_songs)), float(rng.uniform(0, 1))) for _ in range(args.queries)]
+
+    recognition = []
+    song_count = args.probe_songs
+    for catalog_size in sorted(args.catalog_sizes):
+        filler_start = time.perf_counter()
+        filler_rows = 0
+        with quiet():
+            while song_count < catalog_size:
+                hashes, offsets = generate_fingerprint_arrays(filler_peaks(rng, args.song_duration, peaks_per_second, freq_pool))
+                song_id = add_song_to_db(conn, f'filler{song_count:06d}', '', args.song_duration, commit=False)
+                add_fingerprint_arrays_to_db(conn, song_id, hashes, offsets, commit=False)
+                filler_rows += len(hashes)
+                song_count += 1
+                if song_count % 1000 == 0:
+                    conn.commit()
+            conn.commit()
+        filler_seconds = time.perf_counter() - filler_start
+        fingerprint_count = conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        ingest["catalogs"].append({
+            "songs": song_count,
+            "fingerprints": fingerprint_count,
+            "db_size_bytes": db_path.stat().st_size,
+            "insert_rows_per_second": filler_rows / filler_seconds if filler_rows else None,
+            "peak_rss_kib": peak_rss_kib(),
+        })
+        print(f"Catalog of {song_count} songs, {fingerprint_count} fingerprints", file=sys.stderr)
+
+        index = open_index(db_path)
+        with quiet():
+            index.lookup([0]) # reload the song metadata outside the timed queries
+            for clip_len in sorted(args.clip_lengths):
+                timer = StageTimer()
+                correct = 0
+                clip_start = time.perf_counter()
+                for probe, relative_start in queries:
+                    start_time = relative_start * max(args.song_duration - clip_len, 0)
+                    _, peaks = fingerprint_file(probe_paths[probe], timer, args.peak_min_dist, args.peak_min_amp, start_time, clip_len)
+                    with timer.time("generate_fingerprints"):
+                        sample_fingerprints = generate_fingerprints(peaks, 'test')
+                    with timer.time("match_sample_db"):
+                        match_name, score, _ = match_sample_db(sample_fingerprints, index, clip_len, args.progressive, args.margin)
+                    correct += match_name == probe_paths[probe].name
+                recognition.append({
+                    "catalog_songs": song_count,
+                    "clip_len": clip_len,
+                    "stages": timer.summary(),
+                    "clips_per_second": len(queries) / (time.perf_counter() - clip_start),
+                    "accuracy": correct / len(queries),
+                })
+
+    conn.close()
+    for path in work_dir.iterdir():
+        path.unlink()
+    work_dir.rmdir()
+
+    return {"ingest": ingest, "recognition": recognition}
+
+
+STARTUP_MODULES = ('fingerprinting', 'fingerprint_index', 'streaming', 'recognition_service', 'app')
+
+
+def run_python(code: str) -> float:
+    """Runs code in a fresh interpreter in the repository root and returns the float it prints."""
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).resolve().parent.parent).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_startup(repeats: int = 3, budget_seconds: float = None) -> dict:
+    """
+    Best of repeats cold import times of the modules servers and scripts start with, and the time warm_up needs
+    in a fresh process. Imports slower than budget_seconds are listed under over_budget.
+    """
+    startup = {}
+    for module in STARTUP_MODULES:
+        try:
+            startup[f"import_{module}_s"] = min(run_python(f"import time; start = time.perf_counter(); import {module}; "
+                                                           f"print(time.perf_counter() - start)") for _ in range(repeats))
+        except subprocess.CalledProcessError:
+            startup[f"import_{module}_s"] = None # e.g. the web server's dependencies aren't installed
+    startup["warm_up_s"] = min(run_python("import fingerprinting; print(fingerprinting.warm_up())") for _ in range(repeats))
+    if budget_seconds is not None:
+        startup["budget_s"] = budget_seconds
+        startup["over_budget"] = [key for key, seconds in startup.items()
+                                  if key.startswith('import_') and seconds is not None and seconds > budget_seconds]
+    return startup
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> None:
+    """Prints the p50 of every stage next to the baseline's and flags the ones that got slower than tolerance allows."""
+    def stage_p50s(report):
+        p50s = {('ingest', stage): stats['p50_ms'] for stage, stats in report['ingest']['stages'].items()}
+        for run in report['recognition']:
+            for stage, stats in run['stages'].items():
+                p50s[(f"{run['catalog_songs']} songs, {run['clip_len']}s clips", stage)] = stats['p50_ms']
+        return p50s
+
+    baseline_startup = baseline.get('startup', {})
+    for key, seconds in results.get('startup', {}).items():
+        if key.endswith('_s') and key != 'budget_s' and seconds is not None and baseline_startup.get(key):
+            ratio = seconds / baseline_startup[key]
+            flag = '  <-- slower' if ratio > 1 + tolerance else ''
+            print(f"{'startup':>30} {key:<22} {baseline_startup[key] * 1000:9.2f}ms -> {seconds * 1000:9.2f}ms ({ratio:.2f}x){flag}")
+
+    baseline_p50s = stage_p50s(baseline)
+    for key, p50 in stage_p50s(results).items():
+        if key not in baseline_p50s:
+            continue
+        ratio = p50 / baseline_p50s[key] if baseline_p50s[key] else float('inf')
+        flag = '  <-- slower' if ratio > 1 + tolerance else ''
+        print(f"{key[0]:>30} {key[1]:<22} {baseline_p50s[key]:9.2f}ms -> {p50:9.2f}ms ({ratio:.2f}x){flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time decode, STFT, peak picking, hashing, DB insert and matching on synthetic audio.")
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--clip-lengths', type=float, nargs='+', default=[5.0, 10.0, 20.0])
+    parser.add_argument('--probe-songs', type=int, default=20, help="songs rendered as audio and used for queries")
+    parser.add_argument('--song-duration', type=float, default=30.0)
+    parser.add_argument('--queries', type=int, default=20, help="query clips per catalog size and clip length")
+    parser.add_argument('--peak-min-dist', type=int, default=25)
+    parser.add_argument('--peak-min-amp', type=int, default=-40)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--progressive', action='store_true', help="match with the rarest-first, early stopping matcher")
+    parser.add_argument('--margin', type=float, default=None, help="leader/runner-up ratio that ends a progressive match early")
+    parser.add_argument('--out', type=Path, default=Path('benchmark.json'))
+    parser.add_argument('--baseline', type=Path, default=None, help="earlier benchmark JSON to compare the p50 latencies with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="relative slowdown that is flagged as a regression")
+    parser.add_argument('--startup-budget', type=float, default=1.0, help="seconds a cold import of a startup module may take")
+    args = parser.parse_args()
+
+    results = {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "commit": git_commit(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "params": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "startup": measure_startup(budget_seconds=args.startup_budget),
+        **run_benchmark(args),
+        "peak_rss_kib": peak_rss_kib(),
+    }
+    if results["startup"]["over_budget"]:
+        print(f"Over the startup budget of {args.startup_budget}s: {', '.join(results['startup']['over_budget'])}", file=sys.stderr)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_to_baseline(results, json.load(f), args.tolerance)
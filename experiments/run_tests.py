@@ -1,12 +1,14 @@
 import csv
 import os
+import shutil
 from pathlib import Path
 
 import yaml
 
-from scripts.add_songs_to_db import add_songs_from_folder_to_db
-from setup import setup_db
-from tests_db import execute_test
+from feature_cache import FeatureCache
+from scripts.add_songs_to_db import add_songs_to_db
+from setup import setup_db, setup_sharded_db
+from tests_db import execute_multi_clip_test, execute_test
 
 benchmark = 'test_data'
 
@@ -14,14 +16,20 @@ with open('experiments/_config.yaml', 'r') as file:
     config = yaml.safe_load(file)
 
 experiments = config['experiments']
-fieldnames = ['test_name', 'db_hashes', 'matching_time', 'matching_time_single', 'wrong_matches', 'correct_matches', 'no_matches', 'threshold_too_high', 'failed_to_test']
+cache_config = config.get('feature_cache')
+feature_cache = FeatureCache(cache_config['dir'], cache_config['max_size_mb'] * 1024 ** 2) if cache_config else None
+fieldnames = ['test_name', 'db_hashes', 'matching_time', 'matching_time_single', 'wrong_matches', 'correct_matches', 'no_matches', 'threshold_too_high', 'failed_to_test', 'clips']
 
 with open('results.csv', mode='w', newline='') as csv_file:
     writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
     writer.writeheader()
     for exp in experiments:
-        db_file = exp['name'] + '.db'
-        setup_db(db_file)
+        if exp.get('shards'):
+            db_file = exp['name'] + '.shards'
+            setup_sharded_db(db_file, exp['shards'])
+        else:
+            db_file = exp['name'] + '.db'
+            setup_db(db_file)
         
         data_dirs = [
             "commonblackbirdtypesongqClen80len300",
@@ -33,12 +41,21 @@ with open('results.csv', mode='w', newline='') as csv_file:
             "songthrushtypesongqClen90len300"
         ]
 
+        song_paths = []
         for data_dir in data_dirs:
-            db_hash_count = add_songs_from_folder_to_db(Path(__file__).parent.parent / db_file, Path(__file__).parent.parent / f'test_data/{data_dir}/a', exp)
-        results = execute_test(db_file, benchmark, exp)
+            song_folder = Path(__file__).parent.parent / f'test_data/{data_dir}/a'
+            song_paths += sorted(f for f in song_folder.iterdir() if f.is_file())
+        db_hash_count = add_songs_to_db(Path(__file__).parent.parent / db_file, song_paths, exp, workers=os.cpu_count(), feature_cache=feature_cache)
+        if exp.get('clips_per_file', 1) > 1:
+            results = execute_multi_clip_test(db_file, benchmark, exp, feature_cache)
+        else:
+            results = execute_test(db_file, benchmark, exp, feature_cache)
         results['test_name'] = exp['name']
         results['db_hashes'] = db_hash_count
 
         writer.writerow(results)
 
-        os.remove(db_file)
+        if exp.get('shards'):
+            shutil.rmtree(db_file)
+        else:
+            os.remove(db_file)
@@ -12,8 +12,7 @@ def generate_random_list(seed: int, length: int):
     return [random.random() for _ in range(length)]
 
 def get_audio_duration(path: str):
-    y, sr = lr.load(path, sr=None)
-    return len(y) / sr
+    return lr.get_duration(path=path) # read from the header where the format allows it, instead of decoding
 
 def write_line_to_file(file_path, elements):
     row = ', '.join(str(e) for e in elements)
@@ -22,7 +21,26 @@ def write_line_to_file(file_path, elements):
         writer.writerow(elements)
 
 
-def execute_test(db_file, test_folder, exp):
+def index_front_end(index, exp) -> FrontEnd:
+    """The index's front end, which clips are fingerprinted with. The experiment may not configure another one."""
+    front_end = FrontEnd.from_config(exp["fingerprinting"])
+    if front_end != index.front_end:
+        raise ValueError(f"{exp['name']} configures front end {front_end}, but its index was built with {index.front_end}")
+    return index.front_end
+
+
+def clip_peaks(path: str, start_time: float, clip_length: float, peak_min_distance: int, peak_min_amplitude_threshold: int,
+               feature_cache=None, max_peaks_per_frame: int = None, front_end: FrontEnd = DEFAULT_FRONT_END):
+    if feature_cache is not None:
+        peaks, _ = feature_cache.load_peaks(path, peak_min_distance, peak_min_amplitude_threshold, start_time, clip_length,
+                                            max_peaks_per_frame, front_end)
+        return peaks
+    spectrogram, sampling_rate = generate_spectrogram(path, start_time, clip_length, front_end)
+    frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+    return peak_indices_to_peaks(frames, bins, front_end)
+
+
+def execute_test(db_file, test_folder, exp, feature_cache=None):
     pathlist = list(Path(test_folder).glob('**/*.mp3')) + list(Path(test_folder).glob('**/*.wav'))
     print(len(pathlist))
     # return
@@ -35,6 +53,8 @@ def execute_test(db_file, test_folder, exp):
     overall_runtime = 0
     failed_test_count = 0
 
+    index = open_index(db_file) # opened once instead of per clip
+    front_end = index_front_end(index, exp)
     start_long = time.perf_counter()
     for idx, path in enumerate(pathlist):
         try:
@@ -42,26 +62,26 @@ def execute_test(db_file, test_folder, exp):
             start = time.perf_counter()
             peak_min_distance = exp["fingerprinting"]["peak_min_dist"]
             peak_min_amplitude_threshold = exp["fingerprinting"]["peak_min_amp"]
+            max_peaks_per_frame = exp["fingerprinting"].get("max_peaks_per_frame")
 
             path_in_str = str(path)
             print(path_in_str)
             
             clip_length = exp["clip_len"]
             relative_start = relative_starts[idx%len(relative_starts)]
-            start_time = relative_start * (get_audio_duration(path_in_str)-clip_length)
+            audio_duration = get_audio_duration(path_in_str)
+            start_time = relative_start * (audio_duration-clip_length)
             
-            spectrogram, sampling_rate = generate_spectrogram(path_in_str, start_time, clip_length)
-            peaks = find_peaks(spectrogram, sampling_rate,peak_min_distance, peak_min_amplitude_threshold)        
+            peaks = clip_peaks(path_in_str, start_time, clip_length, peak_min_distance, peak_min_amplitude_threshold, feature_cache, max_peaks_per_frame, front_end)
             
-            while len(peaks) < 10 and start_time < (get_audio_duration(path_in_str)-clip_length):
+            while len(peaks) < 10 and start_time < (audio_duration-clip_length):
                 start_time += 0.5
                 print("incremented start_time by 0.5")
-                spectrogram, sampling_rate = generate_spectrogram(path_in_str, start_time, clip_length)
-                peaks = find_peaks(spectrogram, sampling_rate,peak_min_distance, peak_min_amplitude_threshold)
+                peaks = clip_peaks(path_in_str, start_time, clip_length, peak_min_distance, peak_min_amplitude_threshold, feature_cache, max_peaks_per_frame, front_end)
 
 
             test_hashes = generate_fingerprints(peaks, 'test')
-            match_name, score, confidence = match_sample_db(test_hashes, db_file, exp["clip_len"])
+            match_name, score, confidence = match_sample_db(test_hashes, index, exp["clip_len"])
         except Exception as e:
             failed_test_count += 1
             continue
@@ -77,7 +97,7 @@ def execute_test(db_file, test_folder, exp):
         else:
             no_match_count += 1
             print("\033[93mNo Match!\033[0m\n")
-            if match_name in str(path):
+            if match_name is not None and match_name in str(path):
                 threshold_too_high += 1
 
         end = time.perf_counter()
@@ -109,5 +129,135 @@ def execute_test(db_file, test_folder, exp):
     return results
 
 
+SLICE_PEAK_AGREEMENT = 0.9 # share of peaks a sliced clip must have in common with the clip computed on its own
+
+
+def clip_frame_range(start_time: float, clip_length: float, front_end: FrontEnd) -> Tuple[int, int]:
+    """(first STFT frame, frame count) of a clip, starting on the frame grid so its frames line up with the file's."""
+    first_frame = int(round(start_time * front_end.sampling_rate / front_end.hop_length))
+    # librosa's centered STFT of the clip alone would have one frame more than its number of full hops
+    return first_frame, 1 + int(clip_length * front_end.sampling_rate) // front_end.hop_length
+
+
+def sliced_clip_peaks(magnitudes: np.ndarray, first_frame: int, frame_count: int, peak_min_distance: int,
+                      peak_min_amplitude_threshold: int, max_peaks_per_frame: int = None,
+                      front_end: FrontEnd = DEFAULT_FRONT_END) -> np.ndarray:
+    """Peaks of a clip cut as columns from the STFT magnitudes of the whole recording."""
+    spectrogram = magnitudes_to_db(magnitudes[:, first_frame:first_frame + frame_count])
+    frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+    return peak_indices_to_peaks(frames, bins, front_end)
+
+
+def slice_peak_agreement(audio_signal: np.ndarray, magnitudes: np.ndarray, first_frame: int, frame_count: int,
+                         peak_min_distance: int, peak_min_amplitude_threshold: int, max_peaks_per_frame: int = None,
+                         front_end: FrontEnd = DEFAULT_FRONT_END) -> float:
+    """
+    F1 score of the peaks of a sliced clip against the peaks of the same clip computed on its own. They only
+    differ near the clip's edges, where the clip's STFT is zero padded while the slice sees the neighbouring audio.
+    """
+    first_sample = first_frame * front_end.hop_length
+    clip = audio_signal[first_sample:first_sample + (frame_count - 1) * front_end.hop_length]
+    frames, bins = find_peak_indices(compute_spectrogram(clip, front_end), peak_min_distance, peak_min_amplitude_threshold,
+                                     max_peaks_per_frame)
+    clip_peaks = set(zip(frames.tolist(), bins.tolist()))
+    spectrogram = magnitudes_to_db(magnitudes[:, first_frame:first_frame + frame_count])
+    frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+    sliced_peaks = set(zip(frames.tolist(), bins.tolist()))
+    if not clip_peaks and not sliced_peaks:
+        return 1.0
+    return 2 * len(clip_peaks & sliced_peaks) / (len(clip_peaks) + len(sliced_peaks))
+
+
+def execute_multi_clip_test(db_file, test_folder, exp, feature_cache=None):
+    """
+    execute_test with exp["clips_per_file"] clips per recording. Every recording is decoded and transformed once
+    and its clips are cut as STFT column slices. The first clip of a recording is compared with the clip-based
+    path, and if fewer than SLICE_PEAK_AGREEMENT of their peaks agree, the recording's clips are transformed
+    one by one from the decoded signal instead. Per recording counts are written to <name>_recordings.csv.
+    """
+    pathlist = list(Path(test_folder).glob('**/*.mp3')) + list(Path(test_folder).glob('**/*.wav'))
+    clips_per_file = exp["clips_per_file"]
+    relative_starts = generate_random_list(seed=exp["seed"], length=len(pathlist) * clips_per_file)
+    clip_length = exp["clip_len"]
+    peak_min_distance = exp["fingerprinting"]["peak_min_dist"]
+    peak_min_amplitude_threshold = exp["fingerprinting"]["peak_min_amp"]
+    max_peaks_per_frame = exp["fingerprinting"].get("max_peaks_per_frame")
+    index = open_index(db_file)
+    front_end = index_front_end(index, exp)
+    retry_frames = int(round(0.5 * front_end.sampling_rate / front_end.hop_length))
+
+    totals = {"clips": 0, "wrong_matches": 0, "correct_matches": 0, "no_matches": 0, "threshold_too_high": 0, "failed_to_test": 0}
+    overall_runtime = 0
+    recordings_file = f'{exp["name"]}_recordings.csv'
+    if not Path(recordings_file).exists(): # later runs append their rows below the same header
+        write_line_to_file(recordings_file, ['path', 'clips', 'correct_matches', 'wrong_matches', 'no_matches', 'threshold_too_high', 'sliced'])
+
+    for idx, path in enumerate(pathlist):
+        start = time.perf_counter()
+        counts = {"clips": 0, "wrong_matches": 0, "correct_matches": 0, "no_matches": 0, "threshold_too_high": 0}
+        try:
+            audio_signal, sampling_rate = load_audio(str(path), sampling_rate=front_end.sampling_rate)
+            magnitudes = stft_magnitudes(audio_signal, front_end)
+        except Exception:
+            totals["failed_to_test"] += clips_per_file
+            continue
+        last_first_frame = max(magnitudes.shape[1] - clip_frame_range(0, clip_length, front_end)[1], 0)
+        sliced = None
+
+        for clip in range(clips_per_file):
+            try:
+                start_time = relative_starts[idx * clips_per_file + clip] * max(len(audio_signal) / sampling_rate - clip_length, 0)
+                first_frame, frame_count = clip_frame_range(start_time, clip_length, front_end)
+                if sliced is None:
+                    agreement = slice_peak_agreement(audio_signal, magnitudes, first_frame, frame_count, peak_min_distance,
+                                                     peak_min_amplitude_threshold, max_peaks_per_frame, front_end)
+                    sliced = agreement >= SLICE_PEAK_AGREEMENT
+                    if not sliced:
+                        print(f"Only {agreement:.2f} of the sliced peaks of {path} agree with the clip's, transforming its clips one by one")
+
+                while True:
+                    if sliced:
+                        peaks = sliced_clip_peaks(magnitudes, first_frame, frame_count, peak_min_distance, peak_min_amplitude_threshold,
+                                                  max_peaks_per_frame, front_end)
+                    else:
+                        first_sample = first_frame * front_end.hop_length
+                        spectrogram = compute_spectrogram(audio_signal[first_sample:first_sample + (frame_count - 1) * front_end.hop_length], front_end)
+                        frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+                        peaks = peak_indices_to_peaks(frames, bins, front_end)
+                    if len(peaks) >= 10 or first_frame + retry_frames > last_first_frame:
+                        break
+                    first_frame += retry_frames
+
+                match_name, score, confidence = match_sample_db(generate_fingerprints(peaks, 'test'), index, clip_length)
+                counts["clips"] += 1
+                if score > 250:
+                    counts["correct_matches" if match_name in str(path) else "wrong_matches"] += 1
+                else:
+                    counts["no_matches"] += 1
+                    if match_name is not None and match_name in str(path):
+                        counts["threshold_too_high"] += 1
+            except Exception as clip_err:
+                # one failing clip is recorded like an undecodable recording instead of ending the whole run
+                print(f"Could not test clip {clip} of {path}: {type(clip_err).__name__}: {clip_err}")
+                totals["failed_to_test"] += 1
+
+        overall_runtime += time.perf_counter() - start
+        for key, value in counts.items():
+            totals[key] += value
+        write_line_to_file(recordings_file, [str(path), counts["clips"], counts["correct_matches"], counts["wrong_matches"],
+                                             counts["no_matches"], counts["threshold_too_high"], sliced])
+
+    print("Overall: ", overall_runtime)
+    print(f"\n\n{totals['clips']} clips of {len(pathlist)} recordings")
+    print("No Matches:", totals["no_matches"])
+    print("Wrong matches:", totals["wrong_matches"])
+    print("Successful Matches:", totals["correct_matches"])
+
+    return {
+        "matching_time": overall_runtime,
+        "matching_time_single": overall_runtime / totals["clips"] if totals["clips"] else '-',
+        **totals,
+    }
+
 if __name__ == '__main__':
     results = execute_test('test_database.db', 'eurasian_blackcap')
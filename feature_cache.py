@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from fingerprinting import SAMPLING_RATE, HOP_LENGTH, N_FFT, DEFAULT_FRONT_END, FrontEnd, load_audio, compute_spectrogram, find_peak_indices, \
+    peak_indices_to_peaks
+
+CACHE_FORMAT_VERSION = 1
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def front_end_key(front_end: FrontEnd) -> dict:
+    # the default front end adds nothing to the key, so entries from before front ends stay valid
+    return {} if front_end == DEFAULT_FRONT_END else {'front_end': front_end._asdict()}
+
+
+class FeatureCache:
+    """
+    On-disk cache of dB spectrograms keyed by (file digest, sampling rate, STFT front end, clip window) and of
+    peaks keyed additionally by the peak picking parameters. Entries are evicted least recently used first
+    once the cache grows beyond max_size_bytes.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self._size_bytes = None
+        self._digests = {}
+
+    def __reduce__(self):
+        # pool workers unpickle to one shared instance per process instead of a fresh copy per task
+        return get_feature_cache, (str(self.cache_dir), self.max_size_bytes)
+
+    def _digest(self, path) -> str:
+        stat = os.stat(path)
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+        if key not in self._digests:
+            self._digests[key] = file_digest(path)
+        return self._digests[key]
+
+    def _entry_path(self, kind: str, **params) -> Path:
+        key = json.dumps({'format': CACHE_FORMAT_VERSION, 'kind': kind, **params}, sort_keys=True)
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.{kind}.npz"
+
+    def _read(self, entry_path: Path):
+        try:
+            with np.load(entry_path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError, EOFError, zipfile.BadZipFile) as read_err:
+            # a truncated or corrupt entry is a miss; removing it lets the recomputed features replace it
+            print(f"Discarding unreadable cache entry {entry_path.name}: {read_err}")
+            entry_path.unlink(missing_ok=True)
+            self._size_bytes = None
+            return None
+        os.utime(entry_path) # mark as recently used
+        return arrays
+
+    def _write(self, entry_path: Path, **arrays) -> None:
+        tmp_path = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, entry_path) # atomic, so concurrent workers never read half-written entries
+
+        if self._size_bytes is None:
+            self._size_bytes = sum(f.stat().st_size for f in self.cache_dir.glob('*.npz'))
+        else:
+            self._size_bytes += entry_path.stat().st_size
+        if self._size_bytes > self.max_size_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry_path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries.sort()
+
+        self._size_bytes = sum(size for _, size, _ in entries)
+        target_size = 0.9 * self.max_size_bytes
+        for _, size, entry_path in entries:
+            if self._size_bytes <= target_size:
+                break
+            entry_path.unlink(missing_ok=True)
+            self._size_bytes -= size
+
+    def load_spectrogram(self, path, start_time: float = 0.0, clip_duration: float = None,
+                         front_end: FrontEnd = DEFAULT_FRONT_END) -> Tuple[np.ndarray, int, float]:
+        """Returns (spectrogram, sampling_rate, audio_duration) of the clip, decoding the file only on a miss."""
+        entry_path = self._entry_path('spectrogram', digest=self._digest(path), sampling_rate=SAMPLING_RATE,
+                                      n_fft=N_FFT, hop_length=HOP_LENGTH, start_time=start_time, clip_duration=clip_duration,
+                                      **front_end_key(front_end))
+        entry = self._read(entry_path)
+        if entry is not None:
+            return entry['spectrogram'], front_end.sampling_rate, float(entry['audio_duration'])
+
+        audio_signal, sampling_rate = load_audio(str(path), start_time, clip_duration, front_end.sampling_rate)
+        spectrogram = compute_spectrogram(audio_signal, front_end)
+        audio_duration = len(audio_signal) / sampling_rate
+        self._write(entry_path, spectrogram=spectrogram, audio_duration=audio_duration)
+        return spectrogram, sampling_rate, audio_duration
+
+    def load_peaks(self, path, peak_min_distance: int, peak_min_amplitude_threshold: int, start_time: float = 0.0,
+                   clip_duration: float = None, max_peaks_per_frame: int = None,
+                   front_end: FrontEnd = DEFAULT_FRONT_END) -> Tuple[np.ndarray, float]:
+        """Returns (peaks, audio_duration) of the clip with peaks as (time, freq) rows, computing the spectrogram only on a miss."""
+        # uncapped peaks keep their old key, so existing entries stay valid
+        cap = {} if max_peaks_per_frame is None else {'max_peaks_per_frame': max_peaks_per_frame}
+        entry_path = self._entry_path('peaks', digest=self._digest(path), sampling_rate=SAMPLING_RATE,
+                                      n_fft=N_FFT, hop_length=HOP_LENGTH, start_time=start_time, clip_duration=clip_duration,
+                                      peak_min_distance=peak_min_distance, peak_min_amplitude_threshold=peak_min_amplitude_threshold, **cap,
+                                      **front_end_key(front_end))
+        entry = self._read(entry_path)
+        if entry is not None:
+            return entry['peaks'], float(entry['audio_duration'])
+
+        spectrogram, sampling_rate, audio_duration = self.load_spectrogram(path, start_time, clip_duration, front_end)
+        frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+        peaks = peak_indices_to_peaks(frames, bins, front_end)
+        self._write(entry_path, peaks=peaks, audio_duration=audio_duration)
+        return peaks, audio_duration
+
+
+@lru_cache(maxsize=None)
+def get_feature_cache(cache_dir: str, max_size_bytes: int = 2 * 1024 ** 3) -> FeatureCache:
+    """One FeatureCache per process and directory, so workers keep their digest memo and size estimate."""
+    return FeatureCache(cache_dir, max_size_bytes)
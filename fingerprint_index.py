@@ -0,0 +1,685 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+import metrics
+from setup import SHARDS_FILE, get_schema_version, get_setting, is_clustered, is_sharded, read_shard_paths, shard_of, write_shards_file
+
+SAMPLING_RATE = 22050
+HOP_LENGTH = 512
+N_FFT = 2048
+
+
+class FrontEnd(NamedTuple):
+    """
+    STFT front end shared by all songs of a database and the samples matched against it. Decimating divides the
+    sampling rate and hop length by the same factor, so frames keep their HOP_LENGTH / SAMPLING_RATE duration and
+    stored offsets stay comparable. Only the bins between min_freq and max_freq are kept.
+    """
+    decimation: int = 1
+    n_fft: int = None # defaults to N_FFT // decimation, which keeps the bin spacing
+    min_freq: float = 0.0
+    max_freq: float = None
+
+    @classmethod
+    def from_config(cls, fingerprinting: dict) -> 'FrontEnd':
+        """Reads the optional decimation, n_fft, min_freq and max_freq keys of an experiment's fingerprinting section."""
+        front_end = cls(**{field: fingerprinting[field] for field in cls._fields if fingerprinting.get(field) is not None})
+        if SAMPLING_RATE % front_end.decimation or HOP_LENGTH % front_end.decimation:
+            raise ValueError(f"decimation must divide both {SAMPLING_RATE} and {HOP_LENGTH}, got {front_end.decimation}")
+        return front_end
+
+    @classmethod
+    def from_json(cls, value: str) -> 'FrontEnd':
+        return cls(**json.loads(value)) if value else cls()
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict(), sort_keys=True)
+
+    @property
+    def sampling_rate(self) -> int:
+        return SAMPLING_RATE // self.decimation
+
+    @property
+    def hop_length(self) -> int:
+        return HOP_LENGTH // self.decimation
+
+    @property
+    def fft_size(self) -> int:
+        return self.n_fft if self.n_fft is not None else N_FFT // self.decimation
+
+    def bin_range(self) -> Tuple[int, int]:
+        """(first, last + 1) STFT bin inside [min_freq, max_freq]."""
+        bin_count = self.fft_size // 2 + 1
+        bin_hz = self.sampling_rate / self.fft_size
+        first_bin = min(int(np.ceil(self.min_freq / bin_hz)), bin_count)
+        last_bin = bin_count if self.max_freq is None else min(int(self.max_freq // bin_hz) + 1, bin_count)
+        return first_bin, max(last_bin, first_bin)
+
+
+DEFAULT_FRONT_END = FrontEnd()
+
+
+def read_front_end(conn) -> FrontEnd:
+    """Front end recorded in a database's settings table; databases without one used the default."""
+    return FrontEnd.from_json(get_setting(conn, 'front_end'))
+
+
+def time_to_frame(offset: float) -> int:
+    return int(round(offset * SAMPLING_RATE / HOP_LENGTH))
+
+
+def times_to_frames(offsets: np.ndarray) -> np.ndarray:
+    return np.rint(offsets * SAMPLING_RATE / HOP_LENGTH).astype(np.int64)
+
+
+def frames_to_time(frames: np.ndarray) -> np.ndarray:
+    return (frames * HOP_LENGTH) / SAMPLING_RATE
+
+
+def load_sample_hashes(cursor, sample_hashes: list) -> int:
+    """Fills the temp table sample_hashes (idx, hash_value) that lookups join against. Returns the schema version."""
+    schema_version = get_schema_version(cursor.connection)
+    hash_type, to_db_hash = ('INTEGER', int) if schema_version >= 2 else ('TEXT', str)
+    cursor.execute("DROP TABLE IF EXISTS temp.sample_hashes")
+    cursor.execute(f"CREATE TEMP TABLE sample_hashes (idx INTEGER PRIMARY KEY, hash_value {hash_type} NOT NULL)")
+    cursor.executemany("INSERT INTO sample_hashes (idx, hash_value) VALUES (?, ?)", ((idx, to_db_hash(hash_val)) for idx, hash_val in enumerate(sample_hashes)))
+    return schema_version
+
+
+def lookup_sample_hashes(cursor, sample_hashes: list, song_id: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Resolves all sample hashes in a single joined query. Returns parallel (sample_index, song_id, offset) arrays,
+    ordered by sample hash and then by database row, the same order a per-hash SELECT would produce.
+    Offsets are returned in seconds for every schema version. With song_id, only that song's rows are returned.
+    """
+    schema_version = load_sample_hashes(cursor, sample_hashes)
+    row_order = 'f.song_id, f.offset' if is_clustered(cursor.connection) else 'f.rowid'
+    song_filter = 'WHERE f.song_id = ?' if song_id is not None else ''
+    cursor.execute(f'''
+        SELECT s.idx, f.song_id, f.offset
+        FROM sample_hashes s JOIN fingerprints f ON f.hash_value = s.hash_value
+        {song_filter}
+        ORDER BY s.idx, {row_order}
+    ''', (song_id,) if song_id is not None else ())
+    rows = cursor.fetchall()
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    sample_idx, song_ids, offsets = zip(*rows)
+    if schema_version >= 2:
+        offsets = frames_to_time(np.array(offsets, dtype=np.int64))
+    else:
+        offsets = np.array(offsets, dtype=np.float64)
+    return np.array(sample_idx, dtype=np.int64), np.array(song_ids, dtype=np.int64), offsets
+
+
+def count_sample_postings(cursor, sample_hashes: list) -> np.ndarray:
+    """Number of fingerprint rows per sample hash, counted on the hash index without reading the rows."""
+    load_sample_hashes(cursor, sample_hashes)
+    cursor.execute('''
+        SELECT s.idx, COUNT(f.hash_value)
+        FROM sample_hashes s LEFT JOIN fingerprints f ON f.hash_value = s.hash_value
+        GROUP BY s.idx ORDER BY s.idx
+    ''')
+    return np.array([posting_count for _, posting_count in cursor.fetchall()], dtype=np.int64).reshape(-1)
+
+
+def get_hash_count(db_path: str, song_id: int) -> int:
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    # songs.hash_count is kept up to date at ingest time, counting the fingerprints is the fallback for old databases
+    hash_count_known = 'hash_count' in {row[1] for row in cursor.execute("PRAGMA table_info(songs)").fetchall()}
+    if hash_count_known:
+        cursor.execute("SELECT hash_count FROM songs WHERE song_id = ?", (song_id,))
+    else:
+        cursor.execute("SELECT COUNT(*) FROM fingerprints WHERE song_id = ?", (song_id,))
+    count = cursor.fetchone()[0]
+    conn.close()
+
+    return count
+
+def get_song_duration(db_path: str, song_id: int) -> float:
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT song_duration FROM songs WHERE song_id = ?", (song_id,))
+    duration = cursor.fetchone()[0]
+    conn.close()
+
+    return duration
+
+
+class ConnectionPool:
+    """Long-lived read-only connections to a fingerprint database, handed out to one thread at a time."""
+
+    def __init__(self, db_path: str, size: int = 4, cache_size_kib: int = 64 * 1024, mmap_size: int = 256 * 1024 ** 2):
+        self.db_path = str(db_path)
+        self.size = size
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def open_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"{Path(self.db_path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA cache_size = -{self.cache_size_kib}")
+        conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            create = self._idle.empty() and self._opened < self.size
+            if create:
+                self._opened += 1
+        conn = self.open_connection() if create else self._idle.get()
+        try:
+            yield conn
+        finally:
+            conn.rollback() # ends the read transaction, so writers aren't blocked by an idle connection
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """Closes the idle connections; connections still in use are closed when they are garbage collected."""
+        while not self._idle.empty():
+            self._idle.get().close()
+
+
+class SQLiteIndex:
+    """
+    Resolves hashes against the fingerprints table of a SQLite database through a ConnectionPool. Song names,
+    durations, hash counts and the front end are held in memory and reloaded whenever the database was changed.
+    """
+
+    def __init__(self, db_path: str, pool_size: int = 4):
+        self.db_path = str(db_path)
+        stat = os.stat(self.db_path)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.pool = ConnectionPool(self.db_path, pool_size)
+        self.songs = {}
+        self.front_end = DEFAULT_FRONT_END
+        self._meta_conn = self.pool.open_connection()
+        self._data_version = None
+        self._songs_lock = threading.Lock()
+        self.refresh_songs()
+
+    def refresh_songs(self) -> None:
+        """Reloads the song metadata if another connection committed since it was last loaded."""
+        with self._songs_lock:
+            data_version = self._meta_conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            columns = {row[1] for row in self._meta_conn.execute("PRAGMA table_info(songs)").fetchall()}
+            hash_count_column = 'hash_count' if 'hash_count' in columns else 'NULL'
+            songs = {song_id: {'song_name': song_name, 'song_duration': song_duration, 'hash_count': hash_count}
+                     for song_id, song_name, song_duration, hash_count
+                     in self._meta_conn.execute(f"SELECT song_id, song_name, song_duration, {hash_count_column} FROM songs")}
+            self.front_end = read_front_end(self._meta_conn)
+            self._meta_conn.rollback()
+            self.songs, self._data_version = songs, data_version
+
+    def song_names(self) -> dict:
+        return {song_id: song['song_name'] for song_id, song in self.songs.items()}
+
+    def lookup(self, sample_hashes: list, song_id: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        self.refresh_songs()
+        with self.pool.connection() as conn:
+            return lookup_sample_hashes(conn.cursor(), sample_hashes, song_id)
+
+    def posting_lengths(self, sample_hashes: list) -> np.ndarray:
+        with self.pool.connection() as conn:
+            return count_sample_postings(conn.cursor(), sample_hashes)
+
+    def hash_count(self, song_id: int) -> int:
+        song = self.songs[song_id]
+        if song['hash_count'] is None:
+            # database from before songs.hash_count, the rows are counted once until the songs are reloaded
+            with self.pool.connection() as conn:
+                song['hash_count'] = conn.execute("SELECT COUNT(*) FROM fingerprints WHERE song_id = ?", (song_id,)).fetchone()[0]
+        return song['hash_count']
+
+    def song_duration(self, song_id: int) -> float:
+        return self.songs[song_id]['song_duration']
+
+    def close(self) -> None:
+        self._meta_conn.close()
+        self.pool.close()
+
+
+class MmapIndex:
+    """
+    Inverted index held in .npy files: a sorted array of unique hashes plus CSR-style posting arrays of
+    (song_id, offset_frame). Loaded with mmap_mode='r', so workers share the page cache instead of copying.
+    """
+
+    def __init__(self, hashes: np.ndarray, posting_starts: np.ndarray, posting_song_ids: np.ndarray,
+                 posting_offsets: np.ndarray, songs: dict, front_end: FrontEnd = DEFAULT_FRONT_END):
+        self.hashes = hashes
+        self.posting_starts = posting_starts
+        self.posting_song_ids = posting_song_ids
+        self.posting_offsets = posting_offsets
+        self.songs = songs
+        self.front_end = front_end
+
+    @classmethod
+    def load(cls, index_dir) -> 'MmapIndex':
+        index_dir = Path(index_dir)
+        with open(index_dir / 'songs.json', 'r', encoding='utf-8') as f:
+            songs = {int(song_id): song for song_id, song in json.load(f).items()}
+        front_end_path = index_dir / 'front_end.json'
+        front_end = FrontEnd.from_json(front_end_path.read_text(encoding='utf-8')) if front_end_path.exists() else DEFAULT_FRONT_END
+        return cls(np.load(index_dir / 'hashes.npy', mmap_mode='r'),
+                   np.load(index_dir / 'posting_starts.npy', mmap_mode='r'),
+                   np.load(index_dir / 'posting_song_ids.npy', mmap_mode='r'),
+                   np.load(index_dir / 'posting_offsets.npy', mmap_mode='r'),
+                   songs, front_end)
+
+    def save(self, index_dir) -> None:
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / 'hashes.npy', self.hashes)
+        np.save(index_dir / 'posting_starts.npy', self.posting_starts)
+        np.save(index_dir / 'posting_song_ids.npy', self.posting_song_ids)
+        np.save(index_dir / 'posting_offsets.npy', self.posting_offsets)
+        with open(index_dir / 'songs.json', 'w', encoding='utf-8') as f:
+            json.dump(self.songs, f)
+        (index_dir / 'front_end.json').write_text(self.front_end.to_json(), encoding='utf-8')
+
+    def song_names(self) -> dict:
+        return {song_id: song['song_name'] for song_id, song in self.songs.items()}
+
+    def _postings(self, sample_hashes: list) -> Tuple[np.ndarray, np.ndarray]:
+        """(first posting, posting count) of every sample hash, with a count of 0 for unknown hashes."""
+        queries = np.array(sample_hashes, dtype=np.int64)
+        if len(self.hashes) == 0 or len(queries) == 0:
+            return np.zeros(len(queries), dtype=np.int64), np.zeros(len(queries), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.hashes, queries), len(self.hashes) - 1)
+        found = self.hashes[positions] == queries
+        starts = self.posting_starts[positions]
+        return starts, np.where(found, self.posting_starts[positions + 1] - starts, 0)
+
+    def lookup(self, sample_hashes: list, song_id: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        starts, lengths = self._postings(sample_hashes)
+        sample_idx = np.repeat(np.arange(len(lengths)), lengths)
+        postings = np.arange(len(sample_idx)) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        song_ids = self.posting_song_ids[postings].astype(np.int64)
+        if song_id is not None:
+            in_song = song_ids == song_id
+            sample_idx, postings, song_ids = sample_idx[in_song], postings[in_song], song_ids[in_song]
+        return sample_idx, song_ids, frames_to_time(self.posting_offsets[postings].astype(np.int64))
+
+    def posting_lengths(self, sample_hashes: list) -> np.ndarray:
+        return self._postings(sample_hashes)[1]
+
+    def hash_count(self, song_id: int) -> int:
+        return self.songs[song_id]['hash_count']
+
+    def song_duration(self, song_id: int) -> float:
+        return self.songs[song_id]['song_duration']
+
+
+def zigzag_encode(values: np.ndarray) -> np.ndarray:
+    """Maps signed deltas to unsigned values, small magnitudes to small values: 0, -1, 1, -2 -> 0, 1, 2, 3."""
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    """Bytes of the LEB128 varint of every value: 7 payload bits per byte."""
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    return lengths
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """LEB128 encodes unsigned values into one uint8 array, low 7 bits first, high bit set on all but the last byte."""
+    values = values.astype(np.uint64)
+    lengths = varint_lengths(values)
+    value_starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(int(lengths.max()) if len(values) else 0):
+        has_byte = lengths > byte
+        payload = (values[has_byte] >> np.uint64(7 * byte)) & np.uint64(0x7F)
+        continued = np.where(lengths[has_byte] > byte + 1, 0x80, 0).astype(np.uint64)
+        encoded[value_starts[has_byte] + byte] = (payload | continued).astype(np.uint8)
+    return encoded
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    """Inverse of encode_varints for a byte array that holds whole varints."""
+    if len(encoded) == 0:
+        return np.empty(0, dtype=np.uint64)
+    last_bytes = encoded < 0x80
+    value_starts = np.flatnonzero(np.concatenate(([True], last_bytes[:-1])))
+    byte_in_value = np.arange(len(encoded)) - np.repeat(value_starts, np.diff(np.append(value_starts, len(encoded))))
+    payloads = (encoded & 0x7F).astype(np.uint64) << (np.uint64(7) * byte_in_value.astype(np.uint64))
+    return np.add.reduceat(payloads, value_starts)
+
+
+class CompressedIndex:
+    """
+    Read-only inverted index like MmapIndex whose postings are stored as one varint byte stream. For every posting
+    the zigzag encoded deltas of song_id and offset_frame to the hash's previous posting are written, so postings
+    of common hashes, which are sorted by song, take two to four bytes instead of eight. byte_starts gives every
+    hash's slice of the stream. Postings keep database row order, so lookups return what the database returns.
+    """
+
+    def __init__(self, hashes: np.ndarray, posting_starts: np.ndarray, byte_starts: np.ndarray, postings: np.ndarray,
+                 songs: dict, front_end: FrontEnd = DEFAULT_FRONT_END):
+        self.hashes = hashes
+        self.posting_starts = posting_starts
+        self.byte_starts = byte_starts
+        self.postings = postings
+        self.songs = songs
+        self.front_end = front_end
+
+    @classmethod
+    def from_postings(cls, hashes: np.ndarray, posting_starts: np.ndarray, posting_song_ids: np.ndarray,
+                      posting_offsets: np.ndarray, songs: dict, front_end: FrontEnd = DEFAULT_FRONT_END) -> 'CompressedIndex':
+        """Encodes the CSR postings of read_postings."""
+        lengths = np.diff(posting_starts)
+        first_of_hash = np.zeros(len(posting_song_ids), dtype=bool)
+        first_of_hash[posting_starts[:-1][lengths > 0]] = True
+
+        def deltas(values: np.ndarray) -> np.ndarray:
+            values = values.astype(np.int64)
+            previous = np.concatenate(([0], values[:-1]))
+            return np.where(first_of_hash, values, values - previous)
+
+        values = np.empty(2 * len(posting_song_ids), dtype=np.uint64)
+        values[0::2] = zigzag_encode(deltas(posting_song_ids))
+        values[1::2] = zigzag_encode(deltas(posting_offsets))
+        value_ends = np.concatenate(([0], np.cumsum(varint_lengths(values))))
+        # offsets into the stream only need 64 bits for streams beyond 4 GiB
+        offset_type = np.uint32 if value_ends[-1] < 2 ** 32 and posting_starts[-1] < 2 ** 32 else np.int64
+        return cls(hashes, posting_starts.astype(offset_type), value_ends[2 * posting_starts].astype(offset_type),
+                   encode_varints(values), songs, front_end)
+
+    @classmethod
+    def load(cls, index_dir) -> 'CompressedIndex':
+        index_dir = Path(index_dir)
+        with open(index_dir / 'songs.json', 'r', encoding='utf-8') as f:
+            songs = {int(song_id): song for song_id, song in json.load(f).items()}
+        front_end_path = index_dir / 'front_end.json'
+        front_end = FrontEnd.from_json(front_end_path.read_text(encoding='utf-8')) if front_end_path.exists() else DEFAULT_FRONT_END
+        return cls(np.load(index_dir / 'hashes.npy', mmap_mode='r'),
+                   np.load(index_dir / 'posting_starts.npy', mmap_mode='r'),
+                   np.load(index_dir / 'byte_starts.npy', mmap_mode='r'),
+                   np.load(index_dir / 'postings.npy', mmap_mode='r'),
+                   songs, front_end)
+
+    def save(self, index_dir) -> None:
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / 'hashes.npy', self.hashes)
+        np.save(index_dir / 'posting_starts.npy', self.posting_starts)
+        np.save(index_dir / 'byte_starts.npy', self.byte_starts)
+        np.save(index_dir / 'postings.npy', self.postings)
+        with open(index_dir / 'songs.json', 'w', encoding='utf-8') as f:
+            json.dump(self.songs, f)
+        (index_dir / 'front_end.json').write_text(self.front_end.to_json(), encoding='utf-8')
+
+    def song_names(self) -> dict:
+        return {song_id: song['song_name'] for song_id, song in self.songs.items()}
+
+    def _positions(self, sample_hashes: list) -> Tuple[np.ndarray, np.ndarray]:
+        """(position in hashes, found) of every sample hash."""
+        queries = np.array(sample_hashes, dtype=np.int64)
+        if len(self.hashes) == 0 or len(queries) == 0:
+            return np.zeros(len(queries), dtype=np.int64), np.zeros(len(queries), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.hashes, queries), len(self.hashes) - 1)
+        return positions, self.hashes[positions] == queries
+
+    def lookup(self, sample_hashes: list, song_id: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if len(self.hashes) == 0: # posting_starts is just [0], there is no end to read
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        positions, found = self._positions(sample_hashes)
+        lengths = np.where(found, self.posting_starts[positions + 1].astype(np.int64) - self.posting_starts[positions], 0)
+        byte_starts = self.byte_starts[positions].astype(np.int64)
+        byte_lengths = np.where(found, self.byte_starts[positions + 1].astype(np.int64) - byte_starts, 0)
+        stream = np.arange(byte_lengths.sum()) - np.repeat(np.cumsum(byte_lengths) - byte_lengths - byte_starts, byte_lengths)
+        values = zigzag_decode(decode_varints(np.asarray(self.postings[stream])))
+
+        # undo the deltas with a cumulative sum that restarts at the first posting of every hash
+        hash_first_posting = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        sample_idx = np.repeat(np.arange(len(lengths)), lengths)
+        decoded = []
+        for delta in (values[0::2], values[1::2]):
+            running = np.cumsum(delta)
+            decoded.append(running - (running[hash_first_posting] - delta[hash_first_posting]))
+        song_ids, offsets = decoded
+        if song_id is not None:
+            in_song = song_ids == song_id
+            sample_idx, song_ids, offsets = sample_idx[in_song], song_ids[in_song], offsets[in_song]
+        return sample_idx, song_ids, frames_to_time(offsets)
+
+    def posting_lengths(self, sample_hashes: list) -> np.ndarray:
+        if len(self.hashes) == 0:
+            return np.zeros(len(sample_hashes), dtype=np.int64)
+        positions, found = self._positions(sample_hashes)
+        return np.where(found, self.posting_starts[positions + 1].astype(np.int64) - self.posting_starts[positions], 0)
+
+    def hash_count(self, song_id: int) -> int:
+        return self.songs[song_id]['hash_count']
+
+    def song_duration(self, song_id: int) -> float:
+        return self.songs[song_id]['song_duration']
+
+
+def read_postings(db_path: str, chunk_size: int = 1_000_000) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict, FrontEnd]:
+    """
+    Reads all fingerprints of a database into (hashes, posting_starts, posting_song_ids, posting_offsets, songs,
+    front_end), the sorted unique hashes with CSR-style postings that keep each hash's rows in database row order.
+    """
+    conn = sqlite3.connect(db_path)
+    schema_version = get_schema_version(conn)
+    row_order = 'hash_value, song_id, offset' if is_clustered(conn) else 'rowid'
+
+    cursor = conn.execute(f"SELECT hash_value, song_id, offset FROM fingerprints ORDER BY {row_order}")
+    hash_chunks, song_id_chunks, offset_chunks = [], [], []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        hash_values, song_ids, offsets = zip(*rows)
+        hash_chunks.append(np.array([int(hash_val) for hash_val in hash_values], dtype=np.int64))
+        song_id_chunks.append(np.array(song_ids, dtype=np.int32))
+        if schema_version >= 2:
+            offset_chunks.append(np.array(offsets, dtype=np.int32))
+        else:
+            offset_chunks.append(times_to_frames(np.array(offsets, dtype=np.float64)).astype(np.int32))
+
+    songs = {}
+    for song_id, song_name, song_duration in conn.execute("SELECT song_id, song_name, song_duration FROM songs"):
+        songs[song_id] = {'song_name': song_name, 'song_duration': song_duration, 'hash_count': 0}
+    front_end = read_front_end(conn)
+    conn.close()
+
+    all_hashes = np.concatenate(hash_chunks) if hash_chunks else np.empty(0, dtype=np.int64)
+    all_song_ids = np.concatenate(song_id_chunks) if song_id_chunks else np.empty(0, dtype=np.int32)
+    all_offsets = np.concatenate(offset_chunks) if offset_chunks else np.empty(0, dtype=np.int32)
+
+    order = np.argsort(all_hashes, kind='stable')
+    hashes, posting_lengths = np.unique(all_hashes[order], return_counts=True)
+    posting_starts = np.concatenate(([0], np.cumsum(posting_lengths))).astype(np.int64)
+
+    song_ids, hash_counts = np.unique(all_song_ids, return_counts=True)
+    for song_id, hash_count in zip(song_ids.tolist(), hash_counts.tolist()):
+        if song_id in songs:
+            songs[song_id]['hash_count'] = hash_count
+
+    return hashes, posting_starts, all_song_ids[order], all_offsets[order], songs, front_end
+
+
+def build_mmap_index(db_path: str, index_dir: str, chunk_size: int = 1_000_000) -> MmapIndex:
+    """Builds an MmapIndex from a fingerprints database, keeping each hash's postings in database row order."""
+    index = MmapIndex(*read_postings(db_path, chunk_size))
+    index.save(index_dir)
+    print(f"Built index with {len(index.hashes)} unique hashes and {len(index.posting_song_ids)} postings in {index_dir}")
+    return index
+
+
+def build_compressed_index(db_path: str, index_dir: str, chunk_size: int = 1_000_000) -> CompressedIndex:
+    """Builds a CompressedIndex from a fingerprints database."""
+    index = CompressedIndex.from_postings(*read_postings(db_path, chunk_size))
+    index.save(index_dir)
+    print(f"Built compressed index with {len(index.hashes)} unique hashes, {int(index.posting_starts[-1]) if len(index.posting_starts) else 0} "
+          f"postings and {len(index.postings)} posting bytes in {index_dir}")
+    return index
+
+
+def build_sharded_mmap_index(shard_dir, index_dir, compressed: bool = False) -> None:
+    """
+    Builds an MmapIndex, or with compressed a CompressedIndex, per shard of a sharded database, in a directory
+    that open_index reads as sharded index.
+    """
+    build_index = build_compressed_index if compressed else build_mmap_index
+    index_names = []
+    for shard_path in read_shard_paths(shard_dir):
+        index_names.append(shard_path.stem)
+        build_index(shard_path, Path(index_dir) / shard_path.stem)
+    write_shards_file(index_dir, index_names)
+
+
+class ShardedIndex:
+    """
+    Hash-partitioned index over shards that are SQLite databases or MmapIndex directories. A lookup is split by
+    shard_of, the shards are probed in parallel threads and their rows are merged back into the order of the
+    sample hashes, so results match those of a single index holding all fingerprints.
+    """
+
+    def __init__(self, shards: list):
+        self.shards = shards
+        self.executor = ThreadPoolExecutor(len(shards), thread_name_prefix='shard-lookup')
+
+    @classmethod
+    def load(cls, shard_dir) -> 'ShardedIndex':
+        return cls([open_index(shard_path) for shard_path in read_shard_paths(shard_dir)])
+
+    @property
+    def front_end(self) -> FrontEnd:
+        return self.shards[0].front_end
+
+    def _scatter(self, sample_hashes: list, probe) -> list:
+        """[(sample positions, probe result)] of every shard that any of the sample hashes routes to."""
+        queries = np.array(sample_hashes, dtype=np.int64)
+        shards = shard_of(queries, len(self.shards))
+        positions = [np.flatnonzero(shards == shard) for shard in range(len(self.shards))]
+        futures = [(shard_positions, self.executor.submit(probe, self.shards[shard], queries[shard_positions].tolist()))
+                   for shard, shard_positions in enumerate(positions) if len(shard_positions)]
+        return [(shard_positions, future.result()) for shard_positions, future in futures]
+
+    def lookup(self, sample_hashes: list, song_id: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        results = self._scatter(sample_hashes, lambda shard, shard_hashes: shard.lookup(shard_hashes, song_id))
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        sample_idx = np.concatenate([shard_positions[shard_idx] for shard_positions, (shard_idx, _, _) in results])
+        song_ids = np.concatenate([shard_song_ids for _, (_, shard_song_ids, _) in results])
+        offsets = np.concatenate([shard_offsets for _, (_, _, shard_offsets) in results])
+        # each hash lives in one shard, so a stable sort restores the single index order
+        order = np.argsort(sample_idx, kind='stable')
+        return sample_idx[order], song_ids[order], offsets[order]
+
+    def posting_lengths(self, sample_hashes: list) -> np.ndarray:
+        lengths = np.zeros(len(sample_hashes), dtype=np.int64)
+        for shard_positions, shard_lengths in self._scatter(sample_hashes, lambda shard, shard_hashes: shard.posting_lengths(shard_hashes)):
+            lengths[shard_positions] = shard_lengths
+        return lengths
+
+    def song_names(self) -> dict:
+        return self.shards[0].song_names()
+
+    def hash_count(self, song_id: int) -> int:
+        return sum(shard.hash_count(song_id) for shard in self.shards)
+
+    def song_duration(self, song_id: int) -> float:
+        return self.shards[0].song_duration(song_id)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+def index_version(db) -> tuple:
+    """
+    Stamp that changes whenever songs are added to a database, sharded database or index directory, taken from
+    file sizes and modification times without opening it. SQLite commits in WAL mode only touch the -wal file.
+    """
+    db = Path(db)
+    if is_sharded(db):
+        return tuple(index_version(shard_path) for shard_path in read_shard_paths(db)) + (os.stat(db / SHARDS_FILE).st_mtime_ns,)
+    paths = [db / 'songs.json'] if db.is_dir() else [db, Path(f'{db}-wal')]
+    return tuple((stat.st_size, stat.st_mtime_ns) for stat in (os.stat(path) for path in paths if path.exists()))
+
+
+_sqlite_indexes = {} # (path, pid) -> SQLiteIndex, so repeated match_sample_db calls reuse one pool
+_sharded_indexes = {} # (path, pid) -> (shards.json mtime, ShardedIndex), reusing the shards' pools and lookup threads
+
+
+def open_index(db):
+    """
+    Accepts an index object, a sharded database or index directory, a CompressedIndex or MmapIndex directory or a
+    SQLite database path.
+    """
+    if hasattr(db, 'lookup'):
+        return db
+    if is_sharded(db):
+        key = (str(Path(db).resolve()), os.getpid())
+        shards_mtime = os.stat(Path(db) / SHARDS_FILE).st_mtime_ns
+        cached = _sharded_indexes.get(key)
+        if cached is None or cached[0] != shards_mtime:
+            cached = _sharded_indexes[key] = (shards_mtime, ShardedIndex.load(db))
+        return cached[1]
+    if (Path(db) / 'postings.npy').is_file():
+        return CompressedIndex.load(db)
+    if Path(db).is_dir():
+        return MmapIndex.load(db)
+
+    # forked workers must not share connections, and a replaced database file needs a new index. The open
+    # connections keep the old file's inode allocated, so a new file can't reuse its number.
+    key = (str(Path(db).resolve()), os.getpid())
+    stat = os.stat(db)
+    index = _sqlite_indexes.get(key)
+    if index is None or index.file_id != (stat.st_dev, stat.st_ino):
+        if index is not None:
+            index.close()
+        index = _sqlite_indexes[key] = SQLiteIndex(db)
+    return index
+
+
+@metrics.timed('lookup')
+def lookup_batch(index, sample_hash_lists: list) -> list:
+    """
+    Resolves the hashes of several samples with a single index probe and splits the result back per sample,
+    in the same order index.lookup would have returned it for each sample on its own.
+    """
+    all_hashes = np.concatenate([np.array(sample_hashes, dtype=np.int64) for sample_hashes in sample_hash_lists])
+    unique_hashes = np.unique(all_hashes)
+    sample_idx, song_ids, offsets = index.lookup(unique_hashes.tolist())
+    row_starts = np.searchsorted(sample_idx, np.arange(len(unique_hashes) + 1))
+
+    results = []
+    for sample_hashes in sample_hash_lists:
+        positions = np.searchsorted(unique_hashes, np.array(sample_hashes, dtype=np.int64))
+        starts = row_starts[positions]
+        lengths = row_starts[positions + 1] - starts
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        results.append((np.repeat(np.arange(len(positions)), lengths), song_ids[rows], offsets[rows]))
+    return results
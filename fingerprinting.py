@@ -1,78 +1,235 @@
-import librosa as lr
+import io
 import numpy as np
 import sqlite3
 import time
-from collections import defaultdict
-from scipy.ndimage import maximum_filter
+from itertools import repeat
 from typing import List, Tuple
 from pathlib import Path
 
+import metrics
+from setup import get_schema_version, shard_of
+from fingerprint_index import SAMPLING_RATE, HOP_LENGTH, N_FFT, DEFAULT_FRONT_END, FrontEnd, time_to_frame, times_to_frames, \
+    get_hash_count, get_song_duration, open_index
 
-def generate_spectrogram(path: str, start_time: float = 0.0, clip_duration: float = None) -> Tuple[np.ndarray, int]:
-    audio_signal, sampling_rate = lr.load(path, sr=22050, mono=True, offset=start_time, duration=clip_duration)
 
-    transformed_signal = lr.stft(audio_signal)
-    spectrogram = lr.amplitude_to_db(np.abs(transformed_signal), ref=np.max)
+# librosa and scipy.ndimage are imported by the functions that use them, so importing this module for hashing,
+# database writes or matching stays cheap. warm_up() pays for them and numba's JIT compilation up front.
 
-    return spectrogram, sampling_rate
+@metrics.timed('decode')
+def load_audio(path: str, start_time: float = 0.0, clip_duration: float = None, sampling_rate: int = SAMPLING_RATE) -> Tuple[np.ndarray, int]:
+    import librosa as lr
+    return lr.load(path, sr=sampling_rate, mono=True, offset=start_time, duration=clip_duration)
 
 
-def find_peaks(spectrogram: np.ndarray, sampling_rate: int, peak_min_distance: int, peak_min_amplitude_threshold: int) -> List[Tuple[float, float]]:
-    filtered_spectrogram = maximum_filter(spectrogram, size=(peak_min_distance, peak_min_distance))
-    peaks_mask = (spectrogram == filtered_spectrogram)
-    peaks_mask &= (spectrogram > (np.max(spectrogram) + peak_min_amplitude_threshold)) # Example threshold
+def resample_signal(audio_signal: np.ndarray, sampling_rate: int, target_rate: int = SAMPLING_RATE) -> np.ndarray:
+    """Converts an already decoded (samples,) or (samples, channels) signal to mono at target_rate like load_audio does."""
+    if audio_signal.ndim > 1:
+        audio_signal = np.mean(audio_signal, axis=1)
+    if sampling_rate != target_rate:
+        import librosa as lr
+        audio_signal = lr.resample(audio_signal, orig_sr=sampling_rate, target_sr=target_rate)
+    return audio_signal
 
-    peak_indices = np.argwhere(peaks_mask)
-    peak_times = lr.frames_to_time(peak_indices[:, 1], sr=sampling_rate, hop_length=512)
-    peak_freqs = lr.fft_frequencies(sr=sampling_rate)[peak_indices[:, 0]]
 
-    peaks = list(zip(peak_times, peak_freqs))
-    print(f"Found {len(peaks)} peaks.")
-    return peaks
+def stft_magnitudes(audio_signal: np.ndarray, front_end: FrontEnd = DEFAULT_FRONT_END) -> np.ndarray:
+    """float32 STFT magnitudes of the front end's bins, for a signal at front_end.sampling_rate."""
+    import librosa as lr
+    transformed_signal = lr.stft(audio_signal.astype(np.float32, copy=False), n_fft=front_end.fft_size,
+                                 hop_length=front_end.hop_length, dtype=np.complex64)
+    first_bin, last_bin = front_end.bin_range()
+    return np.abs(transformed_signal[first_bin:last_bin])
 
 
-def generate_fingerprints(peaks: List[Tuple[float, float]], song: str) -> dict:
-    hashes = {} # { hash_value: (song_id, time_offset) }
+def magnitudes_to_db(magnitudes: np.ndarray) -> np.ndarray:
+    """dB relative to the loudest bin, so slices of a longer STFT are scaled like a spectrogram of the slice alone."""
+    import librosa as lr
+    return lr.amplitude_to_db(magnitudes, ref=np.max)
+
+
+@metrics.timed('stft')
+def compute_spectrogram(audio_signal: np.ndarray, front_end: FrontEnd = DEFAULT_FRONT_END) -> np.ndarray:
+    """float32 dB spectrogram of the front end's bins, for a signal at front_end.sampling_rate."""
+    return magnitudes_to_db(stft_magnitudes(audio_signal, front_end))
 
-    target_zone_time_delta_min = 0.1
-    target_zone_time_delta_max = 1.0
-    target_zone_freq_delta_max = 1000
 
-    song_id = song
+def generate_spectrogram(path: str, start_time: float = 0.0, clip_duration: float = None,
+                         front_end: FrontEnd = DEFAULT_FRONT_END) -> Tuple[np.ndarray, int]:
+    audio_signal, sampling_rate = load_audio(path, start_time, clip_duration, front_end.sampling_rate)
+    spectrogram = compute_spectrogram(audio_signal, front_end)
+
+    return spectrogram, sampling_rate
 
-    sorted_peaks = sorted(peaks, key=lambda x: x[0])
 
-    for i in range(len(sorted_peaks)):
-        anchor_time, anchor_freq = sorted_peaks[i]
-        for j in range(i + 1, len(sorted_peaks)):
-            target_time, target_freq = sorted_peaks[j]
-            delta_t = target_time - anchor_time
-            delta_f = abs(target_freq - anchor_freq)
+@metrics.timed('peaks')
+def find_peak_indices(spectrogram: np.ndarray, peak_min_distance: int, peak_min_amplitude_threshold: int,
+                      max_peaks_per_frame: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the (frames, bins) integer arrays of the local maxima louder than the spectrogram maximum plus
+    peak_min_amplitude_threshold, ordered by bin and then by frame. The max filter is applied as two 1-D passes in
+    float32 and only around frames and bands that reach the threshold at all. With max_peaks_per_frame, only the
+    loudest peaks of each frame are kept, which bounds the number of hashes per second of audio.
+    """
+    from scipy.ndimage import maximum_filter1d
+    spectrogram = np.asarray(spectrogram, dtype=np.float32)
+    empty = np.empty(0, dtype=np.int64)
+    if spectrogram.size == 0:
+        return empty, empty
+
+    loud = spectrogram > (spectrogram.max() + peak_min_amplitude_threshold)
+    loud_bins = np.flatnonzero(loud.any(axis=1))
+    if len(loud_bins) == 0:
+        return empty, empty
+
+    # the filter reaches size // 2 cells to either side, so cropping with that margin leaves every loud cell's
+    # neighbourhood intact, and at the real borders the crop keeps scipy's reflect mode unchanged
+    margin = peak_min_distance // 2
+    bin_lo, bin_hi = max(loud_bins[0] - margin, 0), min(loud_bins[-1] + margin + 1, spectrogram.shape[0])
+    needed_frames = maximum_filter1d(loud.any(axis=0).astype(np.uint8), 2 * margin + 1) > 0 # frames within margin of a loud frame
+
+    band = spectrogram[bin_lo:bin_hi]
+    filtered = np.full(band.shape, -np.inf, dtype=np.float32)
+    filtered[:, needed_frames] = maximum_filter1d(band[:, needed_frames], peak_min_distance, axis=0)
+    filtered = maximum_filter1d(filtered, peak_min_distance, axis=1)
+
+    peaks_mask = loud[bin_lo:bin_hi] & (band == filtered)
+    bins, frames = np.nonzero(peaks_mask)
+    bins += bin_lo
+
+    if max_peaks_per_frame is not None and len(frames):
+        # rank the peaks of each frame by amplitude and keep the top max_peaks_per_frame
+        amplitudes = spectrogram[bins, frames]
+        order = np.lexsort((-amplitudes, frames))
+        frame_starts = np.searchsorted(frames[order], frames[order], side='left')
+        keep = order[np.arange(len(order)) - frame_starts < max_peaks_per_frame]
+        keep.sort()
+        bins, frames = bins[keep], frames[keep]
+
+    metrics.count('peaks', len(frames))
+    return frames.astype(np.int64), bins.astype(np.int64)
+
+
+def peak_indices_to_peaks(frames: np.ndarray, bins: np.ndarray, front_end: FrontEnd = DEFAULT_FRONT_END) -> np.ndarray:
+    """
+    Converts peak (frames, bins) of a compute_spectrogram(..., front_end) spectrogram to an (n, 2) array of
+    (time, freq) rows as accepted by generate_fingerprint_arrays.
+    """
+    # the arithmetic of librosa's frames_to_time and fft_frequencies
+    peak_times = (np.asarray(frames) * front_end.hop_length).astype(int) / float(front_end.sampling_rate)
+    peak_freqs = np.fft.rfftfreq(front_end.fft_size, 1.0 / front_end.sampling_rate)[bins + front_end.bin_range()[0]]
+    return np.column_stack((peak_times, peak_freqs))
+
+
+def find_peaks(spectrogram: np.ndarray, sampling_rate: int, peak_min_distance: int, peak_min_amplitude_threshold: int,
+               max_peaks_per_frame: int = None, front_end: FrontEnd = None) -> List[Tuple[float, float]]:
+    if front_end is None:
+        front_end = FrontEnd(decimation=SAMPLING_RATE // sampling_rate)
+    frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+    peaks = list(map(tuple, peak_indices_to_peaks(frames, bins, front_end)))
+    print(f"Found {len(peaks)} peaks.")
+    return peaks
 
-            if target_zone_time_delta_min <= delta_t <= target_zone_time_delta_max and delta_f <= target_zone_freq_delta_max:
 
-                freq1_bin = int(anchor_freq)
-                freq2_bin = int(target_freq)
-                delta_t_bin = int(delta_t * 10)
 
-                hash_value = hash((freq1_bin, freq2_bin, delta_t_bin))
+def warm_up(front_end: FrontEnd = DEFAULT_FRONT_END) -> float:
+    """
+    Runs decode, resampling, STFT, peak picking and hashing once on a second of synthetic audio, so the imports and
+    numba compilation behind them are paid before the first real request. Returns the seconds it took.
+    """
+    import soundfile as sf
+    start = time.perf_counter()
+    t = np.arange(front_end.sampling_rate) / front_end.sampling_rate
+    chirp = (0.5 * np.sin(2 * np.pi * (1000 + 2000 * t) * t)).astype(np.float32)
+    wav = io.BytesIO()
+    sf.write(wav, chirp, front_end.sampling_rate, format='WAV')
+    wav.seek(0)
+    # a trace that is never recorded keeps the warm-up out of the stage metrics
+    with metrics.trace('warm_up', record=False):
+        audio_signal, sampling_rate = load_audio(wav, sampling_rate=front_end.sampling_rate)
+        resample_signal(audio_signal, 2 * sampling_rate, sampling_rate)
+        frames, bins = find_peak_indices(compute_spectrogram(audio_signal, front_end), 25, -40)
+        generate_fingerprint_arrays(peak_indices_to_peaks(frames, bins, front_end))
+    return time.perf_counter() - start
+
+TARGET_ZONE_TIME_DELTA_MIN = 0.1
+TARGET_ZONE_TIME_DELTA_MAX = 1.0
+TARGET_ZONE_FREQ_DELTA_MAX = 1000
+
+# bit layout of a packed hash: | freq1_bin (14) | freq2_bin (14) | delta_t_bin (8) |
+HASH_FREQ_BITS = 14
+HASH_DELTA_T_BITS = 8
+
+
+def pack_hash(freq1_bin, freq2_bin, delta_t_bin):
+    """Packs (freq1_bin, freq2_bin, delta_t_bin) into a single stable integer. Works on scalars and arrays."""
+    return (freq1_bin << (HASH_FREQ_BITS + HASH_DELTA_T_BITS)) | (freq2_bin << HASH_DELTA_T_BITS) | delta_t_bin
+
+
+def unpack_hash(hash_value):
+    freq1_bin = hash_value >> (HASH_FREQ_BITS + HASH_DELTA_T_BITS)
+    freq2_bin = (hash_value >> HASH_DELTA_T_BITS) & ((1 << HASH_FREQ_BITS) - 1)
+    delta_t_bin = hash_value & ((1 << HASH_DELTA_T_BITS) - 1)
+    return freq1_bin, freq2_bin, delta_t_bin
+
+
+@metrics.timed('hashing')
+def generate_fingerprint_arrays(peaks) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs every anchor peak with the peaks in its target zone and returns parallel (hashes, offsets) arrays,
+    ordered by anchor and then by target, where offsets are the anchor times.
+    """
+    peaks = np.asarray(peaks, dtype=np.float64).reshape(-1, 2)
+    order = np.argsort(peaks[:, 0], kind='stable')
+    times = peaks[order, 0]
+    freqs = peaks[order, 1]
+
+    # candidate window per anchor; a small slack keeps the exact comparisons below authoritative
+    slack = 1e-9
+    window_start = np.searchsorted(times, times + TARGET_ZONE_TIME_DELTA_MIN - slack, side='left')
+    window_end = np.searchsorted(times, times + TARGET_ZONE_TIME_DELTA_MAX + slack, side='right')
+    window_lengths = np.maximum(window_end - window_start, 0)
+
+    anchors = np.repeat(np.arange(len(times)), window_lengths)
+    first_candidate = np.cumsum(window_lengths) - window_lengths
+    targets = np.arange(len(anchors)) - np.repeat(first_candidate - window_start, window_lengths)
+
+    delta_t = times[targets] - times[anchors]
+    delta_f = np.abs(freqs[targets] - freqs[anchors])
+    in_zone = (delta_t >= TARGET_ZONE_TIME_DELTA_MIN) & (delta_t <= TARGET_ZONE_TIME_DELTA_MAX) & (delta_f <= TARGET_ZONE_FREQ_DELTA_MAX)
+    anchors, targets, delta_t = anchors[in_zone], targets[in_zone], delta_t[in_zone]
+
+    freq1_bin = freqs[anchors].astype(np.int64)
+    freq2_bin = freqs[targets].astype(np.int64)
+    delta_t_bin = (delta_t * 10).astype(np.int64)
+
+    hashes = pack_hash(freq1_bin, freq2_bin, delta_t_bin)
+    offsets = times[anchors]
+    metrics.count('hashes', len(hashes))
+    return hashes, offsets
+
+
+def fingerprint_arrays_to_dict(hashes: np.ndarray, offsets: np.ndarray, song: str) -> dict:
+    fingerprints = {} # { hash_value: [(song_id, time_offset), ...] }
+    for hash_value, offset in zip(hashes.tolist(), offsets.tolist()):
+        if hash_value not in fingerprints:
+            fingerprints[hash_value] = []
+        fingerprints[hash_value].append((song, offset))
+    return fingerprints
 
-                if hash_value not in hashes:
-                    hashes[hash_value] = []
-                hashes[hash_value].append((song_id, anchor_time))
-            elif delta_t > target_zone_time_delta_max:
-                break
-    return hashes
 
+def generate_fingerprints(peaks: List[Tuple[float, float]], song: str) -> dict:
+    hashes, offsets = generate_fingerprint_arrays(peaks)
+    return fingerprint_arrays_to_dict(hashes, offsets, song)
 
-def add_song_to_db(conn, song_name, file_path: str, duration: float):
+
+def add_song_to_db(conn, song_name, file_path: str, duration: float, commit: bool = True):
     if isinstance(file_path, Path):
         file_path = str(file_path)
 
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO songs (song_name, file_path, song_duration) VALUES (?, ?, ?)", (song_name, file_path, duration))
-        conn.commit()
+        if commit:
+            conn.commit()
         song_id = cursor.lastrowid
         print(f"Added song '{song_name}' with ID {song_id}")
         return song_id
@@ -83,78 +240,297 @@ def add_song_to_db(conn, song_name, file_path: str, duration: float):
         return result[0] if result else None
 
 
+def replace_song_in_db(conn, song_name, file_path: str, duration: float, content_digest: str, file_mtime: float,
+                       fingerprint_params: str, song_id: int = None) -> int:
+    """
+    Inserts a song or updates an existing one and deletes the fingerprints it already has. Nothing is committed,
+    so the caller writes the new fingerprints in the same transaction and the replacement is atomic.
+    A new song gets the given song_id, which keeps the ids of the shards of a sharded database in sync.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT song_id FROM songs WHERE song_name = ?", (song_name,))
+    result = cursor.fetchone()
+    song_values = (str(file_path), duration, content_digest, file_mtime, fingerprint_params)
+
+    if result is None:
+        cursor.execute("INSERT INTO songs (file_path, song_duration, content_digest, file_mtime, fingerprint_params, song_name, song_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       song_values + (song_name, song_id))
+        print(f"Added song '{song_name}' with ID {cursor.lastrowid}")
+        return cursor.lastrowid
+
+    song_id = result[0]
+    cursor.execute("DELETE FROM fingerprints WHERE song_id = ?", (song_id,))
+    cursor.execute("UPDATE songs SET file_path = ?, song_duration = ?, content_digest = ?, file_mtime = ?, fingerprint_params = ?, hash_count = 0 WHERE song_id = ?",
+                   song_values + (song_id,))
+    print(f"Song '{song_name}' changed, replacing fingerprints of ID {song_id}")
+    return song_id
+
+
+def add_to_hash_count(cursor, song_id, added_rows: int) -> None:
+    try:
+        cursor.execute("UPDATE songs SET hash_count = hash_count + ? WHERE song_id = ?", (added_rows, song_id))
+    except sqlite3.OperationalError:
+        pass # database from before songs.hash_count, SQLiteIndex.hash_count counts the rows instead
+
+
+@metrics.timed('db_insert')
 def add_fingerprints_to_db(conn, song_id, fingerprint_dict) -> None:
     cursor = conn.cursor()
+    schema_version = get_schema_version(conn)
     fingerprint_data = []
     for hash_val, entries in fingerprint_dict.items():
         for entry in entries:
             offset = entry[1] if isinstance(entry, tuple) else entry
-            hash_str = str(hash_val)
-            fingerprint_data.append((hash_str, song_id, offset))
-
-    cursor.executemany("INSERT INTO fingerprints (hash_value, song_id, offset) VALUES (?, ?, ?)", fingerprint_data)
+            if schema_version >= 2:
+                fingerprint_data.append((int(hash_val), song_id, time_to_frame(offset)))
+            else:
+                fingerprint_data.append((str(hash_val), song_id, offset))
+
+    # the clustered v2 table keeps exact duplicate (hash, song, offset) entries only once
+    insert = "INSERT OR IGNORE" if schema_version >= 2 else "INSERT"
+    cursor.executemany(f"{insert} INTO fingerprints (hash_value, song_id, offset) VALUES (?, ?, ?)", fingerprint_data)
+    inserted_rows = cursor.rowcount
+    add_to_hash_count(cursor, song_id, inserted_rows)
+    metrics.count('db_rows_inserted', inserted_rows)
     conn.commit()
     print(f"Added {len(fingerprint_data)} fingerprint entries for song ID {song_id}")
 
 
-def match_sample_db(sample_fingerprints: dict, db_path: str, sample_len: float) -> Tuple[str, int, float]:
-    """Matches sample fingerprints against the SQLite database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+@metrics.timed('db_insert')
+def add_fingerprint_arrays_to_db(conn, song_id, hashes: np.ndarray, offsets: np.ndarray, commit: bool = True) -> None:
+    """Array counterpart of add_fingerprints_to_db for the (hashes, offsets) output of generate_fingerprint_arrays."""
+    schema_version = get_schema_version(conn)
+    if schema_version >= 2:
+        fingerprint_data = zip(hashes.tolist(), repeat(song_id), times_to_frames(offsets).tolist())
+    else:
+        fingerprint_data = zip(map(str, hashes.tolist()), repeat(song_id), offsets.tolist())
+
+    insert = "INSERT OR IGNORE" if schema_version >= 2 else "INSERT"
+    cursor = conn.executemany(f"{insert} INTO fingerprints (hash_value, song_id, offset) VALUES (?, ?, ?)", fingerprint_data)
+    inserted_rows = cursor.rowcount
+    add_to_hash_count(cursor, song_id, inserted_rows)
+    metrics.count('db_rows_inserted', inserted_rows)
+    if commit:
+        conn.commit()
+    print(f"Added {len(hashes)} fingerprint entries for song ID {song_id}")
+
+
+def replace_song_in_shards(shard_conns: list, song_name, file_path: str, duration: float, content_digest: str,
+                           file_mtime: float, fingerprint_params: str) -> int:
+    """replace_song_in_db on every shard, with the song id chosen by the first shard."""
+    song_id = replace_song_in_db(shard_conns[0], song_name, file_path, duration, content_digest, file_mtime, fingerprint_params)
+    for conn in shard_conns[1:]:
+        replace_song_in_db(conn, song_name, file_path, duration, content_digest, file_mtime, fingerprint_params, song_id)
+    return song_id
+
+
+def add_fingerprint_arrays_to_shards(shard_conns: list, song_id, hashes: np.ndarray, offsets: np.ndarray, commit: bool = True) -> None:
+    """add_fingerprint_arrays_to_db for a sharded database, writing every hash to the shard shard_of routes it to."""
+    if len(shard_conns) == 1:
+        add_fingerprint_arrays_to_db(shard_conns[0], song_id, hashes, offsets, commit)
+        return
+    shards = shard_of(hashes, len(shard_conns))
+    # the first shard's catalog commits last, so a song that isn't complete in every shard is re-indexed by the next run
+    for shard in reversed(range(len(shard_conns))):
+        in_shard = shards == shard
+        add_fingerprint_arrays_to_db(shard_conns[shard], song_id, hashes[in_shard], offsets[in_shard], commit)
+
+
+def sample_anchor_arrays(sample_fingerprints: dict) -> Tuple[list, np.ndarray, np.ndarray]:
+    """Flattens { hash_value: [(song, anchor_time), ...] } into the hash list plus CSR-style anchor arrays."""
+    sample_hashes = list(sample_fingerprints.keys())
+    anchor_counts = np.array([len(entries) for entries in sample_fingerprints.values()], dtype=np.int64)
+    anchor_times = np.array([entry[1] if isinstance(entry, tuple) else entry
+                             for entries in sample_fingerprints.values() for entry in entries], dtype=np.float64)
+    return sample_hashes, anchor_counts, anchor_times
+
+
+def score_alignments(sample_idx: np.ndarray, song_ids: np.ndarray, db_offsets: np.ndarray,
+                     anchor_counts: np.ndarray, anchor_times: np.ndarray) -> Tuple[int, int, int, int]:
+    """
+    Histograms the offset differences of all (database entry, sample anchor) pairs over (song_id, offset_bin).
+    Returns (best_song_id, max_count, best_song_alignments, total_alignments); ties go to the song that was hit first.
+    """
+    if len(sample_idx) == 0:
+        return None, 0, 0, 0
+
+    anchor_starts = np.cumsum(anchor_counts) - anchor_counts
+    repeats = anchor_counts[sample_idx]
+    pair_rows = np.repeat(np.arange(len(sample_idx)), repeats)
+    pair_anchors = np.arange(len(pair_rows)) - np.repeat(np.cumsum(repeats) - repeats - anchor_starts[sample_idx], repeats)
+
+    delta_offsets = db_offsets[pair_rows] - anchor_times[pair_anchors]
+    offset_bins = np.rint(delta_offsets * 10).astype(np.int64) # 0.1 second bins
+    offset_bins -= offset_bins.min()
+    bin_range = int(offset_bins.max()) + 1
+
+    songs, first_hit, pair_songs = np.unique(song_ids[pair_rows], return_index=True, return_inverse=True)
+    bin_keys, bin_counts = np.unique(pair_songs * bin_range + offset_bins, return_counts=True)
+
+    max_count = int(bin_counts.max())
+    candidates = np.unique(bin_keys[bin_counts == max_count] // bin_range)
+    best = candidates[np.argmin(first_hit[candidates])]
+
+    return int(songs[best]), max_count, int(np.count_nonzero(pair_songs == best)), len(pair_rows)
+
+
+EARLY_STOP_MIN_COUNT = 10 # aligned hashes the leader needs before the margin can end the search
+_BIN_KEY_OFFSET = 1 << 31 # keeps offset bins non-negative inside (song_id << 32 | bin) keys
+
+
+def progressive_alignments(index, sample_hashes: list, anchor_counts: np.ndarray, anchor_times: np.ndarray,
+                           margin: float = None, min_count: int = EARLY_STOP_MIN_COUNT,
+                           first_chunk: int = 16) -> Tuple[int, int, int, int]:
+    """
+    score_alignments that resolves the sample hashes rarest first, in chunks of doubling size, using the index's
+    posting list lengths. At most anchor_count * posting_length alignments are left per unresolved hash, so songs
+    whose best bin can't reach the leader's any more are pruned, and the search ends once only the leader can
+    still win. With a margin, it also ends as soon as the leader has min_count aligned hashes and margin times
+    the runner-up's. The winner's count is then completed from its own postings of the remaining hashes, so the
+    returned counts equal score_alignments' for the same winner. The total only covers the resolved chunks.
+    """
+    if len(sample_hashes) == 0:
+        return None, 0, 0, 0
+
+    hashes = np.array(sample_hashes, dtype=np.int64)
+    anchor_starts = np.cumsum(anchor_counts) - anchor_counts
+    with metrics.stage('lookup'):
+        posting_lengths = np.asarray(index.posting_lengths(sample_hashes), dtype=np.int64)
+    order = np.argsort(posting_lengths, kind='stable')
+    remaining_bound = np.sum(anchor_counts * posting_lengths) - np.cumsum((anchor_counts * posting_lengths)[order])
+
+    def alignment_keys(hash_order, sample_idx, song_ids, db_offsets):
+        """(song, offset bin) keys and first-hit keys of the alignments of a resolved chunk."""
+        original_idx = hash_order[sample_idx]
+        row_in_hash = np.arange(len(sample_idx)) - np.searchsorted(sample_idx, sample_idx)
+        repeats = anchor_counts[original_idx]
+        pair_rows = np.repeat(np.arange(len(sample_idx)), repeats)
+        pair_anchors = np.arange(len(pair_rows)) - np.repeat(np.cumsum(repeats) - repeats - anchor_starts[original_idx], repeats)
+        offset_bins = np.rint((db_offsets[pair_rows] - anchor_times[pair_anchors]) * 10).astype(np.int64)
+        keys = (song_ids[pair_rows] << 32) | (offset_bins + _BIN_KEY_OFFSET)
+        # the full matcher breaks ties by the first hit in sample order, then database row order
+        first_hits = (original_idx[pair_rows] << 32) | row_in_hash[pair_rows]
+        return keys, first_hits
+
+    keys = np.empty(0, dtype=np.int64)
+    first_hits = np.empty(0, dtype=np.int64)
+    resolved = 0
+    chunk = first_chunk
+    total_alignments = 0
+    leader = None
+    while resolved < len(order):
+        chunk_order = order[resolved:resolved + chunk]
+        resolved += len(chunk_order)
+        chunk *= 2
+        with metrics.stage('lookup'):
+            sample_idx, song_ids, db_offsets = index.lookup(hashes[chunk_order].tolist())
+        metrics.count('lookup_rows', len(sample_idx))
+
+        with metrics.stage('scoring'):
+            chunk_keys, chunk_first_hits = alignment_keys(chunk_order, sample_idx, song_ids, db_offsets)
+            total_alignments += len(chunk_keys)
+            keys = np.concatenate((keys, chunk_keys))
+            first_hits = np.concatenate((first_hits, chunk_first_hits))
+            if len(keys) == 0:
+                continue
+
+            bin_keys, bin_counts = np.unique(keys, return_counts=True)
+            bin_songs = bin_keys >> 32
+            songs, song_starts = np.unique(bin_songs, return_index=True)
+            best_counts = np.maximum.reduceat(bin_counts, song_starts)
+            leader_count = int(best_counts.max())
+            bound = int(remaining_bound[resolved - 1])
+
+            contenders = best_counts + bound >= leader_count
+            if not contenders.all():
+                keep = np.isin(keys >> 32, songs[contenders])
+                keys, first_hits = keys[keep], first_hits[keep]
+                songs, best_counts = songs[contenders], best_counts[contenders]
+
+            leaders = songs[best_counts == leader_count]
+            runner_up = int(np.sort(best_counts)[-2]) if len(best_counts) > 1 else 0
+            decided = len(songs) == 1 and bound < leader_count
+            margin_reached = margin is not None and len(leaders) == 1 and leader_count >= min_count and leader_count >= margin * runner_up
+            if decided or margin_reached or resolved == len(order):
+                key_songs = keys >> 32
+                leader = min(leaders, key=lambda song: first_hits[key_songs == song].min())
+                break
+
+    if leader is None:
+        return None, 0, 0, 0
+
+    leader_keys = keys[(keys >> 32) == leader]
+    if resolved < len(order):
+        remaining_order = order[resolved:]
+        with metrics.stage('lookup'):
+            sample_idx, song_ids, db_offsets = index.lookup(hashes[remaining_order].tolist(), song_id=int(leader))
+        metrics.count('lookup_rows', len(sample_idx))
+        leader_keys = np.concatenate((leader_keys, alignment_keys(remaining_order, sample_idx, song_ids, db_offsets)[0]))
+    metrics.count('hashes_skipped', len(order) - resolved)
+
+    _, leader_bin_counts = np.unique(leader_keys, return_counts=True)
+    return int(leader), int(leader_bin_counts.max()), len(leader_keys), total_alignments
+
+
+def match_sample_db(sample_fingerprints: dict, db_path, sample_len: float, progressive: bool = False,
+                    margin: float = None) -> Tuple[str, int, float]:
+    """
+    Matches sample fingerprints against an index. db_path may be a SQLite database, a directory
+    written by build_mmap_index or an already opened index backend. With progressive, the hashes are
+    resolved by progressive_alignments, stopping early at the given margin.
+    """
+    index = open_index(db_path)
 
-    matches = defaultdict(lambda: defaultdict(int)) # { song_id: { offset_bin: count } }
     start_time = time.time()
 
-    cursor.execute("SELECT song_id, song_name FROM songs")
-    song_id_to_name = dict(cursor.fetchall())
+    sample_hashes, anchor_counts, anchor_times = sample_anchor_arrays(sample_fingerprints)
+    if progressive and hasattr(index, 'posting_lengths'):
+        alignments = progressive_alignments(index, sample_hashes, anchor_counts, anchor_times, margin)
+        return report_match(index, alignments, len(anchor_counts), sample_len, start_time)
 
-    processed_hashes = 0
-    total_matches_found = 0
+    with metrics.stage('lookup'):
+        sample_idx, song_ids, db_offsets = index.lookup(sample_hashes)
+    metrics.count('lookup_rows', len(sample_idx))
 
-    for sample_hash, sample_anchor_times in sample_fingerprints.items():
-        hash_str = str(sample_hash)
-        cursor.execute("SELECT song_id, offset FROM fingerprints WHERE hash_value = ?", (hash_str,))
-        db_entries = cursor.fetchall() # List of (song_id, db_anchor_time)
+    return score_sample_matches(index, sample_idx, song_ids, db_offsets, anchor_counts, anchor_times, sample_len, start_time)
 
-        processed_hashes += 1
-        if db_entries:
-            total_matches_found += len(db_entries) * len(sample_anchor_times)
-            for sample_anchor_tuple in sample_anchor_times:
-                for db_song_id, db_anchor_time in db_entries:
-                    delta_offset = db_anchor_time - sample_anchor_tuple[1]
-                    offset_bin = round(delta_offset, 1)
-                    matches[db_song_id][offset_bin] += 1
 
-    conn.close()
+def score_sample_matches(index, sample_idx: np.ndarray, song_ids: np.ndarray, db_offsets: np.ndarray, anchor_counts: np.ndarray,
+                         anchor_times: np.ndarray, sample_len: float, start_time: float = None) -> Tuple[str, int, float]:
+    """Scoring half of match_sample_db, for callers that resolved the sample hashes themselves."""
+    if start_time is None:
+        start_time = time.time()
 
     # Scoring
-    best_match_song_id_num = None
-    max_count = 0
-    if not matches:
+    with metrics.stage('scoring'):
+        alignments = score_alignments(sample_idx, song_ids, db_offsets, anchor_counts, anchor_times)
+    return report_match(index, alignments, len(anchor_counts), sample_len, start_time)
+
+
+def report_match(index, alignments: Tuple[int, int, int, int], processed_hashes: int, sample_len: float,
+                 start_time: float) -> Tuple[str, int, float]:
+    """Turns the (best_song_id, max_count, best_song_alignments, total) of a scorer into the match_sample_db result."""
+    best_match_song_id_num, max_count, best_match_alignments, total_matches_found = alignments
+    metrics.count('candidate_alignments', total_matches_found)
+    if best_match_song_id_num is None:
         print(f"No matches found after checking {processed_hashes} sample hashes.")
         match_duration = time.time() - start_time
         print(f"Matching took {match_duration:.2f} seconds.")
-        return None, 0
-
-    for song_id_num, offsets in matches.items():
-        for offset, count in offsets.items():
-            if count > max_count:
-                max_count = count
-                best_match_song_id_num = song_id_num
+        return None, 0, 0.0
 
     match_duration = time.time() - start_time
     print(f"Matching took {match_duration:.2f} seconds. Found {total_matches_found} total hash alignments.")
 
-    best_match_song_name = song_id_to_name.get(best_match_song_id_num, "Unknown ID")
+    best_match_song_name = index.song_names().get(best_match_song_id_num, "Unknown ID")
 
-    hash_count = get_hash_count(db_path, best_match_song_id_num)
-    song_duration = get_song_duration(db_path, best_match_song_id_num)
+    hash_count = index.hash_count(best_match_song_id_num)
+    song_duration = index.song_duration(best_match_song_id_num)
     expected_match_score = hash_count * (sample_len / song_duration)
 
 
     # expected_match_score = get_hash_count(db_path, best_match_song_id_num) * (match_duration / get_song_duration(db_path, best_match_song_id_num))
     confidence = max_count / expected_match_score
-    alignment_confidence = max_count / sum(matches[best_match_song_id_num].values())
+    alignment_confidence = max_count / best_match_alignments
 
 
     print(f"Confidence: {confidence:.2f}")
@@ -162,38 +538,26 @@ def match_sample_db(sample_fingerprints: dict, db_path: str, sample_len: float)
 
     return best_match_song_name, max_count, alignment_confidence
 
-def get_hash_count(db_path: str, song_id: int) -> int:
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT COUNT(*) FROM fingerprints WHERE song_id = ?", (song_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-
-    return count
-
-def get_song_duration(db_path: str, song_id: int) -> float:
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT song_duration FROM songs WHERE song_id = ?", (song_id,))
-    duration = cursor.fetchone()[0]
-    conn.close()
-
-    return duration
-
-
-def get_sample_len() -> float:
-    #TODO: fetch recording length for live recording
-    pass
-
-def endpoint_detection_app(file_path) -> Tuple[str, int]:
-    db_file = 'fingerprints.db'
-    spectrogram, sampling_rate = generate_spectrogram(file_path)
-    peaks = find_peaks(spectrogram, sampling_rate, 25, -40)
-    test_hashes = generate_fingerprints(peaks, 'test')
-    sample_len = get_sample_len()
-    match_name, score, confidence = match_sample_db(test_hashes, db_file, sample_len)
+def get_sample_len(audio_signal: np.ndarray, sampling_rate: int = SAMPLING_RATE) -> float:
+    return len(audio_signal) / sampling_rate
+
+def endpoint_detection_signal(audio_signal: np.ndarray, db_file: str = 'fingerprints.db', sampling_rate: int = SAMPLING_RATE,
+                              progressive: bool = False, margin: float = None) -> Tuple[str, int]:
+    """
+    Recognizes a mono signal that is already in memory, using the front end the database was built with.
+    progressive and margin are passed on to match_sample_db.
+    """
+    index = open_index(db_file)
+    front_end = index.front_end
+    audio_signal = resample_signal(audio_signal, sampling_rate, front_end.sampling_rate)
+    spectrogram = compute_spectrogram(audio_signal, front_end)
+    frames, bins = find_peak_indices(spectrogram, 25, -40)
+    test_hashes = generate_fingerprints(peak_indices_to_peaks(frames, bins, front_end), 'test')
+    sample_len = get_sample_len(audio_signal, front_end.sampling_rate)
+    match_name, score, confidence = match_sample_db(test_hashes, index, sample_len, progressive, margin)
 
     return match_name, score
 
+def endpoint_detection_app(file_path) -> Tuple[str, int]:
+    audio_signal, sampling_rate = load_audio(file_path)
+    return endpoint_detection_signal(audio_signal, sampling_rate=sampling_rate)
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+# FINGERPRINT_METRICS=0 turns every call below into a flag check
+ENABLED = os.environ.get('FINGERPRINT_METRICS', '1') != '0'
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+_NO_STAGE = nullcontext()
+_current_trace = ContextVar('current_trace', default=None)
+_lock = threading.Lock()
+_stage_histograms = {} # stage -> [bucket counts..., +Inf count, sum]
+_counters = {} # name -> total
+_trace_counts = {} # trace name -> number of recorded traces
+
+
+def enable(enabled: bool = True) -> None:
+    global ENABLED
+    ENABLED = enabled
+
+
+class Trace:
+    """Stage timings and counts of one unit of work, e.g. one recognized upload or one ingested song."""
+
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+        self.stages = {} # stage -> seconds
+        self.counts = {}
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, name: str, value: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, other: dict) -> None:
+        """Adds the stages and counts of a trace that was recorded elsewhere, e.g. in a worker process."""
+        if other is None:
+            return
+        for stage, seconds in other['stages'].items():
+            self.add_stage(stage, seconds)
+        for name, value in other['counts'].items():
+            self.add_count(name, value)
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'fields': self.fields, 'stages': self.stages, 'counts': self.counts,
+                'duration': self.duration if self.duration is not None else time.perf_counter() - self.start}
+
+
+@contextmanager
+def trace(name: str, record: bool = True, **fields):
+    """
+    Collects the stages and counts recorded inside the block into a Trace. With record=True the trace is added to
+    the process' metrics and logged on exit, with record=False it is left to the caller, e.g. to send it back
+    from a worker process and record_trace() it there. Yields None while metrics are disabled.
+    """
+    if not ENABLED:
+        yield None
+        return
+    current = Trace(name, **fields)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current.duration = time.perf_counter() - current.start
+        if record:
+            record_trace(current.as_dict())
+
+
+def record_trace(trace_data: dict) -> None:
+    """Adds a finished trace to the metrics and logs it as one JSON line."""
+    if not ENABLED or trace_data is None:
+        return
+    with _lock:
+        _trace_counts[trace_data['name']] = _trace_counts.get(trace_data['name'], 0) + 1
+        for stage, seconds in trace_data['stages'].items():
+            _observe(stage, seconds)
+        for name, value in trace_data['counts'].items():
+            _counters[name] = _counters.get(name, 0) + value
+    print(json.dumps({
+        'event': trace_data['name'],
+        **trace_data['fields'],
+        'duration_ms': round(trace_data['duration'] * 1000, 3),
+        'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in trace_data['stages'].items()},
+        'counts': trace_data['counts'],
+    }, default=str))
+
+
+def record_event(name: str, duration: float, **fields) -> None:
+    """Records and logs a trace without stages, for work that is only timed as a whole."""
+    record_trace({'name': name, 'fields': fields, 'stages': {}, 'counts': {}, 'duration': duration})
+
+
+def _observe(stage: str, seconds: float) -> None:
+    histogram = _stage_histograms.setdefault(stage, [0] * (len(STAGE_BUCKETS) + 2))
+    for i, bucket in enumerate(STAGE_BUCKETS):
+        if seconds <= bucket:
+            histogram[i] += 1
+    histogram[-2] += 1
+    histogram[-1] += seconds
+
+
+@contextmanager
+def _timed_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        current = _current_trace.get()
+        if current is not None:
+            current.add_stage(stage, seconds)
+        else:
+            with _lock:
+                _observe(stage, seconds)
+
+
+def stage(name: str):
+    """Times the block as a stage of the current trace, or of the process if there is none."""
+    return _timed_stage(name) if ENABLED else _NO_STAGE
+
+
+def timed(stage_name: str):
+    """Decorator form of stage()."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _timed_stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: int = 1) -> None:
+    if not ENABLED:
+        return
+    current = _current_trace.get()
+    if current is not None:
+        current.add_count(name, int(value))
+    else:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + int(value)
+
+
+def render_prometheus() -> str:
+    """The metrics of this process in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        lines.append('# HELP fingerprint_stage_seconds Time spent per pipeline stage.')
+        lines.append('# TYPE fingerprint_stage_seconds histogram')
+        for stage_name, histogram in sorted(_stage_histograms.items()):
+            for bucket, bucket_count in zip(STAGE_BUCKETS, histogram):
+                lines.append(f'fingerprint_stage_seconds_bucket{{stage="{stage_name}",le="{bucket}"}} {bucket_count}')
+            lines.append(f'fingerprint_stage_seconds_bucket{{stage="{stage_name}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'fingerprint_stage_seconds_count{{stage="{stage_name}"}} {histogram[-2]}')
+            lines.append(f'fingerprint_stage_seconds_sum{{stage="{stage_name}"}} {histogram[-1]}')
+
+        lines.append('# HELP fingerprint_traces_total Recorded units of work by kind.')
+        lines.append('# TYPE fingerprint_traces_total counter')
+        for trace_name, trace_count in sorted(_trace_counts.items()):
+            lines.append(f'fingerprint_traces_total{{trace="{trace_name}"}} {trace_count}')
+
+        for name, value in sorted(_counters.items()):
+            lines.append(f'# TYPE fingerprint_{name}_total counter')
+            lines.append(f'fingerprint_{name}_total {value}')
+    return '\n'.join(lines) + '\n'
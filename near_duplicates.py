@@ -0,0 +1,226 @@
+import sqlite3
+from typing import Tuple
+
+import numpy as np
+
+from setup import read_shard_paths
+
+MINHASH_SIZE = 64
+LSH_BANDS = 16 # of 4 signature values; songs with a similarity of 0.5 share a band with probability 0.64, at 0.3 with 0.12
+DEDUP_THRESHOLD = 0.5 # estimated Jaccard similarity of the hash sets from which a song counts as a near-duplicate
+MIN_DISTINCT_HASHES = 50 # shorter hash sets give too noisy estimates to be compared
+
+_rng = np.random.default_rng(0x5EED)
+_MINHASH_XOR = _rng.integers(0, 1 << 63, MINHASH_SIZE, dtype=np.uint64)
+_MINHASH_MULTIPLIERS = _rng.integers(0, 1 << 62, MINHASH_SIZE, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_MIX_MULTIPLIER = np.uint64(0xBF58476D1CE4E5B9)
+
+
+def minhash_values(hashes) -> np.ndarray:
+    """(MINHASH_SIZE, len(hashes)) uint32 array of every hash under each of the MINHASH_SIZE hash functions."""
+    values = np.asarray(hashes, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        mixed = (values[None, :] ^ _MINHASH_XOR[:, None]) * _MINHASH_MULTIPLIERS[:, None]
+        mixed ^= mixed >> np.uint64(29)
+        mixed *= _MIX_MULTIPLIER
+    return (mixed >> np.uint64(32)).astype(np.uint32)
+
+
+def minhash_signature(hashes) -> np.ndarray:
+    """MinHash signature of a song's hash set; the fraction of equal values of two signatures estimates their Jaccard similarity."""
+    distinct = np.unique(np.asarray(hashes, dtype=np.int64))
+    if len(distinct) == 0:
+        return np.full(MINHASH_SIZE, np.iinfo(np.uint32).max, dtype=np.uint32)
+    return minhash_values(distinct).min(axis=1)
+
+
+def signature_to_blob(signature: np.ndarray) -> bytes:
+    return signature.astype('<u4').tobytes()
+
+
+def signature_from_blob(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype='<u4').astype(np.uint32)
+
+
+def estimate_similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    return float(np.mean(signature == other))
+
+
+def band_keys(signature: np.ndarray) -> list:
+    rows = MINHASH_SIZE // LSH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(LSH_BANDS)]
+
+
+class NearDuplicateIndex:
+    """
+    LSH buckets over the MinHash signatures of the songs that are indexed in full. Only songs whose signatures
+    share a band are compared, so finding the near-duplicates of a new song doesn't scan the catalog.
+    """
+
+    def __init__(self):
+        self.buckets = {} # (band, band values) -> [song_id]
+        self.signatures = {} # song_id -> signature
+        self.sizes = {} # song_id -> fingerprint rows
+
+    @classmethod
+    def from_db(cls, shard_conns: list) -> 'NearDuplicateIndex':
+        """The songs with a stored signature that are neither flagged nor collapsed duplicates themselves."""
+        index = cls()
+        sizes = {}
+        for conn in shard_conns:
+            for song_id, hash_count in conn.execute("SELECT song_id, hash_count FROM songs"):
+                sizes[song_id] = sizes.get(song_id, 0) + hash_count
+        for song_id, blob in shard_conns[0].execute("SELECT song_id, minhash FROM songs WHERE minhash IS NOT NULL AND duplicate_of IS NULL"):
+            index.add(song_id, signature_from_blob(blob), sizes.get(song_id, 0))
+        return index
+
+    def add(self, song_id: int, signature: np.ndarray, size: int) -> None:
+        self.signatures[song_id] = signature
+        self.sizes[song_id] = size
+        for key in band_keys(signature):
+            self.buckets.setdefault(key, []).append(song_id)
+
+    def remove(self, song_id: int) -> None:
+        signature = self.signatures.pop(song_id, None)
+        self.sizes.pop(song_id, None)
+        if signature is None:
+            return
+        for key in band_keys(signature):
+            self.buckets[key].remove(song_id)
+
+    def find(self, signature: np.ndarray) -> Tuple[int, float]:
+        """(song_id, estimated similarity) of the most similar song sharing a band with signature, or (None, 0.0)."""
+        candidates = {song_id for key in band_keys(signature) for song_id in self.buckets.get(key, ())}
+        best_song_id, best_similarity = None, 0.0
+        for song_id in sorted(candidates):
+            similarity = estimate_similarity(signature, self.signatures[song_id])
+            if similarity > best_similarity:
+                best_song_id, best_similarity = song_id, similarity
+        return best_song_id, best_similarity
+
+
+def check_near_duplicate(near_duplicates: NearDuplicateIndex, hashes: np.ndarray, threshold: float = DEDUP_THRESHOLD,
+                         collapse: bool = False) -> Tuple[np.ndarray, int, float, bool]:
+    """
+    The signature of a new song's hashes, the song it is a near-duplicate of and their similarity (None, 0.0
+    if there is none), and whether it is collapsed into an alias of that song. Only a song that isn't larger
+    than the one it duplicates is collapsed, so the catalog keeps the more complete recording; with a similarity
+    of at least 0.5 that song also holds two thirds or more of the alias' distinct hashes. This finds copies of
+    the same recording, not excerpts: the similarity of an excerpt is at most its share of the song's hashes.
+    """
+    signature = minhash_signature(hashes)
+    if len(np.unique(hashes)) < MIN_DISTINCT_HASHES:
+        return signature, None, 0.0, False
+    duplicate_of, similarity = near_duplicates.find(signature)
+    if similarity < threshold:
+        return signature, None, 0.0, False
+    return signature, duplicate_of, similarity, collapse and len(hashes) <= near_duplicates.sizes[duplicate_of]
+
+
+def set_song_duplicate(conn, song_id: int, signature: np.ndarray, duplicate_of: int, similarity: float, alias_rows: int) -> None:
+    conn.execute("UPDATE songs SET minhash = ?, duplicate_of = ?, duplicate_similarity = ?, alias_rows = ? WHERE song_id = ?",
+                 (signature_to_blob(signature), duplicate_of, similarity if duplicate_of is not None else None, alias_rows, song_id))
+
+
+def release_duplicates(conn, song_id: int) -> int:
+    """
+    Clears the content digests of the songs that were found to duplicate a song that is being replaced, so the
+    next ingestion of their files checks them against the catalog again. Returns their number.
+    """
+    return conn.execute("UPDATE songs SET content_digest = NULL WHERE duplicate_of = ?", (song_id,)).rowcount
+
+
+def stored_signatures(db_path, chunk_size: int = 100_000) -> dict:
+    """
+    { song_id: signature } computed from the fingerprints stored in a database or sharded database, for songs
+    that were ingested without signatures. Signatures of the shards' parts of a song are merged by their minimum.
+    """
+    signatures = {}
+    for shard_path in read_shard_paths(db_path):
+        conn = sqlite3.connect(shard_path)
+        cursor = conn.execute("SELECT song_id, hash_value FROM fingerprints")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            song_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            hashes = np.array([int(row[1]) for row in rows], dtype=np.int64)
+            order = np.argsort(song_ids, kind='stable')
+            chunk_songs, starts = np.unique(song_ids[order], return_index=True)
+            minima = np.minimum.reduceat(minhash_values(hashes[order]), starts, axis=1)
+            for song_id, signature in zip(chunk_songs.tolist(), minima.T):
+                signatures[song_id] = np.minimum(signatures[song_id], signature) if song_id in signatures else signature
+        conn.close()
+    return signatures
+
+
+def near_duplicate_report(db_path, scan: bool = False, threshold: float = DEDUP_THRESHOLD) -> dict:
+    """
+    Counts the flagged and collapsed near-duplicates of a database and estimates what they save. Collapsed aliases
+    saved their fingerprint rows; flagged duplicates would save theirs if they were collapsed. Query work is the
+    mean posting list length a sample hash resolves to, weighting every hash by how often it is stored. Without
+    the aliases, each of a song's postings is assumed to come with a posting per alias, scaled by the alias'
+    size. With scan, signatures are computed from the stored fingerprints and duplicates are found in song id
+    order, for databases that were ingested without deduplication.
+    """
+    shard_paths = read_shard_paths(db_path)
+    catalog = sqlite3.connect(shard_paths[0])
+    columns = {row[1] for row in catalog.execute("PRAGMA table_info(songs)").fetchall()}
+    duplicate_columns = 'duplicate_of, alias_rows' if 'duplicate_of' in columns else 'NULL, NULL' # ingested before deduplication
+    songs = {song_id: {'name': name, 'duplicate_of': duplicate_of, 'alias_rows': alias_rows, 'rows': 0}
+             for song_id, name, duplicate_of, alias_rows
+             in catalog.execute(f"SELECT song_id, song_name, {duplicate_columns} FROM songs")}
+    catalog.close()
+
+    shard_conns = [sqlite3.connect(shard_path) for shard_path in shard_paths]
+    for conn in shard_conns:
+        for song_id, hash_count in conn.execute("SELECT song_id, hash_count FROM songs"):
+            songs[song_id]['rows'] += hash_count
+
+    if scan:
+        near_duplicates = NearDuplicateIndex()
+        signatures = stored_signatures(db_path)
+        for song_id in sorted(signatures):
+            song = songs[song_id]
+            duplicate_of, similarity = near_duplicates.find(signatures[song_id])
+            if song['rows'] >= MIN_DISTINCT_HASHES and similarity >= threshold:
+                song['duplicate_of'] = duplicate_of
+            else:
+                near_duplicates.add(song_id, signatures[song_id], song['rows'])
+
+    # postings a song's hashes would have had without the aliases collapsed into it, per posting it has
+    alias_weights, flagged = {}, set()
+    for song_id, song in songs.items():
+        if song['alias_rows'] is not None:
+            canonical = songs[song['duplicate_of']]
+            alias_weights[song['duplicate_of']] = alias_weights.get(song['duplicate_of'], 0.0) + song['alias_rows'] / max(canonical['rows'], 1)
+        elif song['duplicate_of'] is not None:
+            flagged.add(song_id)
+
+    work = {'stored': [0.0, 0.0], 'without_aliases': [0.0, 0.0], 'flagged_collapsed': [0.0, 0.0]} # [sum n, sum n²]
+    for conn in shard_conns:
+        conn.execute("CREATE TEMP TABLE song_weights (song_id INTEGER PRIMARY KEY, alias_weight REAL, flagged INTEGER)")
+        conn.executemany("INSERT INTO song_weights VALUES (?, ?, ?)",
+                         [(song_id, alias_weights.get(song_id, 0.0), song_id in flagged) for song_id in songs])
+        for stored, without_aliases, unflagged in conn.execute('''
+                SELECT COUNT(*), SUM(1 + w.alias_weight), SUM(1 - w.flagged)
+                FROM fingerprints f JOIN song_weights w ON f.song_id = w.song_id GROUP BY f.hash_value'''):
+            for key, postings in (('stored', stored), ('without_aliases', without_aliases), ('flagged_collapsed', unflagged)):
+                work[key][0] += postings
+                work[key][1] += postings * postings
+        conn.close()
+
+    stored_rows = sum(song['rows'] for song in songs.values())
+    alias_rows = sum(song['alias_rows'] or 0 for song in songs.values())
+    flagged_rows = sum(songs[song_id]['rows'] for song_id in flagged)
+    return {
+        'songs': len(songs),
+        'aliases': sum(song['alias_rows'] is not None for song in songs.values()),
+        'flagged': len(flagged),
+        'stored_rows': stored_rows,
+        'alias_rows_saved': alias_rows,
+        'flagged_rows': flagged_rows,
+        'postings_per_hash': {key: total_sq / total if total else 0.0 for key, (total, total_sq) in work.items()},
+        'duplicates': sorted((song['name'], songs[song['duplicate_of']]['name'], song['alias_rows'] is not None)
+                             for song in songs.values() if song['duplicate_of'] is not None),
+    }
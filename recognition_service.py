@@ -0,0 +1,285 @@
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import numpy as np
+from pydub import AudioSegment
+
+import metrics
+from fingerprint_index import index_version, open_index, lookup_batch
+from fingerprinting import compute_spectrogram, endpoint_detection_signal, find_peak_indices, generate_fingerprints, \
+    get_sample_len, match_sample_db, peak_indices_to_peaks, resample_signal, sample_anchor_arrays, score_sample_matches, \
+    warm_up, SAMPLING_RATE
+
+PEAK_MIN_DISTANCE = 25
+PEAK_MIN_AMPLITUDE_THRESHOLD = -40
+
+_worker_index = None # opened once per worker process by _init_worker
+_worker_match_options = {} # progressive/margin for match_sample_db, set by _init_worker
+
+
+class ServiceSaturated(Exception):
+    def __init__(self, queue_depth: int, capacity: int):
+        super().__init__(f"Recognition queue is full ({queue_depth}/{capacity}).")
+        self.queue_depth = queue_depth
+        self.capacity = capacity
+
+
+def audio_segment_to_signal(audio_segment: AudioSegment, sampling_rate: int = SAMPLING_RATE) -> np.ndarray:
+    """Turns the decoded PCM samples of a pydub segment into a mono float signal at sampling_rate."""
+    samples = np.array(audio_segment.get_array_of_samples(), dtype=np.float32).reshape(-1, audio_segment.channels)
+    samples /= float(1 << (8 * audio_segment.sample_width - 1))
+    return resample_signal(samples, audio_segment.frame_rate, sampling_rate)
+
+
+@metrics.timed('decode')
+def decode_upload(audio_bytes: bytes, sampling_rate: int = SAMPLING_RATE) -> np.ndarray:
+    audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
+    print(f"Pydub loaded audio: {audio_segment.duration_seconds}s, {audio_segment.frame_rate}Hz, {audio_segment.channels}ch")
+    return audio_segment_to_signal(audio_segment, sampling_rate)
+
+
+def _init_worker(db_path, match_options: dict = None, warm_up_pipeline: bool = False) -> None:
+    global _worker_index, _worker_match_options
+    _worker_index = open_index(db_path)
+    _worker_match_options = match_options or {}
+    _worker_index.lookup([0]) # touch the index so the first request doesn't pay for opening it
+    if warm_up_pipeline:
+        print(f"Worker {os.getpid()} warmed up the recognition pipeline in {warm_up(_worker_index.front_end):.2f}s")
+
+
+def _worker_ready() -> int:
+    time.sleep(0.01) # long enough for the other idle workers to pick up the rest of the round
+    return os.getpid()
+
+
+# the worker functions return their metrics trace, so the serving process can record it
+
+def _recognize_upload(audio_bytes: bytes) -> Tuple[Tuple[str, int], dict]:
+    with metrics.trace('recognize', record=False, upload_bytes=len(audio_bytes)) as trace:
+        # decode straight to the rate of the index's front end instead of resampling twice
+        sampling_rate = _worker_index.front_end.sampling_rate
+        result = endpoint_detection_signal(decode_upload(audio_bytes, sampling_rate), _worker_index, sampling_rate,
+                                           **_worker_match_options)
+    return result, trace.as_dict() if trace else None
+
+
+def _fingerprint_signal(audio_bytes: bytes) -> Tuple[dict, float]:
+    front_end = _worker_index.front_end
+    audio_signal = decode_upload(audio_bytes, front_end.sampling_rate)
+    frames, bins = find_peak_indices(compute_spectrogram(audio_signal, front_end), PEAK_MIN_DISTANCE, PEAK_MIN_AMPLITUDE_THRESHOLD)
+    sample_fingerprints = generate_fingerprints(peak_indices_to_peaks(frames, bins, front_end), 'test')
+    return sample_fingerprints, get_sample_len(audio_signal, front_end.sampling_rate)
+
+
+def _fingerprint_upload(audio_bytes: bytes) -> Tuple[dict, float, dict]:
+    with metrics.trace('fingerprint_upload', record=False) as trace:
+        sample_fingerprints, sample_len = _fingerprint_signal(audio_bytes)
+    return sample_fingerprints, sample_len, trace.as_dict() if trace else None
+
+
+def _recognize_upload_cached(audio_bytes: bytes, key_context: str, cached_hash_keys: frozenset) -> Tuple[str, Tuple[str, int], dict]:
+    """
+    Fingerprints and matches an upload in one worker call and returns the cache key of its sample hashes with the
+    result. If that key is among cached_hash_keys the match is skipped and the result is None, the serving
+    process then answers from its ResultCache.
+    """
+    with metrics.trace('recognize_upload', record=False) as trace:
+        sample_fingerprints, sample_len = _fingerprint_signal(audio_bytes)
+        hashes_key = hashes_cache_key(sample_fingerprints.keys(), key_context)
+        result = None
+        if hashes_key not in cached_hash_keys:
+            match_name, score, _ = match_sample_db(sample_fingerprints, _worker_index, sample_len, **_worker_match_options)
+            result = (match_name, score)
+    return hashes_key, result, trace.as_dict() if trace else None
+
+
+def cache_key(kind: str, content: bytes, key_context: str) -> str:
+    digest = hashlib.sha256(content)
+    digest.update(key_context.encode())
+    return f'{kind}:{digest.hexdigest()}'
+
+
+def hashes_cache_key(sample_hashes, key_context: str) -> str:
+    return cache_key('hashes', np.sort(np.fromiter(sample_hashes, dtype=np.int64)).tobytes(), key_context)
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of recognition results with a time to live. Results are stored under two keys: a digest of
+    the upload's bytes, which catches re-sent uploads before they are decoded, and a digest of the sorted sample
+    hashes, which catches the same audio in another encoding after fingerprinting. Both keys include the
+    fingerprinting parameters and the index version (key_context), so ingesting songs invalidates every entry.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float = None, params: dict = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.params = json.dumps(params or {}, sort_keys=True)
+        self.entries = OrderedDict() # key -> (expires, result)
+
+    def key_context(self, version: tuple) -> str:
+        return f'{self.params}{version}'
+
+    def upload_key(self, audio_bytes: bytes, version: tuple) -> str:
+        return cache_key('upload', hashlib.sha256(audio_bytes).digest(), self.key_context(version))
+
+    def live_keys(self, kind: str) -> frozenset:
+        """The unexpired keys of one kind, for workers to check their sample hashes against."""
+        now = time.monotonic()
+        return frozenset(key for key, (expires, _) in self.entries.items()
+                         if key.startswith(f'{kind}:') and (expires is None or expires >= now))
+
+    def get(self, key: str):
+        """The cached result or None, counted as a hit or miss of the key's kind in the metrics."""
+        kind = key.split(':', 1)[0]
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            metrics.count(f'result_cache_{kind}_misses')
+            return None
+        self.entries.move_to_end(key)
+        metrics.count(f'result_cache_{kind}_hits')
+        return entry[1]
+
+    def put(self, key: str, result) -> None:
+        expires = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        self.entries[key] = (expires, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            metrics.count('result_cache_evictions')
+
+
+class LookupBatcher:
+    """Collects the hash lookups of requests arriving within window_seconds and resolves them in one index probe."""
+
+    def __init__(self, index, window_seconds: float):
+        self.index = index
+        self.window_seconds = window_seconds
+        self.pending = [] # [(sample_hashes, future)]
+
+    async def lookup(self, sample_hashes: list):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((sample_hashes, future))
+        if len(self.pending) == 1:
+            # a fresh context keeps the shared lookup out of the metrics trace of the request that started the batch
+            loop.call_later(self.window_seconds, self._flush, context=contextvars.Context())
+        return await future
+
+    def _flush(self) -> None:
+        batch, self.pending = self.pending, []
+        print(f"Resolving hashes of {len(batch)} requests in one lookup")
+        task = asyncio.ensure_future(asyncio.to_thread(lookup_batch, self.index, [sample_hashes for sample_hashes, _ in batch]))
+
+        def distribute(done_task):
+            for i, (_, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if done_task.exception() is not None:
+                    future.set_exception(done_task.exception())
+                else:
+                    future.set_result(done_task.result()[i])
+        task.add_done_callback(distribute)
+
+
+class RecognitionService:
+    """
+    Runs recognition in a bounded process pool so the event loop stays responsive. Requests beyond
+    workers + max_queue are rejected with ServiceSaturated. With batch_window_seconds > 0, workers only
+    fingerprint the audio and the lookups of concurrent requests are grouped by a LookupBatcher.
+    match_options (progressive, margin) are passed to match_sample_db by the workers; batched lookups
+    always resolve every hash, so they don't apply there. With warm_up_pipeline, every worker runs
+    fingerprinting.warm_up before it takes its first request. With cache_entries > 0, results are kept in a
+    ResultCache; a request that misses it is still fingerprinted and matched in one worker call, which skips
+    the match if the cache holds the sample hashes' key.
+    """
+
+    def __init__(self, db_path, workers: int, max_queue: int, batch_window_seconds: float = 0.0, match_options: dict = None,
+                 warm_up_pipeline: bool = False, cache_entries: int = 0, cache_ttl_seconds: float = None):
+        self.db_path = db_path
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.in_flight = 0
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(db_path, match_options, warm_up_pipeline))
+        self.batcher = LookupBatcher(open_index(db_path), batch_window_seconds) if batch_window_seconds > 0 else None
+        cache_params = {'peak_min_dist': PEAK_MIN_DISTANCE, 'peak_min_amp': PEAK_MIN_AMPLITUDE_THRESHOLD, **(match_options or {})}
+        self.cache = ResultCache(cache_entries, cache_ttl_seconds, cache_params) if cache_entries > 0 else None
+
+    def warm_up(self) -> None:
+        """
+        Starts every worker up front and returns once all of them have run their initializer, so none of them
+        opens the index or warms up while serving a request.
+        """
+        ready_workers = set()
+        while len(ready_workers) < self.workers:
+            futures = [self.executor.submit(_worker_ready) for _ in range(self.workers)]
+            ready_workers.update(future.result() for future in futures)
+
+    async def recognize(self, audio_bytes: bytes) -> Tuple[str, int]:
+        if self.in_flight >= self.capacity:
+            raise ServiceSaturated(self.in_flight, self.capacity)
+
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            if self.batcher is None and self.cache is None:
+                result, trace_data = await loop.run_in_executor(self.executor, _recognize_upload, audio_bytes)
+                metrics.record_trace(trace_data)
+                return result
+
+            with metrics.trace('recognize', upload_bytes=len(audio_bytes), batched=self.batcher is not None) as trace:
+                if self.cache is not None:
+                    version = index_version(self.db_path)
+                    upload_key = self.cache.upload_key(audio_bytes, version)
+                    cached = self.cache.get(upload_key)
+                    if cached is not None:
+                        return cached
+
+                if self.batcher is None:
+                    # one worker call fingerprints and matches, the sample hashes never leave the worker
+                    hashes_key, result, worker_trace = await loop.run_in_executor(
+                        self.executor, _recognize_upload_cached, audio_bytes, self.cache.key_context(version), self.cache.live_keys('hashes'))
+                    if trace:
+                        trace.merge(worker_trace)
+                    if result is None:
+                        result = self.cache.get(hashes_key)
+                    else:
+                        metrics.count('result_cache_hashes_misses')
+                    if result is None:
+                        # the entry expired while the worker ran
+                        result, worker_trace = await loop.run_in_executor(self.executor, _recognize_upload, audio_bytes)
+                        if trace:
+                            trace.merge(worker_trace)
+                else:
+                    sample_fingerprints, sample_len, worker_trace = await loop.run_in_executor(self.executor, _fingerprint_upload, audio_bytes)
+                    if trace:
+                        trace.merge(worker_trace)
+                    hashes_key = hashes_cache_key(sample_fingerprints.keys(), self.cache.key_context(version)) if self.cache is not None else None
+                    result = self.cache.get(hashes_key) if self.cache is not None else None
+                    if result is None:
+                        sample_hashes, anchor_counts, anchor_times = sample_anchor_arrays(sample_fingerprints)
+                        sample_idx, song_ids, db_offsets = await self.batcher.lookup(sample_hashes)
+                        match_name, score, _ = await asyncio.to_thread(score_sample_matches, self.batcher.index, sample_idx, song_ids,
+                                                                       db_offsets, anchor_counts, anchor_times, sample_len)
+                        result = (match_name, score)
+
+                if self.cache is not None:
+                    self.cache.put(upload_key, result)
+                    self.cache.put(hashes_key, result)
+            return result
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,238 @@
+import math
+from collections import namedtuple
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+import metrics
+from fingerprinting import SAMPLING_RATE, HOP_LENGTH, DEFAULT_FRONT_END, FrontEnd, find_peak_indices, generate_fingerprint_arrays, \
+    peak_indices_to_peaks
+from streaming import StreamingSpectrogram, stream_audio_blocks
+
+LAG_BIN_SECONDS = 0.1 # the offset bin width of score_alignments
+DIVISOR_FALSE_ALARM = 0.001 # chance that find_repeats replaces a candidate by a divisor the lags don't support
+MAX_LOOP_MULTIPLE = 20 # the frame grid comes back within 1/20 frame of a loop's phase in at most this many iterations
+
+Repeat = namedtuple('Repeat', ['period', 'matches', 'segments']) # segments: [(start, end)] that recur period seconds later
+
+
+def recording_peaks(blocks: Iterable[np.ndarray], peak_min_distance: int = 25, peak_min_amplitude_threshold: int = -40,
+                    max_peaks_per_frame: int = None, front_end: FrontEnd = DEFAULT_FRONT_END,
+                    window_seconds: float = 60.0) -> Tuple[np.ndarray, float]:
+    """
+    (time, freq) peaks of a recording fed as mono signal blocks at front_end.sampling_rate, and its duration.
+    Peaks are picked window by window with the dB scale relative to each window's maximum, as recognize_stream
+    does, and every window gets peak_min_distance frames of context on both sides, so memory stays bounded by
+    one window of STFT frames however long the recording is.
+    """
+    first_bin, last_bin = front_end.bin_range()
+    window_frames = int(round(window_seconds * SAMPLING_RATE / HOP_LENGTH))
+    margin = peak_min_distance
+    stft = StreamingSpectrogram(front_end.fft_size, front_end.hop_length)
+
+    pending = np.empty((last_bin - first_bin, 0), dtype=np.float32)
+    pending_start = 0 # frame index of pending's first frame
+    core_start = 0 # peaks of the frames before this one were already picked
+    all_frames, all_bins = [], []
+
+    def pick(core_end: int) -> None:
+        context_start = max(core_start - margin, pending_start)
+        magnitudes = pending[:, context_start - pending_start:core_end + margin - pending_start]
+        spectrogram = 20 * np.log10(np.maximum(magnitudes, 1e-10) / max(magnitudes.max(), 1e-10))
+        frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+        frames += context_start
+        in_core = (frames >= core_start) & (frames < core_end)
+        all_frames.append(frames[in_core])
+        all_bins.append(bins[in_core])
+
+    def new_frames():
+        for block in blocks:
+            yield stft.push(block)[first_bin:last_bin]
+        yield stft.flush()[first_bin:last_bin]
+
+    for frames in new_frames():
+        pending = np.concatenate((pending, frames), axis=1)
+        while pending_start + pending.shape[1] >= core_start + window_frames + margin:
+            pick(core_start + window_frames)
+            core_start += window_frames
+            drop = core_start - margin - pending_start
+            pending, pending_start = pending[:, drop:], pending_start + drop
+    frame_count = pending_start + pending.shape[1]
+    if core_start < frame_count:
+        pick(frame_count)
+
+    frames, bins = np.concatenate(all_frames), np.concatenate(all_bins)
+    return peak_indices_to_peaks(frames, bins, front_end), frame_count * HOP_LENGTH / SAMPLING_RATE
+
+
+@metrics.timed('self_join')
+def self_join(hashes: np.ndarray, offsets: np.ndarray, min_lag: float = 2.0, successors: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs every hash occurrence with the next `successors` occurrences of the same hash that lie at least min_lag
+    seconds later and returns the (earlier_offsets, lags) arrays of those pairs. Looking only at the nearest later
+    occurrences keeps the join linear in the number of hashes, even for a hash that recurs in every loop of a
+    multi-hour recording, while a period still shows up in the lags of consecutive repeats.
+    """
+    order = np.lexsort((offsets, hashes))
+    sorted_hashes, sorted_offsets = hashes[order], offsets[order]
+    if len(order) == 0:
+        return np.empty(0), np.empty(0)
+
+    # (hash group, offset) as one monotonic key, so the first occurrence min_lag later is one searchsorted away
+    groups = np.concatenate(([0], np.cumsum(sorted_hashes[1:] != sorted_hashes[:-1])))
+    span = float(sorted_offsets.max()) + min_lag + 1.0
+    keys = groups * span + sorted_offsets
+    first = np.searchsorted(keys, keys + min_lag, side='left')
+
+    earlier, lags = [], []
+    for k in range(successors):
+        later = first + k
+        valid = later < len(keys)
+        valid[valid] &= groups[later[valid]] == groups[valid]
+        rows = np.flatnonzero(valid)
+        earlier.append(sorted_offsets[rows])
+        lags.append(sorted_offsets[later[rows]] - sorted_offsets[rows])
+    metrics.count('self_join_pairs', sum(len(lag) for lag in lags))
+    return np.concatenate(earlier), np.concatenate(lags)
+
+
+def lag_segments(earlier: np.ndarray, max_gap: float, min_matches: int) -> List[Tuple[float, float]]:
+    """Splits the sorted earlier offsets of one lag into (start, end) runs without gaps above max_gap seconds."""
+    if len(earlier) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(earlier) > max_gap) + 1
+    starts, ends = np.concatenate(([0], breaks)), np.concatenate((breaks, [len(earlier)]))
+    return [(float(earlier[start]), float(earlier[end - 1])) for start, end in zip(starts, ends) if end - start >= min_matches]
+
+
+def poisson_tail(count: int, expected: float) -> float:
+    """Probability of at least count events where expected are expected."""
+    term = math.exp(-expected)
+    below = 0.0
+    for events in range(count):
+        below += term
+        term *= expected / (events + 1)
+    return max(1.0 - below, 0.0)
+
+
+def is_multiple(lags, periods: List[float], tolerance: float):
+    """Whether each of lags lies within tolerance of a multiple of one of periods."""
+    lags = np.asarray(lags, dtype=np.float64)
+    result = np.zeros(lags.shape, dtype=bool)
+    for period in periods:
+        multiple = np.rint(lags / period)
+        result |= (multiple >= 1) & (np.abs(lags - multiple * period) <= tolerance)
+    return result
+
+
+def find_repeats(hashes: np.ndarray, offsets: np.ndarray, min_period: float = 2.0, min_matches: int = 20,
+                 max_repeats: int = 5, max_gap: float = 2.0, successors: int = 4, min_divisor_matches: int = 3) -> List[Repeat]:
+    """
+    Finds the periods after which parts of a recording recur, from the (hashes, offsets) of its fingerprints.
+    The lags of self_join are histogrammed in LAG_BIN_SECONDS bins like the offset differences of a catalog
+    match; every local maximum with at least min_matches aligned hashes is a candidate. A loop whose period isn't
+    a whole number of frames only aligns its hashes in bulk after the iterations that bring the frame grid back
+    into phase, so a candidate is replaced by its smallest divisor period/k with at least min_divisor_matches
+    aligned hashes at the multiples of period/k that no larger divisor explains, more than the lags around them
+    put there with a probability of DIVISOR_FALSE_ALARM. Periods are ranked by their aligned hashes summed over
+    all their multiples, and a period that is a multiple of a stronger one is dropped as the later loop
+    iterations of it. Returns up to max_repeats Repeats with the refined period, the summed aligned hash count
+    and the segments that recur one period later.
+    """
+    earlier, lags = self_join(hashes, offsets, min_period, successors)
+    if len(lags) == 0:
+        return []
+
+    lag_bins = np.rint(lags / LAG_BIN_SECONDS).astype(np.int64)
+    counts = np.bincount(lag_bins)
+    # lags of one period straddle a bin edge when the frame times don't divide the bin width
+    smoothed = counts + np.concatenate(([0], counts[:-1])) + np.concatenate((counts[1:], [0]))
+    is_peak = (smoothed >= min_matches) & (smoothed >= np.concatenate(([0], smoothed[:-1]))) & \
+              (smoothed > np.concatenate((smoothed[1:], [0])))
+    candidates = np.flatnonzero(is_peak)
+    candidates = candidates[np.argsort(-smoothed[candidates], kind='stable')]
+    # centre every candidate on its strongest bin, a flat top of the smoothed histogram would shift it by one
+    padded = np.concatenate(([0], counts, [0]))
+    candidates = candidates - 1 + np.argmax(np.stack((padded[candidates], padded[candidates + 1], padded[candidates + 2])), axis=0)
+
+    sorted_lags = np.sort(lags)
+    max_lag = float(sorted_lags[-1])
+    tolerance = LAG_BIN_SECONDS / 2
+
+    def multiples(period: float) -> np.ndarray:
+        return period * np.arange(1, int(max_lag / period) + 1)
+
+    def aligned(centres: np.ndarray, width: float) -> np.ndarray:
+        return np.searchsorted(sorted_lags, centres + width, side='right') - np.searchsorted(sorted_lags, centres - width, side='left')
+
+    candidate_lags = np.sort(candidates) * LAG_BIN_SECONDS
+
+    def near_candidate(centres: np.ndarray) -> np.ndarray:
+        nearest = np.clip(np.searchsorted(candidate_lags, centres), 1, len(candidate_lags) - 1)
+        return np.minimum(np.abs(centres - candidate_lags[nearest - 1]), np.abs(centres - candidate_lags[nearest])) <= 2 * LAG_BIN_SECONDS
+
+    periods = []
+    for lag_bin in candidates.tolist():
+        if lag_bin < 1 or is_multiple(lag_bin * LAG_BIN_SECONDS, periods, LAG_BIN_SECONDS):
+            continue
+        period = float(np.median(lags[np.abs(lag_bins - lag_bin) <= 1]))
+        divisors = min(int(period / min_period), MAX_LOOP_MULTIPLE)
+        for k in range(divisors, 1, -1):
+            # multiples of period/k that share a factor with k are multiples of a larger divisor or of period, and a peak
+            # of its own is scored on its own
+            divisor_multiples = multiples(period / k)
+            divisor_multiples = divisor_multiples[(np.gcd(np.arange(1, len(divisor_multiples) + 1), k) == 1) &
+                                                  ~near_candidate(divisor_multiples) & ~is_multiple(divisor_multiples, periods, 2 * tolerance)]
+            matches = int(aligned(divisor_multiples, tolerance).sum())
+            # what the lags within a second around the windows put into windows of their width by chance
+            surrounding = int(aligned(divisor_multiples, 1.0).sum()) - matches
+            expected = surrounding * tolerance / (1.0 - tolerance)
+            if matches >= min_divisor_matches and poisson_tail(matches, expected) <= DIVISOR_FALSE_ALARM / divisors:
+                period /= k
+                break
+        periods.append(period)
+
+    repeats = []
+    for matches, period in sorted(((int(aligned(multiples(period), LAG_BIN_SECONDS).sum()), period) for period in periods), reverse=True):
+        if is_multiple(period, [repeat.period for repeat in repeats], LAG_BIN_SECONDS):
+            continue
+        # hashes that recur m periods later start m consecutive stretches that recur one period later
+        starts = [(earlier[np.abs(lags - lag) <= LAG_BIN_SECONDS, None] + period * np.arange(multiple)).ravel()
+                  for multiple, lag in enumerate(multiples(period), 1)]
+        segments = lag_segments(np.sort(np.concatenate(starts)), max_gap, min_matches)
+        if not segments:
+            continue
+        repeats.append(Repeat(period, matches, segments))
+        if len(repeats) == max_repeats:
+            break
+    return repeats
+
+
+def loop_coverage(repeat: Repeat, duration: float) -> float:
+    """Fraction of a recording that lies in one of the repeat's segments or in their recurrences."""
+    if duration <= 0:
+        return 0.0
+    covered = sorted((start, end + repeat.period) for start, end in repeat.segments)
+    total, current_start, current_end = 0.0, None, None
+    for start, end in covered:
+        if current_end is None or start > current_end:
+            total += 0.0 if current_end is None else current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    total += current_end - current_start
+    return min(total / duration, 1.0)
+
+
+def detect_repeats(path: str, peak_min_distance: int = 25, peak_min_amplitude_threshold: int = -40, max_peaks_per_frame: int = None,
+                   front_end: FrontEnd = DEFAULT_FRONT_END, **repeat_options) -> Tuple[List[Repeat], float]:
+    """
+    Streams a recording of any length, fingerprints it once and returns its Repeats (see find_repeats) and its
+    duration, without a fingerprint database.
+    """
+    with metrics.trace('detect_repeats', recording=str(path)):
+        peaks, duration = recording_peaks(stream_audio_blocks(path, sampling_rate=front_end.sampling_rate), peak_min_distance,
+                                          peak_min_amplitude_threshold, max_peaks_per_frame, front_end)
+        hashes, offsets = generate_fingerprint_arrays(peaks)
+        repeats = find_repeats(hashes, offsets, **repeat_options)
+    return repeats, duration
@@ -1,41 +1,240 @@
+import argparse
+import json
+import os
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
+
+import metrics
+from feature_cache import FeatureCache, file_digest
 from fingerprinting import *
 from pathlib import Path
-from pydub.exceptions import CouldntDecodeError
-from pydub import AudioSegment
+from fingerprint_index import build_compressed_index, build_sharded_mmap_index, read_front_end
+from near_duplicates import DEDUP_THRESHOLD, NearDuplicateIndex, check_near_duplicate, minhash_signature, release_duplicates, \
+    set_song_duplicate
+from setup import add_missing_song_columns, create_hash_index, create_settings_table, create_song_index, has_songs_table, \
+    is_clustered, is_sharded, read_shard_paths, set_setting, setup_db, setup_sharded_db
+
+
+def fingerprint_song(path: Path, peak_min_distance: int, peak_min_amplitude_threshold: int, feature_cache: FeatureCache = None,
+                     max_peaks_per_frame: int = None, front_end: FrontEnd = DEFAULT_FRONT_END):
+    """
+    Decode → STFT → peaks → hashes for one file, reusing cached spectrograms/peaks if a feature_cache is given.
+    Returns (path, None) if the file can't be decoded.
+    """
+    try:
+        if feature_cache is not None:
+            peaks, duration = feature_cache.load_peaks(path, peak_min_distance, peak_min_amplitude_threshold,
+                                                       max_peaks_per_frame=max_peaks_per_frame, front_end=front_end)
+        else:
+            audio_signal, sampling_rate = load_audio(str(path), sampling_rate=front_end.sampling_rate)
+            duration = len(audio_signal) / sampling_rate
+            spectrogram = compute_spectrogram(audio_signal, front_end)
+            frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+            peaks = peak_indices_to_peaks(frames, bins, front_end)
+    except Exception as decode_err:
+        print(f"Could not decode {path}: {decode_err}")
+        return path, None
+
+    hashes, offsets = generate_fingerprint_arrays(peaks)
+    return path, (duration, hashes, offsets)
+
+
+def traced_fingerprint_song(path: Path, **kwargs):
+    """fingerprint_song that also returns the metrics trace of the worker it ran in."""
+    with metrics.trace('fingerprint_song', record=False) as trace:
+        path, fingerprint_result = fingerprint_song(path, **kwargs)
+    return path, fingerprint_result, trace.as_dict() if trace else None
+
+
+def fingerprint_params_key(exp) -> str:
+    return json.dumps({**exp["fingerprinting"], "sampling_rate": SAMPLING_RATE, "hop_length": HOP_LENGTH}, sort_keys=True)
+
+
+def find_changed_songs(conn, paths: list, fingerprint_params: str) -> dict:
+    """
+    Returns { path: (content_digest, file_mtime) } for the files that are new or changed since they were indexed.
+    Files with an unchanged mtime are skipped without being read, files that were only touched get their mtime updated.
+    """
+    indexed_songs = {song_name: (content_digest, file_mtime, params) for song_name, content_digest, file_mtime, params
+                     in conn.execute("SELECT song_name, content_digest, file_mtime, fingerprint_params FROM songs")}
+    changed_songs = {}
+    for path in paths:
+        file_mtime = path.stat().st_mtime
+        indexed_digest, indexed_mtime, indexed_params = indexed_songs.get(path.name, (None, None, None))
+        if indexed_digest is not None and indexed_params == fingerprint_params and indexed_mtime == file_mtime:
+            continue
+
+        content_digest = file_digest(path)
+        if content_digest == indexed_digest and indexed_params == fingerprint_params:
+            conn.execute("UPDATE songs SET file_mtime = ? WHERE song_name = ?", (file_mtime, path.name))
+            continue
+        changed_songs[path] = (content_digest, file_mtime)
+    conn.commit()
+    return changed_songs
 
 
-def add_songs_from_folder_to_db(db_path, song_folder, exp) -> int:
-    song_names = [f.name for f in song_folder.iterdir() if f.is_file()]
-    conn = sqlite3.connect(db_path)
+def commit_shards(shard_conns: list) -> None:
+    """Commits the catalog in the first shard last, see add_fingerprint_arrays_to_shards."""
+    for shard_conn in reversed(shard_conns):
+        shard_conn.commit()
+
+
+def add_songs_to_db(db_path, paths: list, exp, workers: int = 1, commit_every: int = 100, feature_cache: FeatureCache = None,
+                    dedup: str = None, dedup_threshold: float = DEDUP_THRESHOLD) -> int:
+    """
+    Fingerprints the new and changed files among paths and writes them to the database. With workers > 1 the
+    files are processed by a process pool while this process stays the only writer, committing every commit_every
+    songs with WAL and synchronous=NORMAL, and the hash index is rebuilt once after the load.
+    A song's fingerprints and content digest are always committed together, so an interrupted run picks up
+    where it stopped. With a feature_cache, spectrograms and peaks are shared with other runs.
+    db_path may also be a sharded database directory; every song is then written to all of its shards.
+    Every song's MinHash signature is stored with it. With dedup='flag', songs whose hash sets are near-duplicates
+    of an indexed song are marked with songs.duplicate_of; with dedup='collapse', such a song that isn't larger
+    than the indexed one becomes an alias entry without fingerprints, which queries find as the indexed song.
+    """
+    front_end = FrontEnd.from_config(exp["fingerprinting"])
+    fingerprint = partial(traced_fingerprint_song,
+                          peak_min_distance=exp["fingerprinting"]["peak_min_dist"],
+                          peak_min_amplitude_threshold=exp["fingerprinting"]["peak_min_amp"],
+                          feature_cache=feature_cache,
+                          max_peaks_per_frame=exp["fingerprinting"].get("max_peaks_per_frame"),
+                          front_end=front_end)
+    ingest_start = time.perf_counter()
+    shard_conns = [sqlite3.connect(shard_path) for shard_path in read_shard_paths(db_path)]
+    conn = shard_conns[0] # holds the catalog of a sharded database
+    for shard_conn in shard_conns:
+        add_missing_song_columns(shard_conn.cursor())
+        create_settings_table(shard_conn.cursor())
+        create_song_index(shard_conn.cursor()) # databases from before the index
+    if read_front_end(conn) != front_end:
+        # songs fingerprinted with another front end can't be matched together; their changed
+        # fingerprint_params make find_changed_songs re-index all of them below
+        print(f"Switching {db_path} to front end {front_end.to_json()}")
+    for shard_conn in shard_conns:
+        set_setting(shard_conn, 'front_end', front_end.to_json())
+    commit_shards(shard_conns)
     corrupt_files_counter = 0
 
-    for song_name in song_names:
-        try:
-            path = song_folder / song_name
-            duration = len(AudioSegment.from_file(str(path))) / 1000
-
-            song_id = add_song_to_db(conn, song_name, path, duration)
-            if song_id:
-                spectrogram, sampling_rate = generate_spectrogram(path)
-
-                peak_min_distance = exp["fingerprinting"]["peak_min_dist"]
-                peak_min_amplitude_threshold = exp["fingerprinting"]["peak_min_amp"]
-                
-                peaks = find_peaks(spectrogram, sampling_rate, peak_min_distance, peak_min_amplitude_threshold)
-                song_hashes = generate_fingerprints(peaks,song_name)
-                add_fingerprints_to_db(conn, song_id, song_hashes)
-        except CouldntDecodeError:
-            corrupt_files_counter += 1
-   
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM fingerprints")
-    fingerprints_count = cursor.fetchone()[0]
-    conn.close()
+    near_duplicates = NearDuplicateIndex.from_db(shard_conns) if dedup else None
+    duplicate_counter = 0
+
+    fingerprint_params = fingerprint_params_key(exp)
+    changed_songs = find_changed_songs(conn, paths, fingerprint_params)
+    print(f"{len(changed_songs)} of {len(paths)} files are new or changed.")
+
+    bulk = workers > 1 and len(changed_songs) > 1
+    defer_index = bulk and not is_clustered(conn)
+    for shard_conn in shard_conns:
+        if bulk:
+            shard_conn.execute("PRAGMA journal_mode = WAL")
+            shard_conn.execute("PRAGMA synchronous = NORMAL")
+        if defer_index:
+            shard_conn.execute("DROP INDEX IF EXISTS idx_hash_value")
+
+    try:
+        with Pool(workers) if bulk else nullcontext() as pool:
+            results = pool.imap(fingerprint, changed_songs, chunksize=4) if bulk else map(fingerprint, changed_songs)
+            for song_count, (path, fingerprint_result, worker_trace) in enumerate(results, start=1):
+                if fingerprint_result is None:
+                    corrupt_files_counter += 1
+                    metrics.count('corrupt_files')
+                    continue
+                duration, hashes, offsets = fingerprint_result
+                content_digest, file_mtime = changed_songs[path]
+
+                with metrics.trace('ingest_song', song=path.name) as trace:
+                    if trace:
+                        trace.merge(worker_trace)
+                    song_id = replace_song_in_shards(shard_conns, path.name, path, duration, content_digest, file_mtime, fingerprint_params)
+                    if near_duplicates is not None:
+                        near_duplicates.remove(song_id) # a changed song isn't compared with its old version
+                        if sum(release_duplicates(shard_conn, song_id) for shard_conn in shard_conns):
+                            print(f"Near-duplicates of '{path.name}' will be checked again when their files are next ingested")
+                    with metrics.stage('dedup'):
+                        if near_duplicates is not None:
+                            signature, duplicate_of, similarity, collapse = check_near_duplicate(near_duplicates, hashes, dedup_threshold,
+                                                                                                 dedup == 'collapse')
+                        else:
+                            signature, duplicate_of, similarity, collapse = minhash_signature(hashes), None, 0.0, False
+                    for shard_conn in shard_conns:
+                        set_song_duplicate(shard_conn, song_id, signature, duplicate_of, similarity, len(hashes) if collapse else None)
+                    if duplicate_of is not None:
+                        duplicate_counter += 1
+                        metrics.count('near_duplicates_collapsed' if collapse else 'near_duplicates_flagged')
+                        print(f"'{path.name}' is a near-duplicate of song ID {duplicate_of} (similarity {similarity:.2f})"
+                              f"{', stored as an alias' if collapse else ''}")
+                    if not collapse:
+                        add_fingerprint_arrays_to_shards(shard_conns, song_id, hashes, offsets, commit=False)
+                    if near_duplicates is not None and duplicate_of is None:
+                        near_duplicates.add(song_id, signature, len(hashes))
+                if not bulk or song_count % commit_every == 0:
+                    commit_shards(shard_conns)
+        commit_shards(shard_conns)
+    except BaseException:
+        # never commit a song whose fingerprints were only partly written
+        for shard_conn in shard_conns:
+            shard_conn.rollback()
+        raise
+    finally:
+        if defer_index:
+            print("Creating hash index...")
+            for shard_conn in shard_conns:
+                create_hash_index(shard_conn.cursor())
+                shard_conn.commit()
+
+    if corrupt_files_counter:
+        print(f"Skipped {corrupt_files_counter} files that could not be decoded.")
+    if duplicate_counter:
+        print(f"Found {duplicate_counter} near-duplicates of indexed songs.")
+
+    fingerprints_count = 0
+    for shard_conn in shard_conns:
+        fingerprints_count += shard_conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        shard_conn.close()
+    metrics.record_event('ingest', time.perf_counter() - ingest_start, db=db_path, files=len(paths), changed=len(changed_songs),
+                         corrupt=corrupt_files_counter, fingerprints_in_db=fingerprints_count)
     return fingerprints_count
 
 
+def add_songs_from_folder_to_db(db_path, song_folder, exp, workers: int = 1, feature_cache: FeatureCache = None,
+                                dedup: str = None, dedup_threshold: float = DEDUP_THRESHOLD) -> int:
+    paths = sorted(f for f in Path(song_folder).iterdir() if f.is_file())
+    return add_songs_to_db(db_path, paths, exp, workers, feature_cache=feature_cache, dedup=dedup, dedup_threshold=dedup_threshold)
+
+
 if __name__ == '__main__':
-    song_folder = Path(__file__).parent.parent.parent / 'test_files_path'
-    db_path = Path(__file__).parent.parent / 'test_database.db'
+    parser = argparse.ArgumentParser(description="Fingerprint all files in a folder and add them to a database.")
+    parser.add_argument('song_folder', type=Path)
+    parser.add_argument('db_path', type=Path)
+    parser.add_argument('--peak-min-dist', type=int, default=25)
+    parser.add_argument('--peak-min-amp', type=int, default=-40)
+    parser.add_argument('--max-peaks-per-frame', type=int, default=None, help="keep only the loudest peaks of each STFT frame")
+    parser.add_argument('--decimation', type=int, default=None, help="compute the STFT at a sampling rate divided by this factor")
+    parser.add_argument('--min-freq', type=float, default=None, help="lowest frequency in Hz that peaks are picked from")
+    parser.add_argument('--max-freq', type=float, default=None, help="highest frequency in Hz that peaks are picked from")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache-dir', type=Path, default=None, help="reuse spectrograms and peaks cached in this directory")
+    parser.add_argument('--shards', type=int, default=None, help="create db_path as a directory of this many hash-partitioned shards")
+    parser.add_argument('--dedup', choices=['flag', 'collapse'], default=None,
+                        help="mark near-duplicates of indexed songs, or store them as aliases without fingerprints")
+    parser.add_argument('--dedup-threshold', type=float, default=DEDUP_THRESHOLD, help="estimated Jaccard similarity of a near-duplicate")
+    parser.add_argument('--compressed-index', type=Path, default=None, help="rebuild a compressed posting list index in this directory afterwards")
+    args = parser.parse_args()
+
+    if args.shards and not is_sharded(args.db_path):
+        setup_sharded_db(args.db_path, args.shards)
+    elif not is_sharded(args.db_path) and not has_songs_table(args.db_path):
+        setup_db(args.db_path)
 
-    add_songs_from_folder_to_db()
+    exp = {"fingerprinting": {"peak_min_dist": args.peak_min_dist, "peak_min_amp": args.peak_min_amp}}
+    for option in ('max_peaks_per_frame', 'decimation', 'min_freq', 'max_freq'):
+        if getattr(args, option) is not None:
+            exp["fingerprinting"][option] = getattr(args, option)
+    feature_cache = FeatureCache(args.cache_dir) if args.cache_dir else None
+    add_songs_from_folder_to_db(args.db_path, args.song_folder, exp, args.workers, feature_cache, args.dedup, args.dedup_threshold)
+    if args.compressed_index:
+        if is_sharded(args.db_path):
+            build_sharded_mmap_index(args.db_path, args.compressed_index, compressed=True)
+        else:
+            build_compressed_index(args.db_path, args.compressed_index)
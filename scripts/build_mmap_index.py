@@ -0,0 +1,19 @@
+import argparse
+
+from fingerprint_index import build_compressed_index, build_mmap_index, build_sharded_mmap_index
+from setup import is_sharded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a memory-mapped inverted index from a fingerprint database.")
+    parser.add_argument('db_path')
+    parser.add_argument('index_dir')
+    parser.add_argument('--compressed', action='store_true', help="store the postings as delta encoded varints")
+    args = parser.parse_args()
+
+    if is_sharded(args.db_path):
+        build_sharded_mmap_index(args.db_path, args.index_dir, compressed=args.compressed)
+    elif args.compressed:
+        build_compressed_index(args.db_path, args.index_dir)
+    else:
+        build_mmap_index(args.db_path, args.index_dir)
@@ -0,0 +1,32 @@
+import argparse
+
+from fingerprint_index import FrontEnd
+from repeat_detection import detect_repeats, loop_coverage
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the periods after which parts of a long recording repeat, e.g. a looped lure.")
+    parser.add_argument('recording')
+    parser.add_argument('--min-period', type=float, default=2.0, help="shortest repeat period in seconds")
+    parser.add_argument('--min-matches', type=int, default=20, help="aligned hashes a period and each of its segments need")
+    parser.add_argument('--max-repeats', type=int, default=5)
+    parser.add_argument('--max-gap', type=float, default=2.0, help="longest gap in seconds inside one repeated segment")
+    parser.add_argument('--loop-coverage', type=float, default=0.5, help="fraction of the recording a period must cover to be flagged as a loop")
+    parser.add_argument('--peak-min-dist', type=int, default=25)
+    parser.add_argument('--peak-min-amp', type=int, default=-40)
+    parser.add_argument('--max-peaks-per-frame', type=int, default=None)
+    parser.add_argument('--decimation', type=int, default=None, help="compute the STFT at a sampling rate divided by this factor")
+    args = parser.parse_args()
+
+    front_end = FrontEnd.from_config({'decimation': args.decimation})
+    repeats, duration = detect_repeats(args.recording, args.peak_min_dist, args.peak_min_amp, args.max_peaks_per_frame, front_end,
+                                       min_period=args.min_period, min_matches=args.min_matches, max_repeats=args.max_repeats,
+                                       max_gap=args.max_gap)
+    if not repeats:
+        print(f"No repeats in {duration:.1f}s of audio.")
+    for repeat in repeats:
+        coverage = loop_coverage(repeat, duration)
+        flag = '  LOOP' if coverage >= args.loop_coverage else ''
+        print(f"period {repeat.period:8.2f}s  {repeat.matches} aligned hashes  covers {coverage:.0%}{flag}")
+        for start, end in repeat.segments:
+            print(f"    {start:9.2f}s - {end:9.2f}s  recurs at {start + repeat.period:9.2f}s - {end + repeat.period:9.2f}s")
@@ -0,0 +1,13 @@
+import argparse
+
+from setup import migrate_db
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert fingerprint databases in place to the compact version 2 schema.")
+    parser.add_argument('db_paths', nargs='+')
+    parser.add_argument('--clustered', action='store_true', help="store fingerprints in a WITHOUT ROWID table clustered on (hash_value, song_id, offset)")
+    args = parser.parse_args()
+
+    for db_path in args.db_paths:
+        migrate_db(db_path, clustered=args.clustered)
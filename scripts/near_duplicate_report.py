@@ -0,0 +1,26 @@
+import argparse
+
+from near_duplicates import DEDUP_THRESHOLD, near_duplicate_report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the near-duplicate songs of a database and the index size and query work they save.")
+    parser.add_argument('db_path', help="fingerprint database or sharded database directory")
+    parser.add_argument('--scan', action='store_true', help="find near-duplicates from the stored fingerprints, e.g. of a database ingested without --dedup")
+    parser.add_argument('--threshold', type=float, default=DEDUP_THRESHOLD, help="estimated Jaccard similarity of a near-duplicate, with --scan")
+    parser.add_argument('--list', action='store_true', help="list every near-duplicate and the song it duplicates")
+    args = parser.parse_args()
+
+    report = near_duplicate_report(args.db_path, args.scan, args.threshold)
+    work = report['postings_per_hash']
+    total_rows = report['stored_rows'] + report['alias_rows_saved']
+    print(f"{report['songs']} songs: {report['aliases']} collapsed into aliases, {report['flagged']} flagged as near-duplicates")
+    print(f"fingerprint rows: {report['stored_rows']} stored, {report['alias_rows_saved']} saved by aliases "
+          f"({report['alias_rows_saved'] / max(total_rows, 1):.1%} of the index without them)")
+    print(f"postings per sample hash: {work['stored']:.2f} now, {work['without_aliases']:.2f} without aliases")
+    if report['flagged']:
+        print(f"collapsing the flagged near-duplicates would save {report['flagged_rows']} more rows "
+              f"({report['flagged_rows'] / max(report['stored_rows'], 1):.1%}) and cut postings per sample hash to {work['flagged_collapsed']:.2f}")
+    if args.list:
+        for song_name, duplicate_of, is_alias in report['duplicates']:
+            print(f"    {song_name} -> {duplicate_of}{' (alias)' if is_alias else ''}")
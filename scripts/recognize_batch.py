@@ -0,0 +1,32 @@
+import argparse
+import os
+import sys
+
+from batch_recognition import recognize_batch, write_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recognize a clip of every file of a directory or manifest with a pool of workers.")
+    parser.add_argument('source', help="directory of audio files, CSV manifest (path, start_time, expected) or text file of paths")
+    parser.add_argument('db_path', help="fingerprint database, sharded database or memory-mapped index directory")
+    parser.add_argument('--out', default=None, help="results file, .csv or .jsonl; JSONL on stdout if omitted")
+    parser.add_argument('--clip-len', type=float, default=None, help="clip length in seconds, whole files if omitted")
+    parser.add_argument('--seed', type=int, default=42, help="seed of the clip positions of files without a start_time")
+    parser.add_argument('--min-score', type=int, default=250, help="score a match needs to count as recognized")
+    parser.add_argument('--peak-min-dist', type=int, default=25)
+    parser.add_argument('--peak-min-amp', type=int, default=-40)
+    parser.add_argument('--max-peaks-per-frame', type=int, default=None)
+    parser.add_argument('--progressive', action='store_true', help="match with the rarest-first, early stopping matcher")
+    parser.add_argument('--margin', type=float, default=None, help="leader/runner-up ratio that ends a progressive match early")
+    parser.add_argument('--detect-loops', action='store_true', help="also report the repeat period of every file from a self-join of its fingerprints")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--verbose', action='store_true', help="keep the progress output of the workers")
+    args = parser.parse_args()
+
+    results = recognize_batch(args.source, args.db_path, args.workers, args.clip_len, args.seed, args.peak_min_dist,
+                              args.peak_min_amp, args.max_peaks_per_frame, args.min_score, args.progressive, args.margin,
+                              args.detect_loops, args.verbose)
+    summary = write_results(results, args.out, args.min_score)
+    accuracy = f", {summary['correct']}/{summary['with_expected']} correct" if summary['with_expected'] else ''
+    print(f"{summary['clips']} clips in {summary['seconds']:.1f}s ({summary['clips'] / max(summary['seconds'], 1e-9):.1f} clips/s): "
+          f"{summary['matched']} matched, {summary['errors']} failed{accuracy}", file=sys.stderr)
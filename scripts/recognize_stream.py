@@ -0,0 +1,20 @@
+import argparse
+
+from streaming import recognize_stream
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scan a long recording with a sliding window and print detections as they are found.")
+    parser.add_argument('recording')
+    parser.add_argument('db_path', help="fingerprint database or memory-mapped index directory")
+    parser.add_argument('--window', type=float, default=10.0, help="window length in seconds")
+    parser.add_argument('--step', type=float, default=5.0, help="step between windows in seconds")
+    parser.add_argument('--min-score', type=int, default=250)
+    parser.add_argument('--peak-min-dist', type=int, default=25)
+    parser.add_argument('--peak-min-amp', type=int, default=-40)
+    parser.add_argument('--max-peaks-per-frame', type=int, default=None)
+    args = parser.parse_args()
+
+    for detection in recognize_stream(args.recording, args.db_path, args.window, args.step,
+                                      args.peak_min_dist, args.peak_min_amp, args.min_score, args.max_peaks_per_frame):
+        print(f"{detection.start:9.2f}s - {detection.end:9.2f}s  {detection.song}  score={detection.score}  alignment={detection.confidence:.2f}")
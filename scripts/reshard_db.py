@@ -0,0 +1,14 @@
+import argparse
+
+from setup import reshard_db
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy a fingerprint database or sharded database into a new set of hash-partitioned shards.")
+    parser.add_argument('source', help="database file or sharded database directory")
+    parser.add_argument('target_dir', help="new, empty directory for the shards")
+    parser.add_argument('--shards', type=int, required=True)
+    parser.add_argument('--clustered', action='store_true', help="store fingerprints in a WITHOUT ROWID table clustered on (hash_value, song_id, offset)")
+    args = parser.parse_args()
+
+    reshard_db(args.source, args.target_dir, args.shards, clustered=args.clustered)
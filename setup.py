@@ -1,6 +1,174 @@
+import json
 import sqlite3
+from pathlib import Path
 
-def setup_db(db_name):
+import numpy as np
+
+SCHEMA_VERSION = 2 # 1: TEXT hash / REAL offset in seconds, 2: INTEGER hash / INTEGER offset in STFT frames
+
+
+def get_schema_version(conn) -> int:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    return version if version else 1
+
+
+def is_clustered(conn) -> bool:
+    """True if fingerprints is a WITHOUT ROWID table clustered on (hash_value, song_id, offset)."""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'fingerprints'").fetchone()
+    return row is not None and 'WITHOUT ROWID' in row[0].upper()
+
+
+def create_fingerprints_table(cursor, table_name: str, schema_version: int, clustered: bool) -> None:
+    if schema_version == 1:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                hash_value TEXT NOT NULL,
+                song_id INTEGER NOT NULL,
+                offset REAL NOT NULL, -- Store time in seconds
+                FOREIGN KEY (song_id) REFERENCES songs (song_id)
+            )
+        ''')
+    elif clustered:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                hash_value INTEGER NOT NULL,
+                song_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL, -- STFT frame number
+                PRIMARY KEY (hash_value, song_id, offset),
+                FOREIGN KEY (song_id) REFERENCES songs (song_id)
+            ) WITHOUT ROWID
+        ''')
+    else:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                hash_value INTEGER NOT NULL,
+                song_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL, -- STFT frame number
+                FOREIGN KEY (song_id) REFERENCES songs (song_id)
+            )
+        ''')
+
+
+# columns added to songs after the initial schema
+SONG_EXTRA_COLUMNS = {
+    'content_digest': 'TEXT', # sha256 of the audio file, set by incremental ingestion
+    'file_mtime': 'REAL',
+    'fingerprint_params': 'TEXT', # JSON of the parameters the fingerprints were generated with
+    'hash_count': 'INTEGER NOT NULL DEFAULT 0', # number of fingerprint rows of the song, kept up to date at ingest
+    'minhash': 'BLOB', # MinHash signature of the song's hash set, see near_duplicates
+    'duplicate_of': 'INTEGER', # song whose hash set this song's nearly equals
+    'duplicate_similarity': 'REAL', # estimated Jaccard similarity to duplicate_of
+    'alias_rows': 'INTEGER', # set for a duplicate collapsed into an alias: the fingerprint rows that weren't written
+}
+
+
+def add_missing_song_columns(cursor) -> None:
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(songs)").fetchall()}
+    for column, column_type in SONG_EXTRA_COLUMNS.items():
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE songs ADD COLUMN {column} {column_type}")
+
+    if 'hash_count' not in existing_columns and cursor.execute("SELECT name FROM sqlite_master WHERE name = 'fingerprints'").fetchone():
+        hash_counts = cursor.execute("SELECT song_id, COUNT(*) FROM fingerprints GROUP BY song_id").fetchall()
+        cursor.executemany("UPDATE songs SET hash_count = ? WHERE song_id = ?", [(count, song_id) for song_id, count in hash_counts])
+
+
+def create_settings_table(cursor) -> None:
+    """Key/value table for parameters that every song in the database has to share, e.g. the STFT front end."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+
+def get_setting(conn, key: str, default: str = None) -> str:
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return default # database from before the settings table
+    return row[0] if row else default
+
+
+def set_setting(conn, key: str, value: str) -> None:
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+
+def create_hash_index(cursor) -> None:
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_hash_value ON fingerprints (hash_value)
+    ''')
+
+
+def create_song_index(cursor) -> None:
+    """Lets replace_song_in_db delete a changed song's fingerprints without scanning the whole table."""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_song_id ON fingerprints (song_id)
+    ''')
+
+
+SHARDS_FILE = 'shards.json' # marks a directory of hash-partitioned shards and lists their files in shard order
+_SHARD_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15) # spreads the packed hashes, whose low bits are only the time delta
+
+
+def shard_of(hashes, shard_count: int) -> np.ndarray:
+    """Shard number of every hash. All fingerprints with the same hash live in the same shard."""
+    mixed = np.asarray(hashes, dtype=np.int64).astype(np.uint64) * _SHARD_HASH_MULTIPLIER
+    return ((mixed >> np.uint64(32)) % np.uint64(shard_count)).astype(np.int64)
+
+
+def has_songs_table(db_path) -> bool:
+    """False for a database file that doesn't exist yet or was never set up."""
+    if not Path(db_path).is_file():
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'songs'").fetchone() is not None
+    finally:
+        conn.close()
+
+
+def is_sharded(db_path) -> bool:
+    return (Path(db_path) / SHARDS_FILE).is_file()
+
+
+def read_shard_paths(db_path) -> list:
+    """Paths of the shards of a sharded database, or [db_path] for a single database file."""
+    if not is_sharded(db_path):
+        return [Path(db_path)]
+    with open(Path(db_path) / SHARDS_FILE, 'r', encoding='utf-8') as f:
+        return [Path(db_path) / shard for shard in json.load(f)['shards']]
+
+
+def write_shards_file(shard_dir, shard_names: list) -> None:
+    with open(Path(shard_dir) / SHARDS_FILE, 'w', encoding='utf-8') as f:
+        json.dump({'shard_count': len(shard_names), 'shards': shard_names}, f)
+
+
+def setup_sharded_db(shard_dir, shard_count: int, clustered: bool = False) -> None:
+    """
+    Creates a directory of shard_count databases. Every shard holds the full songs and settings tables with the
+    same song ids, and the fingerprints whose hash shard_of routes to it. The first shard's songs table is the
+    catalog that ingestion reads; its hash_count columns count only the shard's own rows.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    shard_names = [f'shard-{shard:03d}.db' for shard in range(shard_count)]
+    for shard_name in shard_names:
+        setup_db(shard_dir / shard_name, clustered=clustered)
+    write_shards_file(shard_dir, shard_names)
+
+
+def fingerprints_table_version(cursor) -> int:
+    """Schema version of an existing fingerprints table judged by its column types, or None if there is none."""
+    column_types = {row[1]: row[2].upper() for row in cursor.execute("PRAGMA table_info(fingerprints)").fetchall()}
+    if not column_types:
+        return None
+    return 2 if column_types.get('hash_value') == 'INTEGER' and column_types.get('offset') == 'INTEGER' else 1
+
+
+def setup_db(db_name, schema_version: int = SCHEMA_VERSION, clustered: bool = False):
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
@@ -12,22 +180,126 @@ def setup_db(db_name):
             song_duration REAL
         )
     ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS fingerprints (
-            hash_value TEXT NOT NULL, -- Or INTEGER if your hashes are numeric
-            song_id INTEGER NOT NULL,
-            offset REAL NOT NULL, -- Store time in seconds
-            FOREIGN KEY (song_id) REFERENCES songs (song_id)
-        )
-    ''')
+    add_missing_song_columns(cursor)
+    existing_version = fingerprints_table_version(cursor)
+    create_fingerprints_table(cursor, 'fingerprints', schema_version, clustered)
+    create_settings_table(cursor)
 
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_hash_value ON fingerprints (hash_value)
-    ''')
+    if not is_clustered(conn):
+        create_hash_index(cursor)
+    create_song_index(cursor)
+    if existing_version == 1 and schema_version >= 2:
+        # stamping the old table as version 2 would make readers take its offsets in seconds for frame numbers
+        print(f"{db_name} has a version 1 fingerprints table, convert it with migrate_db.")
+    elif schema_version >= 2:
+        cursor.execute(f"PRAGMA user_version = {schema_version}")
 
     conn.commit()
     conn.close()
 
 
+def migrate_db(db_name, clustered: bool = False, sampling_rate: int = 22050, hop_length: int = 512) -> None:
+    """Converts a version 1 database in place to the compact version 2 schema."""
+    conn = sqlite3.connect(db_name)
+    if get_schema_version(conn) >= 2:
+        print(f"{db_name} already uses schema version {get_schema_version(conn)}.")
+        conn.close()
+        return
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    create_fingerprints_table(cursor, 'fingerprints_v2', 2, clustered)
+    cursor.execute(f'''
+        INSERT {'OR IGNORE ' if clustered else ''}INTO fingerprints_v2 (hash_value, song_id, offset)
+        SELECT CAST(hash_value AS INTEGER), song_id, CAST(ROUND(offset * {sampling_rate} / {hop_length}) AS INTEGER)
+        FROM fingerprints ORDER BY rowid
+    ''')
+    migrated_rows = cursor.rowcount
+    cursor.execute("DROP INDEX IF EXISTS idx_hash_value")
+    cursor.execute("DROP TABLE fingerprints")
+    cursor.execute("ALTER TABLE fingerprints_v2 RENAME TO fingerprints")
+    if not clustered:
+        create_hash_index(cursor)
+    create_song_index(cursor)
+    cursor.execute("PRAGMA user_version = 2")
+    conn.commit()
+
+    # hashes from before the packed hash format are arbitrary 64-bit values and will never match new samples
+    cursor.execute("SELECT COUNT(*) FROM fingerprints WHERE hash_value < 0 OR hash_value >= (1 << 36)")
+    if cursor.fetchone()[0]:
+        print(f"Warning: {db_name} contains fingerprints from the old hash format, re-index its songs.")
+
+    cursor.execute("VACUUM")
+    conn.close()
+    print(f"Migrated {migrated_rows} fingerprint entries in {db_name} to schema version 2.")
+
+
+def reshard_db(source, target_dir, shard_count: int, clustered: bool = False, chunk_size: int = 1_000_000) -> None:
+    """
+    Copies a database or sharded database into a new directory of shard_count shards, e.g. to split a database
+    that outgrew one file or to rebalance after changing the shard count. The source is only read, and the
+    target only becomes a sharded database once its shards.json is written at the end.
+    """
+    source_paths = read_shard_paths(source)
+    target_dir = Path(target_dir)
+    if target_dir.exists() and any(target_dir.iterdir()):
+        raise ValueError(f"{target_dir} is not empty")
+    source_conns = [sqlite3.connect(path) for path in source_paths]
+    if any(get_schema_version(conn) < 2 for conn in source_conns):
+        raise ValueError(f"{source} uses schema version 1, migrate it with migrate_db first")
+
+    target_dir.mkdir(parents=True, exist_ok=True)
+    shard_names = [f'shard-{shard:03d}.db' for shard in range(shard_count)]
+    target_conns = []
+    for shard_name in shard_names:
+        setup_db(target_dir / shard_name, clustered=clustered)
+        conn = sqlite3.connect(target_dir / shard_name)
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("DROP INDEX IF EXISTS idx_hash_value") # both rebuilt once after the copy
+        conn.execute("DROP INDEX IF EXISTS idx_song_id")
+        target_conns.append(conn)
+
+    # songs and settings come from the first source shard, which holds the catalog
+    catalog = source_conns[0]
+    song_columns = [row[1] for row in catalog.execute("PRAGMA table_info(songs)").fetchall()]
+    songs = catalog.execute(f"SELECT {', '.join(song_columns)} FROM songs").fetchall()
+    try:
+        settings = catalog.execute("SELECT key, value FROM settings").fetchall()
+    except sqlite3.OperationalError:
+        settings = [] # database from before the settings table
+    for conn in target_conns:
+        conn.executemany(f"INSERT INTO songs ({', '.join(song_columns)}) VALUES ({', '.join('?' * len(song_columns))})", songs)
+        conn.execute("UPDATE songs SET hash_count = 0")
+        conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", settings)
+
+    copied_rows = 0
+    insert = "INSERT OR IGNORE" if clustered else "INSERT"
+    for source_conn in source_conns:
+        row_order = 'hash_value, song_id, offset' if is_clustered(source_conn) else 'rowid'
+        cursor = source_conn.execute(f"SELECT hash_value, song_id, offset FROM fingerprints ORDER BY {row_order}")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            shard_rows = [[] for _ in target_conns]
+            for row, shard in zip(rows, shard_of([row[0] for row in rows], shard_count).tolist()):
+                shard_rows[shard].append(row)
+            for conn, rows_of_shard in zip(target_conns, shard_rows):
+                conn.executemany(f"{insert} INTO fingerprints (hash_value, song_id, offset) VALUES (?, ?, ?)", rows_of_shard)
+            copied_rows += len(rows)
+        source_conn.close()
+
+    for conn in target_conns:
+        hash_counts = conn.execute("SELECT song_id, COUNT(*) FROM fingerprints GROUP BY song_id").fetchall()
+        conn.executemany("UPDATE songs SET hash_count = ? WHERE song_id = ?", [(count, song_id) for song_id, count in hash_counts])
+        if not clustered:
+            create_hash_index(conn.cursor())
+        create_song_index(conn.cursor())
+        conn.commit()
+        conn.close()
+    write_shards_file(target_dir, shard_names)
+    print(f"Copied {copied_rows} fingerprint entries from {source} into {shard_count} shards in {target_dir}")
+
+
 if __name__ == '__main__':
-    setup_db('limittest_database.db')
\ No newline at end of file
+    setup_db('limittest_database.db')
@@ -0,0 +1,118 @@
+from collections import namedtuple
+from typing import Iterator
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+from fingerprinting import SAMPLING_RATE, HOP_LENGTH, N_FFT, DEFAULT_FRONT_END, FrontEnd, find_peak_indices, \
+    generate_fingerprints, match_sample_db, peak_indices_to_peaks
+from fingerprint_index import open_index
+
+Detection = namedtuple('Detection', ['start', 'end', 'song', 'score', 'confidence'])
+
+
+def stream_audio_blocks(path: str, block_seconds: float = 5.0, sampling_rate: int = SAMPLING_RATE) -> Iterator[np.ndarray]:
+    """Reads a file block by block and yields it as mono float32 at sampling_rate."""
+    with sf.SoundFile(path) as audio_file:
+        resampler = soxr.ResampleStream(audio_file.samplerate, sampling_rate, 1, dtype='float32')
+        block_size = int(block_seconds * audio_file.samplerate)
+        while True:
+            block = audio_file.read(block_size, dtype='float32', always_2d=True)
+            last = len(block) < block_size
+            resampled = resampler.resample_chunk(block.mean(axis=1), last=last)
+            if len(resampled):
+                yield resampled
+            if last:
+                break
+
+
+class StreamingSpectrogram:
+    """
+    Incremental magnitude STFT. Feeding a signal in arbitrary blocks and calling flush() yields the same frames
+    as lr.stft(signal, n_fft=N_FFT, hop_length=HOP_LENGTH) with its default centered, zero padded framing.
+    """
+
+    def __init__(self, n_fft: int = N_FFT, hop_length: int = HOP_LENGTH):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        from scipy.signal import get_window # imported on first use, so importing streaming doesn't load scipy
+        self.window = get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        self.buffer = np.zeros(n_fft // 2, dtype=np.float32)
+
+    def push(self, samples: np.ndarray) -> np.ndarray:
+        """Returns the magnitudes (freq x frames) of all frames that are complete after adding samples."""
+        self.buffer = np.concatenate((self.buffer, samples.astype(np.float32)))
+        if len(self.buffer) < self.n_fft:
+            return np.empty((self.n_fft // 2 + 1, 0), dtype=np.float32)
+
+        frame_count = 1 + (len(self.buffer) - self.n_fft) // self.hop_length
+        frames = np.lib.stride_tricks.sliding_window_view(self.buffer, self.n_fft)[::self.hop_length][:frame_count]
+        magnitudes = np.abs(np.fft.rfft(frames * self.window, axis=1)).T.astype(np.float32)
+        self.buffer = self.buffer[frame_count * self.hop_length:]
+        return magnitudes
+
+    def flush(self) -> np.ndarray:
+        return self.push(np.zeros(self.n_fft // 2, dtype=np.float32))
+
+
+def recognize_window(magnitudes: np.ndarray, index, peak_min_distance: int, peak_min_amplitude_threshold: int,
+                     max_peaks_per_frame: int = None, front_end: FrontEnd = DEFAULT_FRONT_END):
+    """magnitudes holds only the front end's bins, as cut by recognize_stream."""
+    spectrogram = 20 * np.log10(np.maximum(magnitudes, 1e-10) / max(magnitudes.max(), 1e-10)) # dB relative to the window maximum
+    frames, bins = find_peak_indices(spectrogram, peak_min_distance, peak_min_amplitude_threshold, max_peaks_per_frame)
+    if not len(frames):
+        return None, 0, 0.0
+    window_hashes = generate_fingerprints(peak_indices_to_peaks(frames, bins, front_end), 'stream')
+    return match_sample_db(window_hashes, index, magnitudes.shape[1] * HOP_LENGTH / SAMPLING_RATE)
+
+
+def recognize_stream(path: str, db_path, window_seconds: float = 10.0, step_seconds: float = 5.0,
+                     peak_min_distance: int = 25, peak_min_amplitude_threshold: int = -40,
+                     min_score: int = 0, max_peaks_per_frame: int = None) -> Iterator[Detection]:
+    """
+    Slides a window_seconds window in steps of step_seconds over a recording of any length and yields a Detection
+    for every window whose best match scores at least min_score. Only the current window's STFT frames are kept
+    in memory, so the first detections arrive after one window of audio has been read.
+    """
+    index = open_index(db_path)
+    front_end = index.front_end
+    first_bin, last_bin = front_end.bin_range()
+    # frames last HOP_LENGTH / SAMPLING_RATE seconds for every front end
+    window_frames = int(round(window_seconds * SAMPLING_RATE / HOP_LENGTH))
+    step_frames = int(round(step_seconds * SAMPLING_RATE / HOP_LENGTH))
+    stft = StreamingSpectrogram(front_end.fft_size, front_end.hop_length)
+
+    window = np.empty((last_bin - first_bin, 0), dtype=np.float32)
+    window_start = 0 # frame index of the first frame in window
+    matched_until = 0 # frames before this one were already part of a matched window
+
+    def match_window(frames: np.ndarray, start_frame: int):
+        song, score, confidence = recognize_window(frames, index, peak_min_distance, peak_min_amplitude_threshold,
+                                                   max_peaks_per_frame, front_end)
+        if song is not None and score >= min_score:
+            return Detection(start_frame * HOP_LENGTH / SAMPLING_RATE,
+                             (start_frame + frames.shape[1]) * HOP_LENGTH / SAMPLING_RATE, song, score, confidence)
+        return None
+
+    def new_frames():
+        for block in stream_audio_blocks(path, sampling_rate=front_end.sampling_rate):
+            yield stft.push(block)[first_bin:last_bin]
+        yield stft.flush()[first_bin:last_bin]
+
+    for frames in new_frames():
+        window = np.concatenate((window, frames), axis=1)
+        while window.shape[1] >= window_frames:
+            detection = match_window(window[:, :window_frames], window_start)
+            matched_until = window_start + window_frames
+            if detection:
+                yield detection
+            window = window[:, step_frames:]
+            window_start += step_frames
+
+    # the tail of the recording that no full window covered
+    if window.shape[1] and window_start + window.shape[1] > matched_until:
+        tail = window[:, -window_frames:]
+        detection = match_window(tail, window_start + window.shape[1] - tail.shape[1])
+        if detection:
+            yield detection
@@ -0,0 +1,54 @@
+import sqlite3
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+import metrics
+from experiments.benchmark import synthetic_song
+from fingerprinting import SAMPLING_RATE, HOP_LENGTH, add_fingerprint_arrays_to_db, add_song_to_db, compute_spectrogram, \
+    find_peak_indices, generate_fingerprint_arrays, generate_fingerprints, peak_indices_to_peaks
+from setup import setup_db
+
+metrics.enable(False)
+
+SONG_SECONDS = 15.0
+CLIP_SECONDS = 5.0
+
+Catalog = namedtuple('Catalog', ['db_path', 'songs', 'samples', 'sample_len']) # songs: { name: signal }, samples: [fingerprint dict]
+
+
+def signal_peaks(signal: np.ndarray) -> np.ndarray:
+    frames, bins = find_peak_indices(compute_spectrogram(signal), 25, -40)
+    return peak_indices_to_peaks(frames, bins)
+
+
+def fingerprint_catalog(db_path, songs: dict, schema_version: int = 2) -> None:
+    """A SQLite database holding the fingerprints of songs."""
+    setup_db(db_path, schema_version)
+    conn = sqlite3.connect(db_path)
+    for name, signal in songs.items():
+        song_id = add_song_to_db(conn, name, f'{name}.wav', len(signal) / SAMPLING_RATE, commit=False)
+        add_fingerprint_arrays_to_db(conn, song_id, *generate_fingerprint_arrays(signal_peaks(signal)))
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def catalog(tmp_path_factory) -> Catalog:
+    """
+    A catalog of synthetic songs and the fingerprints of samples to match against it: a noisy excerpt of every
+    song, one that doesn't start on the frame grid, two songs mixed together and a song the catalog doesn't hold.
+    """
+    songs = {f'song{seed}': synthetic_song(seed, SONG_SECONDS) for seed in range(8)}
+    db_path = tmp_path_factory.mktemp('catalog') / 'catalog.db'
+    fingerprint_catalog(db_path, songs)
+
+    rng = np.random.default_rng(0)
+    clip_samples = int(CLIP_SECONDS * SAMPLING_RATE)
+    max_start = int((SONG_SECONDS - CLIP_SECONDS) * SAMPLING_RATE)
+    clips = [signal[start:start + clip_samples] + rng.normal(0, 0.01, clip_samples).astype(np.float32)
+             for signal, start in zip(songs.values(), rng.integers(0, max_start // HOP_LENGTH, len(songs)) * HOP_LENGTH)]
+    clips.append(songs['song0'][1000:1000 + clip_samples])
+    clips.append(songs['song1'][:clip_samples] + 0.8 * songs['song2'][:clip_samples])
+    clips.append(synthetic_song(100, CLIP_SECONDS))
+    return Catalog(db_path, songs, [generate_fingerprints(signal_peaks(clip), 'test') for clip in clips], CLIP_SECONDS)
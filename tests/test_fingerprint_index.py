@@ -0,0 +1,96 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import metrics
+from fingerprint_index import SQLiteIndex, build_compressed_index, build_mmap_index, build_sharded_mmap_index, open_index
+from fingerprinting import add_fingerprint_arrays_to_shards, match_sample_db, replace_song_in_shards
+from setup import read_shard_paths, reshard_db, setup_db, setup_sharded_db, shard_of
+
+metrics.enable(False)
+
+
+def assert_same_as_sqlite(index, catalog) -> None:
+    """Every sample resolves to the same rows in the same order and gets the same match as from the SQLite catalog."""
+    reference = SQLiteIndex(catalog.db_path)
+    for sample in catalog.samples:
+        for expected, actual in zip(reference.lookup(list(sample)), index.lookup(list(sample))):
+            np.testing.assert_array_equal(actual, expected)
+        assert match_sample_db(sample, index, catalog.sample_len) == match_sample_db(sample, reference, catalog.sample_len)
+    reference.close()
+
+
+def test_catalog_samples_match_their_songs(catalog):
+    reference = SQLiteIndex(catalog.db_path)
+    matches = [match_sample_db(sample, reference, catalog.sample_len)[0] for sample in catalog.samples]
+    reference.close()
+
+    assert matches[:len(catalog.songs)] == list(catalog.songs)
+
+
+def test_mmap_index_matches_like_sqlite(catalog, tmp_path):
+    assert_same_as_sqlite(build_mmap_index(catalog.db_path, tmp_path / 'index'), catalog)
+    assert_same_as_sqlite(open_index(tmp_path / 'index'), catalog)
+
+
+def test_sharded_index_matches_like_sqlite(catalog, tmp_path):
+    reshard_db(catalog.db_path, tmp_path / 'shards', 3)
+    build_sharded_mmap_index(tmp_path / 'shards', tmp_path / 'index')
+
+    assert_same_as_sqlite(open_index(tmp_path / 'shards'), catalog)
+    assert_same_as_sqlite(open_index(tmp_path / 'index'), catalog)
+
+
+def test_compressed_index_matches_like_sqlite(catalog, tmp_path):
+    assert_same_as_sqlite(build_compressed_index(catalog.db_path, tmp_path / 'index'), catalog)
+    reshard_db(catalog.db_path, tmp_path / 'shards', 3)
+    build_sharded_mmap_index(tmp_path / 'shards', tmp_path / 'sharded_index', compressed=True)
+    assert_same_as_sqlite(open_index(tmp_path / 'sharded_index'), catalog)
+
+
+
+def test_hash_count_of_a_database_without_the_column(catalog, tmp_path, monkeypatch):
+    db_path = tmp_path / 'old.db'
+    with sqlite3.connect(catalog.db_path) as source, sqlite3.connect(db_path) as target:
+        source.backup(target)
+        target.execute("ALTER TABLE songs DROP COLUMN hash_count")
+    reference, index = SQLiteIndex(catalog.db_path), SQLiteIndex(db_path)
+    song_ids = list(reference.songs)
+
+    assert [index.hash_count(song_id) for song_id in song_ids] == [reference.hash_count(song_id) for song_id in song_ids]
+    monkeypatch.setattr(index.pool, 'connection', lambda: pytest.fail("hash count was not kept"))
+    assert [index.hash_count(song_id) for song_id in song_ids] == [reference.hash_count(song_id) for song_id in song_ids]
+    reference.close()
+    index.close()
+
+def assert_no_postings(index, sample_hashes: list):
+    sample_idx, song_ids, offsets = index.lookup(sample_hashes)
+    assert len(sample_idx) == len(song_ids) == len(offsets) == 0
+    assert index.posting_lengths(sample_hashes).tolist() == [0] * len(sample_hashes)
+
+
+def test_empty_compressed_index(tmp_path):
+    setup_db(tmp_path / 'empty.db')
+    index = build_compressed_index(tmp_path / 'empty.db', tmp_path / 'index')
+
+    assert_no_postings(index, [0])
+    assert_no_postings(open_index(tmp_path / 'index'), [0, 12345])
+
+
+def test_compressed_index_with_an_empty_shard(tmp_path):
+    setup_sharded_db(tmp_path / 'shards', 2)
+    hashes = np.arange(1, 200, dtype=np.int64)
+    hashes = hashes[shard_of(hashes, 2) == 0]
+    shard_conns = [sqlite3.connect(path) for path in read_shard_paths(tmp_path / 'shards')]
+    song_id = replace_song_in_shards(shard_conns, 'song', 'song.wav', 10.0, None, None, None)
+    add_fingerprint_arrays_to_shards(shard_conns, song_id, hashes, np.linspace(0.0, 9.0, len(hashes)))
+    build_sharded_mmap_index(tmp_path / 'shards', tmp_path / 'index', compressed=True)
+    index = open_index(tmp_path / 'index')
+
+    empty_shard_hashes = [hash_value for hash_value in range(200, 400) if shard_of([hash_value], 2)[0] == 1]
+    assert_no_postings(index, empty_shard_hashes)
+    assert_no_postings(index, [0])
+    sample_idx, song_ids, _ = index.lookup(hashes[:3].tolist() + empty_shard_hashes[:2])
+    assert sample_idx.tolist() == [0, 1, 2]
+    assert song_ids.tolist() == [song_id] * 3
@@ -0,0 +1,28 @@
+import pytest
+
+import metrics
+from fingerprint_index import SQLiteIndex, build_mmap_index
+from fingerprinting import match_sample_db
+
+metrics.enable(False)
+
+
+@pytest.fixture
+def indexes(catalog, tmp_path):
+    reference = SQLiteIndex(catalog.db_path)
+    yield {'sqlite': reference, 'mmap': build_mmap_index(catalog.db_path, tmp_path / 'index')}
+    reference.close()
+
+
+def test_progressive_matches_like_full_scoring(catalog, indexes):
+    for sample in catalog.samples:
+        expected = match_sample_db(sample, indexes['sqlite'], catalog.sample_len)
+        for index in indexes.values():
+            assert match_sample_db(sample, index, catalog.sample_len, progressive=True) == expected
+
+
+def test_progressive_with_margin_finds_the_same_songs(catalog, indexes):
+    for sample in catalog.samples[:len(catalog.songs)]:
+        expected = match_sample_db(sample, indexes['sqlite'], catalog.sample_len)
+        for index in indexes.values():
+            assert match_sample_db(sample, index, catalog.sample_len, progressive=True, margin=2.0) == expected
@@ -0,0 +1,36 @@
+import time
+
+import metrics
+from recognition_service import ResultCache, hashes_cache_key
+
+metrics.enable(False)
+
+
+def test_hashes_key_ignores_hash_order_but_not_the_index_version():
+    cache = ResultCache(8, params={'peak_min_dist': 25})
+
+    assert hashes_cache_key([3, 1, 2], cache.key_context((1,))) == hashes_cache_key([1, 2, 3], cache.key_context((1,)))
+    assert hashes_cache_key([1, 2, 3], cache.key_context((1,))) != hashes_cache_key([1, 2, 3], cache.key_context((2,)))
+    assert cache.upload_key(b'audio', (1,)) != cache.upload_key(b'audio', (2,))
+    assert ResultCache(8, params={'peak_min_dist': 10}).key_context((1,)) != cache.key_context((1,))
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(2)
+    cache.put('hashes:a', ('song0', 10))
+    cache.put('hashes:b', ('song1', 20))
+    cache.get('hashes:a')
+    cache.put('hashes:c', ('song2', 30))
+
+    assert cache.get('hashes:a') == ('song0', 10)
+    assert cache.get('hashes:b') is None
+    assert cache.live_keys('hashes') == frozenset({'hashes:a', 'hashes:c'})
+
+
+def test_result_cache_expires_entries():
+    cache = ResultCache(2, ttl_seconds=0.01)
+    cache.put('upload:a', (None, 0))
+    time.sleep(0.02)
+
+    assert cache.live_keys('upload') == frozenset()
+    assert cache.get('upload:a') is None
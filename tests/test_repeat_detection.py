@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import metrics
+from experiments.benchmark import synthetic_song
+from fingerprinting import generate_fingerprint_arrays
+from repeat_detection import LAG_BIN_SECONDS, find_repeats, loop_coverage, recording_peaks
+
+metrics.enable(False)
+
+
+def looped_recording(loop_seconds: float, loop_count: int) -> np.ndarray:
+    """A loop of loop_seconds repeated loop_count times between two different songs, over faint noise."""
+    signal = np.concatenate((synthetic_song(100, 20.0), np.tile(synthetic_song(7, loop_seconds), loop_count), synthetic_song(101, 15.0)))
+    return signal + np.random.default_rng(1).normal(0, 0.002, len(signal)).astype(np.float32)
+
+
+def repeats_of(signal: np.ndarray):
+    peaks, duration = recording_peaks([signal])
+    return find_repeats(*generate_fingerprint_arrays(peaks)), duration
+
+
+# none of these periods is a whole number of frames, so most loop iterations don't align their hashes with the next one
+@pytest.mark.parametrize('loop_seconds', [9.3, 11.7, 13.1])
+def test_loop_period_off_the_frame_grid(loop_seconds):
+    loop_count = int(120 // loop_seconds)
+    repeats, duration = repeats_of(looped_recording(loop_seconds, loop_count))
+
+    assert len(repeats) == 1
+    assert abs(repeats[0].period - loop_seconds) <= LAG_BIN_SECONDS
+    assert loop_coverage(repeats[0], duration) == pytest.approx(loop_count * loop_seconds / duration, abs=0.1)
+
+
+def test_no_repeats_without_a_loop():
+    repeats, _ = repeats_of(np.concatenate([synthetic_song(seed, 30.0) for seed in range(200, 204)]))
+
+    assert repeats == []
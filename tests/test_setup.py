@@ -0,0 +1,29 @@
+import numpy as np
+
+import metrics
+from conftest import fingerprint_catalog
+from fingerprint_index import SQLiteIndex
+from fingerprinting import match_sample_db
+from setup import migrate_db
+
+metrics.enable(False)
+
+
+def assert_same_matches(db_path, catalog) -> None:
+    index, reference = SQLiteIndex(db_path), SQLiteIndex(catalog.db_path)
+    for sample in catalog.samples:
+        expected, actual = reference.lookup(list(sample)), index.lookup(list(sample))
+        np.testing.assert_array_equal(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+        np.testing.assert_allclose(actual[2], expected[2], atol=1e-6) # seconds against whole frames
+        assert match_sample_db(sample, index, catalog.sample_len) == match_sample_db(sample, reference, catalog.sample_len)
+    index.close()
+    reference.close()
+
+
+def test_v1_database_matches_like_v2(catalog, tmp_path):
+    fingerprint_catalog(tmp_path / 'v1.db', catalog.songs, schema_version=1)
+
+    assert_same_matches(tmp_path / 'v1.db', catalog)
+    migrate_db(tmp_path / 'v1.db')
+    assert_same_matches(tmp_path / 'v1.db', catalog)
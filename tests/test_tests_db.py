@@ -0,0 +1,56 @@
+import pytest
+import soundfile as sf
+
+import metrics
+from experiments.benchmark import synthetic_song
+from experiments.tests_db import execute_multi_clip_test, execute_test
+from fingerprinting import SAMPLING_RATE
+from setup import setup_db
+
+metrics.enable(False)
+
+
+def experiment(tmp_path) -> dict:
+    return {"name": str(tmp_path / "experiment.csv"), "seed": 42, "clip_len": 5, "add_noise": 0,
+            "fingerprinting": {"peak_min_dist": 25, "peak_min_amp": -40}}
+
+
+def test_clip_without_match_counts_as_no_match(tmp_path):
+    db_file = tmp_path / "empty.db"
+    setup_db(db_file)
+    clips = tmp_path / "clips"
+    clips.mkdir()
+    sf.write(clips / "unknown.wav", synthetic_song(1, 10.0), SAMPLING_RATE)
+
+    results = execute_test(str(db_file), clips, experiment(tmp_path))
+
+    assert results["no_matches"] == 1
+    assert results["threshold_too_high"] == 0
+    assert results["failed_to_test"] == 0
+
+
+def test_recordings_header_is_written_once(tmp_path):
+    db_file = tmp_path / "empty.db"
+    setup_db(db_file)
+    clips = tmp_path / "clips"
+    clips.mkdir()
+    sf.write(clips / "unknown.wav", synthetic_song(1, 10.0), SAMPLING_RATE)
+    exp = {**experiment(tmp_path), "clips_per_file": 2}
+
+    execute_multi_clip_test(str(db_file), clips, exp)
+    execute_multi_clip_test(str(db_file), clips, exp)
+
+    lines = (tmp_path / "experiment.csv_recordings.csv").read_text().splitlines()
+    assert [line.split(',')[0] for line in lines] == ['path', str(clips / "unknown.wav"), str(clips / "unknown.wav")]
+
+
+def test_front_end_other_than_the_index_is_rejected(tmp_path):
+    db_file = tmp_path / "empty.db"
+    setup_db(db_file)
+    exp = experiment(tmp_path)
+    exp["fingerprinting"]["decimation"] = 2
+
+    with pytest.raises(ValueError):
+        execute_test(str(db_file), tmp_path, exp)
+    with pytest.raises(ValueError):
+        execute_multi_clip_test(str(db_file), tmp_path, {**exp, "clips_per_file": 2})